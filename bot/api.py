@@ -1,22 +1,34 @@
+import asyncio
+import contextlib
 import json
 import logging
+import os
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, cast
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional, cast
 
 import aiohttp
-import requests
 from marshmallow import Schema, fields
 
-DEFAULT_CLIENT_VERSION = "7.2.2.4"
-DEFAULT_IOS_VERSION = "17.4.1"
+import decoders
+import metrics
+import transport
+from transport import InvalidToken
+
+LAB_ID = 68334
+# WALKR_API_BASE_URL=http://127.0.0.1:8088/api/v2 - ходить в локальный fake_server.py вместо настоящего walkr
+API_BASE_URL = os.environ.get('WALKR_API_BASE_URL', 'https://production.sw.fourdesire.com/api/v2').rstrip('/')
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-
-# todo: перейти на https://github.com/lovasoa/marshmallow_dataclass
-# а то выходит, что поля приходится дублировать
+# по умолчанию ответы разбираются через decoders, marshmallow-схемы здесь - строгий режим для тестов и отладки
+STRICT_DECODING = False
+# /comments читаем и разбираем потоком: в памяти один комментарий за раз, а не весь ответ на limit штук.
+# Такие ответы не проходят через response_cache; в STRICT_DECODING ответ всё равно читается целиком
+STREAM_COMMENTS = True
 
 
 class TimeStamp(fields.DateTime):
@@ -153,40 +165,95 @@ class FleetsApiAnswerSchema(Schema):
     now = TimeStamp()
 
 
-def _get_headers(
-        auth_token: str,
-        client_version: str = DEFAULT_CLIENT_VERSION,
-        ios_version: str = DEFAULT_IOS_VERSION,
-        **additional_params
-) -> dict[str, str]:
-    client_version = '.'.join(client_version.split('.')[:3])
-    headers = {
-        'Accept': '*/*',
-        'User-Agent': f'Walkr/{client_version} (iPhone; iOS {ios_version}; Scale/3.00)',
-        'Accept-Language': 'en-US;q=1, ru-RU;q=0.9',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'authorization': f'Bearer {auth_token}',
-    }
-    headers.update(additional_params)
-    return headers
-
-
-def _get_params(
-        client_version: str = DEFAULT_CLIENT_VERSION,
-        ios_version: str = DEFAULT_IOS_VERSION,
-        **additional_params
-) -> dict[str, str]:
-    data = {
-        "locale": "en",
-        "client_version": client_version,
-        "platform": "ios",
-        "timezone": 2,
-        "os_version": f"iOS {ios_version}",
-        "country_code": "RU",
-        "device_model": "iPhone13,2"
-    }
-    data.update(additional_params)
-    return data
+def api_url(path: str) -> str:
+    return f'{API_BASE_URL}{path}'
+
+
+class ResponseCache:
+    """
+    Кэш ответов api с коротким ttl + single-flight: одновременные одинаковые запросы
+    ждут один и тот же запрос к серверу вместо того, чтобы делать свои
+    """
+
+    def __init__(self, ttl: float = 2.0, max_size: int = 256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: OrderedDict[Hashable, tuple[float, str]] = OrderedDict()
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(method: str, url: str, params: dict, auth_token: str) -> Hashable:
+        return method, url, tuple(sorted((k, str(v)) for k, v in params.items())), auth_token
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'size': len(self._data),
+            'in_flight': len(self._in_flight),
+        }
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def _get(self, key: Hashable) -> Optional[str]:
+        cached = self._data.get(key)
+        if cached is None:
+            return None
+        expires_at, value = cached
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def _put(self, key: Hashable, value: str) -> None:
+        if self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[str]]) -> str:
+        value = self._get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        self.misses += 1
+        # запрос идёт отдельной задачей, чтобы отмена того, кто его начал, не ломала остальным
+        task = asyncio.ensure_future(fetch())
+        self._in_flight[key] = task
+        task.add_done_callback(lambda t: self._on_fetched(key, t))
+        return await asyncio.shield(task)
+
+    def _on_fetched(self, key: Hashable, task: asyncio.Future) -> None:
+        del self._in_flight[key]
+        # .exception() заодно помечает ошибку прочитанной, если её никто не ждал
+        if not task.cancelled() and task.exception() is None:
+            self._put(key, task.result())
+
+
+response_cache = ResponseCache()
+
+for _stat, _type in (('hits', 'counter'), ('misses', 'counter'), ('coalesced', 'counter'),
+                     ('size', 'gauge'), ('in_flight', 'gauge')):
+    metrics.callback_metric(
+        f'walkr_response_cache_{_stat}' + ('_total' if _type == 'counter' else ''),
+        f'Walkr response cache {_stat}',
+        lambda stat=_stat: response_cache.stats()[stat],
+        _type,
+    )
 
 
 async def make_async_request(
@@ -195,69 +262,27 @@ async def make_async_request(
         session: aiohttp.ClientSession,
         auth_token: str,
         additional_params: dict = None,
-        additional_headers: dict = None
+        additional_headers: dict = None,
+        use_cache: bool = True,
 ) -> str:
-    # todo: 1-2 second optional cache to prevent the same multiple requests (oh no, async)
     additional_params = additional_params or {}
     additional_headers = additional_headers or {}
-    params = _get_params(**additional_params)
-    headers = _get_headers(auth_token, **additional_headers)
-
-    logger.info('async %s %s params=%s headers=%s', method, url, params, headers)
-    cookies = session.cookie_jar.filter_cookies(session._build_url(url))
-    logger.debug(f'cookies: {cookies}')
-
-    if method == 'get':
-        mng = session.get(url, params=params, headers=headers, ssl=False)
-    elif method == 'post':
-        data = json.dumps(params)
-        mng = session.post(url, data=data, headers=headers, ssl=False)
-    else:
-        raise ValueError(f'unknown method - {method}')
-
-    async with mng as response:
-        result = await response.text()
-        if response.status == 401:
-            # токен устарел
-            # todo: а вот тут надо выставить active=0 токену в бд
-            raise ValueError('response code is 401, token is invalid: %s url: %s\ndata=%s', response.status, url,
-                             result)
-        elif response.status != 200:
-            raise ValueError(f'response code is not 200: {response.status} url: {url}\ndata={result}')
-        logger.info('response %s status, \ndata=%s', response.status, result)
-        return result
-
-
-def make_sync_request(
-        method: str,
-        url: str,
-        auth_token: str,
-        additional_params: dict = None,
-        additional_headers: dict = None
-) -> str:
-    # отдельный метод добавляю для cli, чтобы async там не городить
-    # todo: объединить два этих метода как-нибудь
-    additional_params = additional_params or {}
-    additional_headers = additional_headers or {}
-    params = _get_params(**additional_params)
-    headers = _get_headers(auth_token, **additional_headers)
-
-    logger.info('sync %s %s params=%s headers=%s', method, url, params, headers)
-    if method == 'get':
-        resp = requests.get(url, params=params, headers=headers)
-    elif method == 'post':
-        resp = requests.post(url, data=params, headers=headers)
-    else:
-        raise ValueError(f'unknown method - {method}')
-
-    result = resp.text
-    if resp.status_code != 200:
-        raise ValueError('response code is not 200: %s url: %s\ndata=%s', resp.status_code, url, result)
-    logger.info('response %s status, \ndata=%s', resp.status_code, result)
-    return result
-
-
-@dataclass
+    params = transport.get_params(**additional_params)
+    headers = transport.get_headers(auth_token, **additional_headers)
+
+    try:
+        if method == 'get' and use_cache:
+            key = response_cache.make_key(method, url, params, auth_token)
+            return await response_cache.get_or_fetch(
+                key, lambda: transport.request_async(method, url, session, params, headers)
+            )
+        return await transport.request_async(method, url, session, params, headers)
+    except InvalidToken as e:
+        e.auth_token = auth_token
+        raise
+
+
+@dataclass(slots=True)
 class FleetWrapper:
     name: str
     id: int
@@ -297,7 +322,7 @@ class FleetWrapper:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class EventWrapper:
     status: str  # event/path
     type: str  # preparation/...
@@ -336,15 +361,15 @@ class NotInEpic(Exception):
 
 
 async def get_fleet(auth_token: str, session: aiohttp.ClientSession) -> tuple[FleetWrapper, EventWrapper]:
-    url = 'https://production.sw.fourdesire.com/api/v2/fleets/current'
+    url = api_url('/fleets/current')
     result: str = await make_async_request('get', url, session, auth_token)
-    result: dict = FleetsApiAnswerSchema().loads(result)
+    # врапперы читают только поля без конвертации, поэтому без strict хватает голого json
+    result: dict = FleetsApiAnswerSchema().loads(result) if STRICT_DECODING else json.loads(result)
 
     fleet = FleetWrapper.from_api_answer(result)
     if not fleet:
         raise NotInEpic
 
-    fleet = FleetWrapper.from_api_answer(result)
     event = EventWrapper.from_api_answer(result)
 
     return fleet, event
@@ -381,7 +406,7 @@ class CommentsAnswerSchema(Schema):
     now = TimeStamp()
 
 
-@dataclass
+@dataclass(slots=True)
 class LabRequestWrapper:
     created_at: datetime
     user_id: int
@@ -392,40 +417,139 @@ class LabRequestWrapper:
     current_donation: int
     last_requested_at: datetime
     donated_counter: str
+    comment_id: Optional[int] = None
 
 
-async def get_lab_planets(auth_token: str, session: aiohttp.ClientSession) -> list[LabRequestWrapper]:
+def _lab_request_from_schema(req: dict) -> LabRequestWrapper:
+    return LabRequestWrapper(
+        created_at=req['created_at'],
+        user_id=req['user']['id'],
+        user_name=req['user']['name'],
+        planet_name=req['comment']['identifier'],
+        requirements=req['comment']['requirements'],
+        total_donation=req['comment']['total_donation'],
+        current_donation=req['comment']['current_donation'],
+        last_requested_at=req['comment']['last_requested_at'],
+        donated_counter=req['comment']['donated_counter'],
+        comment_id=req['id'],
+    )
+
+
+_decode_lab_request = decoders.compile_decoder(LabRequestWrapper, {
+    'created_at': (('created_at',), decoders.timestamp),
+    'user_id': (('user', 'id'), None),
+    'user_name': (('user', 'name'), None),
+    'planet_name': (('comment', 'identifier'), None),
+    'requirements': (('comment', 'requirements'), None),
+    'total_donation': (('comment', 'total_donation'), None),
+    'current_donation': (('comment', 'current_donation'), None),
+    'last_requested_at': (('comment', 'last_requested_at'), decoders.timestamp),
+    'donated_counter': (('comment', 'donated_counter'), None),
+    'comment_id': (('id',), None),
+})
+
+_decode_user_request = decoders.compile_decoder(LabRequestWrapper, {
+    'planet_name': (('research', 'identifier'), None),
+    'requirements': (('research', 'requirements'), None),
+    'total_donation': (('research', 'total_donation'), None),
+    'current_donation': (('research', 'current_donation'), None),
+    'last_requested_at': (('research', 'last_requested_at'), decoders.timestamp),
+    'donated_counter': (('research', 'donated_counter'), None),
+})
+
+
+@dataclass(slots=True)
+class LabCommentsPage:
+    requests: list[LabRequestWrapper]
+    comments_count: int  # сколько всего комментариев пришло, включая стикеры и текст
+    max_comment_id: int  # 0, если не пришло ни одного
+
+
+def _comments_params(since_id: int, limit: int) -> dict:
+    return {
+        'commentable_id': LAB_ID,
+        'commentable_type': 'lab',
+        'limit': limit,
+        'queried_at': 2147483647,
+        'since_id': since_id,
+    }
+
+
+async def iter_lab_comments(
+        auth_token: str,
+        session: aiohttp.ClientSession,
+        since_id: int = 0,
+        limit: int = 3000
+) -> AsyncIterator[dict]:
+    """все комментарии лабы как dict из json, по одному по мере чтения ответа"""
+    params = transport.get_params(**_comments_params(since_id, limit))
+    headers = transport.get_headers(auth_token)
+    try:
+        async with contextlib.aclosing(
+                transport.stream_async(api_url('/comments'), session, params, headers)
+        ) as chunks:
+            async for comment in decoders.iter_array_items(chunks, 'comments'):
+                yield comment
+    except InvalidToken as e:
+        e.auth_token = auth_token
+        raise
+
+
+async def iter_lab_requests(
+        auth_token: str,
+        session: aiohttp.ClientSession,
+        since_id: int = 0,
+        limit: int = 3000
+) -> AsyncIterator[LabRequestWrapper]:
+    """только запросы энергии; стикеры и текст отбрасываются сразу после разбора"""
+    async with contextlib.aclosing(iter_lab_comments(auth_token, session, since_id, limit)) as comments:
+        async for c in comments:
+            if c['comment']['type'] == 'donation':
+                yield _decode_lab_request(c)
+
+
+async def get_lab_comments(
+        auth_token: str,
+        session: aiohttp.ClientSession,
+        since_id: int = 0,
+        limit: int = 3000
+) -> LabCommentsPage:
+    if STREAM_COMMENTS and not STRICT_DECODING:
+        page = LabCommentsPage(requests=[], comments_count=0, max_comment_id=0)
+        async with contextlib.aclosing(iter_lab_comments(auth_token, session, since_id, limit)) as comments:
+            async for c in comments:
+                page.comments_count += 1
+                page.max_comment_id = max(page.max_comment_id, c['id'])
+                if c['comment']['type'] == 'donation':
+                    page.requests.append(_decode_lab_request(c))
+        return page
+
     result = await make_async_request(
         'get',
-        'https://production.sw.fourdesire.com/api/v2/comments',
+        api_url('/comments'),
         session,
         auth_token,
-        {
-            'commentable_id': 68334,
-            'commentable_type': 'lab',
-            'limit': 3000,
-            'queried_at': 2147483647,
-            'since_id': 0,
+        _comments_params(since_id, limit),
+    )
+    if STRICT_DECODING:
+        comments = CommentsAnswerSchema().loads(result)['comments']
+        decode = _lab_request_from_schema
+    else:
+        comments = json.loads(result)['comments']
+        decode = _decode_lab_request
 
-        }
+    return LabCommentsPage(
+        requests=[decode(c) for c in comments if c['comment']['type'] == 'donation'],
+        comments_count=len(comments),
+        max_comment_id=max((c['id'] for c in comments), default=0),
     )
-    result = CommentsAnswerSchema().loads(result)
-
-    lab_requests = [c for c in result['comments'] if c['comment']['type'] == 'donation']
-    ret = []
-    for req in lab_requests:
-        ret.append(LabRequestWrapper(
-            created_at=req['created_at'],
-            user_id=req['user']['id'],
-            user_name=req['user']['name'],
-            planet_name=req['comment']['identifier'],
-            requirements=req['comment']['requirements'],
-            total_donation=req['comment']['total_donation'],
-            current_donation=req['comment']['current_donation'],
-            last_requested_at=req['comment']['last_requested_at'],
-            donated_counter=req['comment']['donated_counter'],
-        ))
-    return ret
+
+
+async def get_lab_planets(auth_token: str, session: aiohttp.ClientSession) -> list[LabRequestWrapper]:
+    if STREAM_COMMENTS and not STRICT_DECODING:
+        return [request async for request in iter_lab_requests(auth_token, session)]
+    page = await get_lab_comments(auth_token, session)
+    return page.requests
 
 
 class LabSchema(Schema):
@@ -456,12 +580,14 @@ class LabAnswerSchema(Schema):
 async def get_user_request(auth_token: str, session: aiohttp.ClientSession) -> LabRequestWrapper:
     result = await make_async_request(
         'get',
-        'https://production.sw.fourdesire.com/api/v2/labs/current',
+        api_url('/labs/current'),
         session,
         auth_token
     )
-    result = LabAnswerSchema().loads(result)
+    if not STRICT_DECODING:
+        return _decode_user_request(json.loads(result))
 
+    result = LabAnswerSchema().loads(result)
     return LabRequestWrapper(
         created_at=None,
         user_id=None,
@@ -478,8 +604,23 @@ async def get_user_request(auth_token: str, session: aiohttp.ClientSession) -> L
 async def make_lab_request(auth_token: str, session: aiohttp.ClientSession) -> None:
     await make_async_request(
         'post',
-        'https://production.sw.fourdesire.com/api/v2/labs/68334/request',
+        api_url(f'/labs/{LAB_ID}/request'),
+        session,
+        auth_token,
+        additional_headers={'Content-Type': 'application/json'}
+    )
+
+
+async def extend_token(auth_token: str, session: aiohttp.ClientSession) -> dict:
+    """продлевает токен; возвращает authorization из ответа (player_id, name, token_expired_at)"""
+    result = await make_async_request(
+        'post',
+        api_url('/players/extend_token'),
         session,
         auth_token,
         additional_headers={'Content-Type': 'application/json'}
     )
+    result = json.loads(result)
+    if not result['success']:
+        raise ValueError('api answer doesnt have success:true')
+    return result['authorization']
@@ -0,0 +1,316 @@
+"""
+Бенчмарки горячих мест: разбор ответов api, раскладка запросов лабы по бд, рендер сообщений.
+
+    python bench.py --output before.json
+    python bench.py --output after.json --compare before.json
+
+Результат - json с медианой/минимумом/p95 времени одного вызова по каждому бенчмарку.
+--compare печатает сравнение с прошлым прогоном и выходит с кодом 1, если что-то стало медленнее --threshold
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Optional
+
+import sqlalchemy
+
+import api
+import bot
+import fake_server
+import logic
+import orm
+
+# сколько комментариев приходит при полной синхронизации лабы (api.get_lab_comments)
+REALISTIC_COMMENTS = 3000
+# во сколько раз больше реального гоняем "тяжёлый" вариант
+HEAVY_FACTOR = 10
+# один замер длится не меньше этого, быстрые функции вызываются в нём много раз
+MIN_SAMPLE_TIME = 0.05
+DEFAULT_REPEAT = 7
+DEFAULT_THRESHOLD = 1.2
+
+# история лабы в синтетической бд: игроки * планеты * запросы * записи прогресса
+HISTORY_USERS = 200
+HISTORY_PLANETS_PER_USER = 3
+HISTORY_REQUESTS_PER_PLANET = 20
+HISTORY_PROGRESSES_PER_REQUEST = 10
+# сколько запросов из api раскладываем за один вызов, как одна полная синхронизация
+PROGRESS_BATCH = 100
+
+
+@dataclass
+class BenchResult:
+    name: str
+    params: dict
+    # сколько раз функция вызывалась в одном замере
+    number: int
+    # время одного вызова по каждому замеру, секунды
+    samples: list[float] = field(repr=False)
+    median: float = 0.0
+    min: float = 0.0
+    mean: float = 0.0
+    p95: float = 0.0
+
+    def __post_init__(self):
+        ordered = sorted(self.samples)
+        self.median = statistics.median(ordered)
+        self.min = ordered[0]
+        self.mean = statistics.fmean(ordered)
+        self.p95 = ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))]
+
+
+def measure(name: str, fn: Callable[[], object], repeat: int, **params) -> BenchResult:
+    fn()  # прогрев: ленивые импорты, компиляция схем, кэш страниц sqlite
+
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_SAMPLE_TIME:
+            break
+        number *= 2
+
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return BenchResult(name=name, params=params, number=number, samples=samples)
+
+
+def _heavy_fleet() -> dict:
+    """флот с HEAVY_FACTOR-кратным числом участников и событий"""
+    data = fake_server.synthetic_fleet()
+    data['members'] = [
+        {**member, 'id': member['id'] + i * 100} for i in range(HEAVY_FACTOR) for member in data['members']
+    ]
+    data['fleet_histories'] = data['fleet_histories'] * HEAVY_FACTOR
+    return data
+
+
+def _comments_answer(count: int) -> str:
+    return json.dumps({'success': True, 'comments': fake_server.synthetic_comments(count), 'now': int(time.time())})
+
+
+def bench_decoding(repeat: int) -> list[BenchResult]:
+    results = []
+    for size, fleet in (('realistic', fake_server.synthetic_fleet()), ('heavy', _heavy_fleet())):
+        payload = json.dumps(fleet)
+        results.append(measure(
+            'fleets_schema_loads', lambda: api.FleetsApiAnswerSchema().loads(payload), repeat,
+            size=size, bytes=len(payload),
+        ))
+        results.append(measure(
+            'fleets_fast_decode', lambda: api.FleetWrapper.from_api_answer(json.loads(payload)), repeat,
+            size=size, bytes=len(payload),
+        ))
+
+    for size, count in (('realistic', REALISTIC_COMMENTS), ('heavy', REALISTIC_COMMENTS * HEAVY_FACTOR)):
+        payload = _comments_answer(count)
+        results.append(measure(
+            'comments_schema_loads', lambda: api.CommentsAnswerSchema().loads(payload), repeat,
+            size=size, comments=count, bytes=len(payload),
+        ))
+        results.append(measure(
+            'comments_fast_decode',
+            lambda: [api._decode_lab_request(c) for c in json.loads(payload)['comments']
+                     if c['comment']['type'] == 'donation'],
+            repeat, size=size, comments=count, bytes=len(payload),
+        ))
+    return results
+
+
+def populate_history(engine: sqlalchemy.Engine) -> None:
+    orm.Base.metadata.create_all(engine)
+    now = datetime.datetime(2024, 1, 1)
+    users, planets, requests, progresses = [], [], [], []
+    for user_id in range(1, HISTORY_USERS + 1):
+        users.append({'id': user_id, 'name': f'Player {user_id}', 'create_dt': now})
+        for planet in range(HISTORY_PLANETS_PER_USER):
+            planet_id = len(planets) + 1
+            planets.append({'id': planet_id, 'user_id': user_id, 'planet_name': f'planet-{planet}',
+                            'planet_requirements': 30000, 'create_dt': now})
+            for request in range(HISTORY_REQUESTS_PER_PLANET):
+                request_id = len(requests) + 1
+                requested_dt = now + datetime.timedelta(hours=6 * request, minutes=planet)
+                requests.append({'id': request_id, 'lab_planet_id': planet_id, 'requested_dt': requested_dt,
+                                 'create_dt': requested_dt})
+                for progress in range(HISTORY_PROGRESSES_PER_REQUEST):
+                    progresses.append({
+                        'lab_request_id': request_id,
+                        'create_dt': requested_dt + datetime.timedelta(minutes=progress),
+                        'total_donation': 500 * progress, 'current_donation': 500 * progress,
+                        'donated_counter': f'{user_id + 1}|' + '+'.join(['500'] * progress),
+                    })
+
+    with orm.Session(engine) as session:
+        for model, rows in ((orm.User, users), (orm.LabPlanet, planets), (orm.LabRequest, requests),
+                            (orm.LabRequestProgress, progresses)):
+            session.execute(sqlalchemy.insert(model), rows)
+        session.commit()
+    orm.migrate(engine)
+
+
+def _latest_api_requests(engine: sqlalchemy.Engine) -> list[api.LabRequestWrapper]:
+    """последние запросы из бд с новым прогрессом - как будто пришли из api при очередной синхронизации"""
+    with orm.Session(engine) as session:
+        latest = (
+            orm.select(orm.LabRequest.lab_planet_id, orm.func.max(orm.LabRequest.requested_dt).label('requested_dt'))
+            .group_by(orm.LabRequest.lab_planet_id)
+            .limit(PROGRESS_BATCH)
+            .subquery()
+        )
+        rows = session.execute(
+            orm.select(orm.User, orm.LabPlanet, latest.c.requested_dt)
+            .join(orm.LabPlanet, orm.LabPlanet.user_id == orm.User.id)
+            .join(latest, latest.c.lab_planet_id == orm.LabPlanet.id)
+        ).all()
+
+    return [
+        api.LabRequestWrapper(
+            created_at=requested_dt, user_id=user.id, user_name=user.name, planet_name=planet.planet_name,
+            requirements=planet.planet_requirements, total_donation=planet.planet_requirements - 500,
+            current_donation=2500, last_requested_at=requested_dt, donated_counter='1|500+500+500+500+500',
+        )
+        for user, planet, requested_dt in rows
+    ]
+
+
+def bench_persist(repeat: int, db_path: Optional[str]) -> list[BenchResult]:
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_db_path = os.path.join(tmp, 'bench.db')
+        engine = sqlalchemy.create_engine(f'sqlite+pysqlite:///{bench_db_path}')
+        if db_path is None:
+            populate_history(engine)
+        else:
+            # гоняем на копии, чтобы migrate и ANALYZE не трогали рабочую бд
+            shutil.copyfile(db_path, bench_db_path)
+            orm.migrate(engine)
+        api_requests = _latest_api_requests(engine)
+
+        with orm.Session(engine) as session:
+            history = session.scalar(orm.select(orm.func.count()).select_from(orm.LabRequestProgress))
+
+        def run():
+            # откатываем, чтобы каждый замер видел одну и ту же бд
+            with orm.Session(engine) as session_:
+                logic._get_orm_request_progresses(session_, api_requests)
+                session_.flush()
+                session_.rollback()
+
+        result = measure('get_orm_request_progresses', run, repeat,
+                         db=os.path.basename(db_path) if db_path else 'synthetic', batch=len(api_requests),
+                         history=history)
+        engine.dispose()
+    return [result]
+
+
+def bench_render(repeat: int) -> list[BenchResult]:
+    results = []
+    for size, fleets_count in (('realistic', 3), ('heavy', 3 * HEAVY_FACTOR)):
+        fleets = {}
+        for fleet_id in range(fleets_count):
+            data = fake_server.synthetic_fleet()
+            data['fleet']['id'] = fleet_id
+            data['fleet']['name'] = f'Fleet {fleet_id}'
+            fleets[fleet_id] = (api.FleetWrapper.from_api_answer(data), api.EventWrapper.from_api_answer(data))
+        results.append(measure('render_epic_infos', lambda: logic.render_epic_infos(fleets), repeat,
+                               size=size, fleets=fleets_count))
+
+    # сообщение про лабу: по строке на игрока, близко к лимиту телеграма в 4096 символов
+    line = 'Player_1000 (aurora-1.2) [30000] осталось 5h12m! '
+    for size, lines in (('realistic', 80), ('heavy', 80 * HEAVY_FACTOR)):
+        text = line * lines
+        results.append(measure('md_esc', lambda: bot.md_esc(text), repeat, size=size, chars=len(text)))
+    numbers = list(range(0, 1_000_000, 997))
+    results.append(measure('num_to_k', lambda: [bot.num_to_k(n) for n in numbers], repeat, calls=len(numbers)))
+    return results
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(result: dict) -> str:
+    params = ','.join(f'{k}={v}' for k, v in sorted(result['params'].items()) if k in ('size', 'db'))
+    return f'{result["name"]}[{params}]' if params else result['name']
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> bool:
+    """печатает сравнение медиан; False, если есть регрессия"""
+    baseline_results = {_key(r): r for r in baseline['results']}
+    ok = True
+    print(f'{"benchmark":<50} {"baseline":>12} {"current":>12} {"ratio":>7}')
+    for result in current['results']:
+        key = _key(result)
+        old = baseline_results.get(key)
+        if old is None:
+            print(f'{key:<50} {"-":>12} {result["median"] * 1000:>10.3f}ms {"new":>7}')
+            continue
+        ratio = result['median'] / old['median']
+        mark = ''
+        if ratio > threshold:
+            mark = '  REGRESSION'
+            ok = False
+        print(f'{key:<50} {old["median"] * 1000:>10.3f}ms {result["median"] * 1000:>10.3f}ms {ratio:>6.2f}x{mark}')
+    return ok
+
+
+BENCHMARKS = {
+    'decoding': lambda args: bench_decoding(args.repeat),
+    'persist': lambda args: bench_persist(args.repeat, args.db),
+    'render': lambda args: bench_render(args.repeat),
+}
+
+parser = argparse.ArgumentParser(prog='Walkr bench', description='Бенчмарки горячих мест бота')
+parser.add_argument('--only', nargs='*', choices=list(BENCHMARKS), help='Какие группы бенчмарков гонять')
+parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Сколько замеров на бенчмарк')
+parser.add_argument('--db', help='Раскладывать по копии этой бд (например, walkr.db) вместо синтетической')
+parser.add_argument('--output', help='Куда сохранить результат в json (по умолчанию stdout)')
+parser.add_argument('--compare', help='json прошлого прогона для сравнения')
+parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                    help='Во сколько раз медиана может вырасти, прежде чем это регрессия')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    results = []
+    for group in args.only or BENCHMARKS:
+        results.extend(BENCHMARKS[group](args))
+
+    report = {
+        'created_at': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': [asdict(r) for r in results],
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.threshold):
+            sys.exit(1)
@@ -1,38 +1,167 @@
+import asyncio
 import datetime
+import functools
+import hashlib
 import html
 import json
 import logging
+import os
+import re
+import time
 import traceback
 from decimal import Decimal
 from zoneinfo import ZoneInfo
 
-import aiohttp
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, Application, CallbackQueryHandler
 
 # todo: перенести секреты в venv (вычищать в момент инициализации)
+import charts
+import chat_updates
 import config
 import logic
+import logs
+import metrics
 import orm
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("debug.log"),
-        logging.StreamHandler()
-    ]
-)
+import poller
+import retention
+import token_pool
+import transport
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 DEVELOPER_CHAT_ID = 163127202
 
+EPIC_INFO_KIND = 'epic_info'
+LAB_REQUESTS_KIND = 'lab_requests'
+AUTOUPDATE_INTERVAL = poller.POLL_INTERVAL
+# сколько апдейтов обрабатываем одновременно; в одном чате они всё равно идут по очереди
+CONCURRENT_UPDATES = int(os.environ.get('WALKR_CONCURRENT_UPDATES', 8))
+# подвал с временем обновления и обратный отсчёт запросов меняются сами по себе, состоянием это не считаем
+_AUTOUPDATE_IGNORED_RE = re.compile(r'\n[^\n]*(Обновлено|Актуально на) [^\n]* MSK\s*$|осталось \d+h\d+m')
 
-# todo: metrics of answer timings. may be make grafana/kibana? what about zabbix?
-# todo: прикапывать цифры из инфы о лабе, рисовать графики в динамике
+HANDLER_LATENCY = metrics.histogram(
+    'telegram_handler_duration_seconds', 'Duration of telegram update handlers', ('handler', 'data', 'status')
+)
+# остальные значения callback_data пишем как unknown, чтобы не плодить ряды
+_KNOWN_CALLBACK_DATA = {'update_epic_info', 'update_lab_requests', 'make_requests'}
+# столько секунд после обработки нажатия повторные нажатия той же кнопки того же сообщения ничего не делают
+CALLBACK_COOLDOWN = 3
+
+# (chat_id, message_id, data) -> событие конца обработки нажатия, которое сейчас выполняется
+_callbacks_in_flight: dict[tuple, asyncio.Event] = {}
+# (chat_id, message_id, data) -> когда успешно обработали последнее нажатие
+_callbacks_done_at: dict[tuple, float] = {}
+
+
+# метрики времени ответа отдаются на metrics.METRICS_PORT в формате prometheus, графики - хоть в grafana
+
+
+def _now_msk(dt: datetime.datetime | None = None) -> str:
+    dt = dt or datetime.datetime.now(tz=ZoneInfo("Europe/Moscow"))
+    return dt.astimezone(ZoneInfo("Europe/Moscow")).strftime('%d.%m.%Y %H:%M:%S')
+
+
+def _autoupdate_hash(text: str) -> str:
+    return hashlib.sha1(_AUTOUPDATE_IGNORED_RE.sub('', text).rstrip().encode()).hexdigest()
+
+
+async def _track_message(chat_id: int, message_id: int, kind: str, text: str) -> None:
+    """запоминает последнее сообщение каждого вида в чате, чтобы потом обновлять его автоматически"""
+    async with orm.make_async_session() as session:
+        tracked = await orm.get_or_create(
+            session, orm.TrackedMessage, {orm.TrackedMessage.chat_id: chat_id, orm.TrackedMessage.kind: kind}
+        )
+        tracked.message_id = message_id
+        tracked.text_hash = _autoupdate_hash(text)
+        tracked.update_dt = datetime.datetime.now(tz=ZoneInfo('UTC'))
+        await session.commit()
+
+
+UPSTREAM_UNAVAILABLE_TEXT = 'Walkr сейчас не отвечает, попробуйте через минуту'
+
+
+def _stale_note(snapshot: poller.Snapshot) -> str | None:
+    if not snapshot.stale:
+        return None
+    return f'Walkr сейчас не отвечает, показываю данные на {_now_msk(snapshot.updated_dt)} MSK'
+
+
+def _friendly_upstream_errors(handler):
+    """если walkr лежит, а показать нечего - говорим об этом пользователю, а не молчим"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            return await handler(update, context)
+        except Exception as e:
+            if not transport.is_upstream_error(e):
+                raise
+            logger.warning('%s: walkr is unavailable: %r', handler.__name__, e)
+            if update.callback_query:
+                await update.callback_query.answer(UPSTREAM_UNAVAILABLE_TEXT, show_alert=True)
+            else:
+                await context.bot.send_message(chat_id=update.effective_chat.id, text=UPSTREAM_UNAVAILABLE_TEXT,
+                                               disable_notification=True)
+
+    return wrapper
+
+
+def _debounce_callback_presses(handler):
+    """
+    Пять нажатий "Обновить" подряд - одно обновление: пока первое обрабатывается, остальные ждут его,
+    а в течение CALLBACK_COOLDOWN после успешного сразу получают answer() без пересчёта и edit_message_text.
+    Обычные чаты chat_updates и так обрабатывает по очереди, а кнопки под inline-сообщениями без чата
+    приходят одновременно - их и сводит ожидание. Если обработка упала, следующее нажатие считает заново
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        if query.message is not None:
+            key = (query.message.chat_id, query.message.message_id, query.data)
+        else:
+            # кнопка под inline-сообщением: чата у апдейта нет
+            key = (query.inline_message_id, query.data)
+        while (in_flight := _callbacks_in_flight.get(key)) is not None:
+            await in_flight.wait()
+        done_at = _callbacks_done_at.get(key)
+        if done_at is not None and time.monotonic() - done_at < CALLBACK_COOLDOWN:
+            await query.answer()
+            return
+
+        in_flight = _callbacks_in_flight[key] = asyncio.Event()
+        try:
+            result = await handler(update, context)
+            now = time.monotonic()
+            for old_key in [k for k, t in _callbacks_done_at.items() if now - t >= CALLBACK_COOLDOWN]:
+                del _callbacks_done_at[old_key]
+            _callbacks_done_at[key] = now
+            return result
+        finally:
+            del _callbacks_in_flight[key]
+            in_flight.set()
+
+    return wrapper
+
+
+def _timed_handler(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        data = ''
+        if update.callback_query:
+            data = update.callback_query.data if update.callback_query.data in _KNOWN_CALLBACK_DATA else 'unknown'
+        status = 'error'
+        start_ = time.perf_counter()
+        try:
+            result = await handler(update, context)
+            status = 'ok'
+            return result
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start_, handler=handler.__name__, data=data, status=status)
+
+    return wrapper
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -42,72 +171,87 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def _get_epic_info(
         update: Update, context: ContextTypes.DEFAULT_TYPE, callback=False
 ) -> tuple[str, InlineKeyboardMarkup]:
-    # todo: cron job to autoupdate info in last message of each chat
     # todo: send in markdown
     # todo? на сервере генерить изображение с таблицей со всей информацией
-    # мысли о мультитокенности: отдельное меню кнопкой "настройки", там:
-    # - юзер:
-    #   - все доступные (для группы). В процессе работы отправит запрос полностью от всех, исключит дубликаты и
-    #     отправляет одним сообщением конкатенацию ответов
-    #   - (отдельно имя каждого игрока, для кого есть токен) (для лички)
+    # сейчас показываем все флоты, где есть игроки с токенами. Мысли: отдельное меню кнопкой "настройки", там:
+    # - юзер: отдельно имя каждого игрока, для кого есть токен (для лички)
     # - автообновление (в названии кнопки галка или крестик как текущий стейт)
-    # Для обоих вариантов явно надо хранить инфу в sql в разрезе (чат, сообщение)
+    # у нажатия кнопки под inline-сообщением чата нет
     logger.info('processing get_epic_info from %s (id=%s) in chat id=%s',
-                update.effective_user.name, update.effective_user.id, update.effective_chat.id)
+                update.effective_user.name, update.effective_user.id,
+                update.effective_chat.id if update.effective_chat else None)
     if not callback:
         await update.effective_chat.send_chat_action('typing')
 
-    http_session = context.bot_data['aiohttp_session']
-    with orm.make_session() as session:
-        walkr_token = session.query(orm.Token).filter(orm.Token.user_id == 271306).one().value
+    max_age = poller.FORCE_REFRESH_MIN_AGE if callback else poller.SNAPSHOT_MAX_AGE
+    snapshot = await poller.get_fleet_snapshot(context.bot_data, max_age=max_age)
+    return _render_epic_info(snapshot)
 
-    result = await logic.get_epic_info(walkr_token, http_session)
-    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Обновить", callback_data="update_epic_info")]])
 
+def _render_epic_info(snapshot: poller.Snapshot) -> tuple[str, InlineKeyboardMarkup]:
+    result = logic.render_epic_infos(snapshot.value)
+    if stale_note := _stale_note(snapshot):
+        result = f'{result}\n\n{stale_note}'
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Обновить", callback_data="update_epic_info")]])
     return result, reply_markup
 
 
+@_timed_handler
+@_friendly_upstream_errors
 async def get_epic_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     result, reply_markup = await _get_epic_info(update, context, callback=False)
-    await context.bot.send_message(chat_id=update.effective_chat.id,
-                                   text=result,
-                                   disable_notification=True,
-                                   reply_markup=reply_markup)
+    message = await context.bot.send_message(chat_id=update.effective_chat.id,
+                                             text=result,
+                                             disable_notification=True,
+                                             reply_markup=reply_markup)
+    await _track_message(message.chat_id, message.message_id, EPIC_INFO_KIND, result)
 
 
+@_timed_handler
+@_friendly_upstream_errors
+@_debounce_callback_presses
 async def callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info('processing callback_query id=%s from %s (id=%s) in chat id=%s (message id=%s, data=%s)',
-                update.callback_query.id,
-                update.effective_user.name, update.effective_user.id, update.effective_chat.id,
-                update.callback_query.message.id, update.callback_query.data)
-
     query = update.callback_query
+    if query.message is not None:
+        logger.info('processing callback_query id=%s from %s (id=%s) in chat id=%s (message id=%s, data=%s)',
+                    query.id, update.effective_user.name, update.effective_user.id, query.message.chat_id,
+                    query.message.message_id, query.data)
+    else:
+        logger.info('processing callback_query id=%s from %s (id=%s) under inline message id=%s (data=%s)',
+                    query.id, update.effective_user.name, update.effective_user.id, query.inline_message_id,
+                    query.data)
 
     if query.data == 'update_epic_info':
         text, reply_markup = await _get_epic_info(update, context, callback=True)
 
         # todo: вынести в единое место после перехода всего в маркдаун
-        now = datetime.datetime.now(tz=ZoneInfo("Europe/Moscow")).strftime('%d.%m.%Y %H:%M:%S')
-        updated_text = f'Обновлено пользователем {update.effective_user.name} в {now} MSK'
+        updated_text = f'Обновлено пользователем {update.effective_user.name} в {_now_msk()} MSK'
 
         edit_message_text_kwargs = {'text': f'{text}\n\n{updated_text}', 'reply_markup': reply_markup}
+        tracked_kind = EPIC_INFO_KIND
     elif query.data == 'update_lab_requests':
         text, reply_markup = await _get_lab_requests(update, context, callback=True)
         edit_message_text_kwargs = {'text': text, 'reply_markup': reply_markup, 'parse_mode': ParseMode.MARKDOWN_V2}
+        tracked_kind = LAB_REQUESTS_KIND
     elif query.data == 'make_requests':
         http_session = context.bot_data['aiohttp_session']
-        with orm.make_session() as db_session:
-            await logic.make_lab_requests(http_session, db_session)
+        attempts = await logic.make_lab_requests(http_session, context.bot_data['token_pool'])
 
-        text, reply_markup = await _get_lab_requests(update, context, callback=True)
+        text, reply_markup = await _get_lab_requests(update, context, callback=True, attempts=attempts, max_age=0)
         edit_message_text_kwargs = {'text': text, 'reply_markup': reply_markup, 'parse_mode': ParseMode.MARKDOWN_V2}
+        tracked_kind = LAB_REQUESTS_KIND
     else:
         text = ('Обработка кнопок под этим сообщением поломалась, запросите новое сообщение и пользуйтесь кнопками '
                 'под ним')
         edit_message_text_kwargs = {'text': text, 'parse_mode': ParseMode.MARKDOWN_V2}
+        tracked_kind = None
 
     await query.answer()
     await query.edit_message_text(**edit_message_text_kwargs)
+    # автообновление умеет только сообщения в чатах
+    if tracked_kind and query.message is not None:
+        await _track_message(query.message.chat_id, query.message.message_id, tracked_kind,
+                             edit_message_text_kwargs['text'])
 
 
 def md_esc(text: str) -> str:
@@ -123,19 +267,31 @@ def num_to_k(num: int) -> str:
     return f'{num / 1000}K'
 
 
-async def _get_lab_requests(
-        update: Update, context: ContextTypes.DEFAULT_TYPE, callback=False
-) -> tuple[str, InlineKeyboardMarkup]:
-    logger.info('start get_lab_requests')
-    http_session = context.bot_data['aiohttp_session']
-
+def _get_lab_request_attempts_rows(attempts: list[logic.LabRequestAttempt]) -> list[str]:
+    statuses = {
+        'requested': 'запрос сделан',
+        'skipped': 'запрос пока не нужен',
+        'error': 'ошибка',
+    }
+    rows = [md_esc('\nРезультаты запросов ботом:\n')]
+    for attempt in attempts:
+        status = statuses.get(attempt.status, attempt.status)
+        if attempt.error:
+            status = f'{status}: {attempt.error[:100]}'
+        rows.append(f' \\- *{md_esc(attempt.user_name)}* {md_esc(status)}')
+    return rows
+
+
+async def _render_lab_requests(
+        snapshot: poller.Snapshot, attempts: list[logic.LabRequestAttempt] | None = None
+) -> tuple[list[str], InlineKeyboardMarkup]:
     def get_progress_line(progress_: orm.LabRequestProgress) -> str:
         name = md_esc(progress_.request.lab_planet.user.name)
         now_energy = md_esc(num_to_k(progress_.total_donation))
         max_energy = md_esc(num_to_k(progress_.request.lab_planet.planet_requirements))
 
         seconds_left = (
-                progress.request.requested_dt.replace(tzinfo=ZoneInfo('UTC'))
+                progress_.request.requested_dt.replace(tzinfo=ZoneInfo('UTC'))
                 + datetime.timedelta(hours=6)
                 - datetime.datetime.now(tz=ZoneInfo('UTC'))
         ).seconds
@@ -144,54 +300,186 @@ async def _get_lab_requests(
         return f' \\- *{name}* {now_energy}/{max_energy} осталось {time_left}'
 
     message_rows = ['Вижу такие запросы в лаборатории:\n']
-    with orm.make_session() as session:
-        progresses, has_token_no_request_query = await logic.get_current_lab_planets(http_session, session)
+    async with logic.lab_progress_lock, orm.make_async_session() as session:
+        progresses, has_token_no_request = await logic.get_lab_request_progresses(session, snapshot.value)
         progresses.sort(key=lambda p: p.request.requested_dt, reverse=True)
 
         for progress in progresses:
             message_rows.append(get_progress_line(progress))
 
-        has_token_no_request_count = has_token_no_request_query.count()
-        if has_token_no_request_count:
+        if has_token_no_request:
             message_rows.append(md_esc('\nСледующим игрокам можно попробовать сделать запрос ботом:\n'))
-            for user in has_token_no_request_query:
+            for user in has_token_no_request:
                 message_rows.append(f' \\- *{md_esc(user.name)}*')
 
             message_rows.append(f'_{md_esc("(правда, я бессилен, если планета докачана уже до конца)")}_')
 
-        session.commit()
+        await session.commit()
 
-    now = datetime.datetime.now(tz=ZoneInfo("Europe/Moscow")).strftime('%d.%m.%Y %H:%M:%S')
-    if callback:
-        message_rows.append(md_esc(f'\nОбновлено пользователем {update.effective_user.name} в {now} MSK'))
-    else:
-        message_rows.append(md_esc(f'\nАктуально на {now} MSK'))
+    if attempts:
+        message_rows.extend(_get_lab_request_attempts_rows(attempts))
+    if stale_note := _stale_note(snapshot):
+        message_rows.append(f'\n_{md_esc(stale_note)}_')
 
     buttons = [InlineKeyboardButton("Обновить", callback_data="update_lab_requests")]
-    if has_token_no_request_count:
+    if has_token_no_request:
         buttons.append(InlineKeyboardButton("Делаем запросы", callback_data="make_requests"))
 
-    reply_markup = InlineKeyboardMarkup([buttons])
+    return message_rows, InlineKeyboardMarkup([buttons])
+
+
+async def _get_lab_requests(
+        update: Update, context: ContextTypes.DEFAULT_TYPE, callback=False,
+        attempts: list[logic.LabRequestAttempt] | None = None, full_sync=False, max_age: float | None = None
+) -> tuple[str, InlineKeyboardMarkup]:
+    logger.info('start get_lab_requests')
+    if max_age is None:
+        max_age = poller.FORCE_REFRESH_MIN_AGE if callback else poller.SNAPSHOT_MAX_AGE
+    snapshot = await poller.get_lab_snapshot(context.bot_data, max_age=max_age, full_sync=full_sync)
+
+    message_rows, reply_markup = await _render_lab_requests(snapshot, attempts)
+
+    if callback:
+        message_rows.append(md_esc(f'\nОбновлено пользователем {update.effective_user.name} в {_now_msk()} MSK'))
+    else:
+        message_rows.append(md_esc(f'\nАктуально на {_now_msk(snapshot.updated_dt)} MSK'))
+
     return '\n'.join(message_rows), reply_markup
 
 
+@_timed_handler
+@_friendly_upstream_errors
 async def get_lab_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text, reply_markup = await _get_lab_requests(update, context)
-    await context.bot.send_message(chat_id=update.effective_chat.id,
-                                   text=text,
-                                   disable_notification=True,
-                                   reply_markup=reply_markup,
-                                   parse_mode=ParseMode.MARKDOWN_V2)
+    # /get_lab_requests full - перечитать все комментарии лабы, а не только новые
+    full_sync = bool(context.args) and context.args[0] == 'full'
+    text, reply_markup = await _get_lab_requests(update, context, full_sync=full_sync)
+    message = await context.bot.send_message(chat_id=update.effective_chat.id,
+                                             text=text,
+                                             disable_notification=True,
+                                             reply_markup=reply_markup,
+                                             parse_mode=ParseMode.MARKDOWN_V2)
+    await _track_message(message.chat_id, message.message_id, LAB_REQUESTS_KIND, text)
+
+
+@_timed_handler
+async def lab_chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info('processing lab_chart from %s (id=%s) in chat id=%s',
+                update.effective_user.name, update.effective_user.id, update.effective_chat.id)
+    async with orm.make_async_session() as session:
+        series = await charts.load_series(session)
+        if not series:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id, disable_notification=True,
+                text=f'Нет истории запросов в лаборатории за {charts.CHART_PERIOD.days} дн.',
+            )
+            return
+
+        caption = f'Прогресс запросов в лаборатории на {_now_msk()} MSK'
+        data_hash = charts.data_hash(series)
+        file_id = await charts.get_cached_file_id(session, data_hash)
+        if file_id:
+            try:
+                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=file_id, caption=caption,
+                                             disable_notification=True)
+                return
+            except BadRequest as e:
+                # файл в телеграме мог пропасть - рисуем заново
+                logger.warning('cant reuse chart file_id %s: %s', file_id, e)
+                await charts.forget_file_id(session, data_hash)
+
+        await update.effective_chat.send_chat_action('upload_photo')
+        png = await asyncio.to_thread(charts.render, series)
+        message = await context.bot.send_photo(chat_id=update.effective_chat.id, photo=png, caption=caption,
+                                               disable_notification=True)
+        await charts.save_file_id(session, data_hash, message.photo[-1].file_id)
+
+
+async def _render_for_autoupdate(kind: str, bot_data: dict) -> dict | None:
+    """kwargs для edit_message_text, одинаковые для всех чатов"""
+    if kind == EPIC_INFO_KIND:
+        text, reply_markup = _render_epic_info(await poller.get_fleet_snapshot(bot_data))
+        return {
+            'text': f'{text}\n\nОбновлено автоматически в {_now_msk()} MSK',
+            'reply_markup': reply_markup,
+        }
+    elif kind == LAB_REQUESTS_KIND:
+        message_rows, reply_markup = await _render_lab_requests(await poller.get_lab_snapshot(bot_data))
+        message_rows.append(md_esc(f'\nОбновлено автоматически в {_now_msk()} MSK'))
+        return {
+            'text': '\n'.join(message_rows),
+            'reply_markup': reply_markup,
+            'parse_mode': ParseMode.MARKDOWN_V2,
+        }
+    logger.error('unknown tracked message kind %s', kind)
+    return None
+
+
+async def autoupdate_messages(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """перерисовывает отслеживаемые сообщения, но редактирует только те, где что-то поменялось"""
+    async with orm.make_async_session() as session:
+        tracked_messages = (await session.scalars(orm.select(orm.TrackedMessage))).all()
+
+        rendered = {}
+        for kind in {tracked.kind for tracked in tracked_messages}:
+            try:
+                rendered[kind] = await _render_for_autoupdate(kind, context.bot_data)
+            except Exception:
+                logger.exception('cant render %s for autoupdate', kind)
+
+        edited = 0
+        for tracked in tracked_messages:
+            edit_message_text_kwargs = rendered.get(tracked.kind)
+            if not edit_message_text_kwargs:
+                continue
+            text_hash = _autoupdate_hash(edit_message_text_kwargs['text'])
+            if tracked.text_hash == text_hash:
+                continue
+
+            try:
+                await context.bot.edit_message_text(
+                    chat_id=tracked.chat_id, message_id=tracked.message_id, **edit_message_text_kwargs
+                )
+            except BadRequest as e:
+                if 'not modified' not in e.message.lower():
+                    # сообщение удалили или его больше нельзя редактировать - перестаём следить
+                    logger.info('stop tracking message %s in chat %s: %s', tracked.message_id, tracked.chat_id, e)
+                    await session.delete(tracked)
+                    continue
+            tracked.text_hash = text_hash
+            tracked.update_dt = datetime.datetime.now(tz=ZoneInfo('UTC'))
+            edited += 1
+
+        await session.commit()
+    logger.info('autoupdate: %s tracked messages, %s edited', len(tracked_messages), edited)
 
 
 async def post_init(application: Application):
-    session = aiohttp.ClientSession(trust_env=True)
+    session = transport.make_async_session()
     application.bot_data['aiohttp_session'] = session
+    tokens = application.bot_data['token_pool'] = token_pool.TokenPool()
+    await tokens.reload()
+    poller.schedule(application.job_queue)
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            autoupdate_messages, interval=AUTOUPDATE_INTERVAL, first=AUTOUPDATE_INTERVAL, name='autoupdate_messages'
+        )
+        application.job_queue.run_repeating(
+            token_pool.refresh_job, interval=token_pool.REFRESH_CHECK_INTERVAL, first=0, name='token_pool_refresh'
+        )
+        application.job_queue.run_repeating(
+            retention.retention_job, interval=retention.RETENTION_INTERVAL, first=retention.RETENTION_INTERVAL,
+            name='retention'
+        )
+    application.bot_data['metrics_runner'] = await metrics.start_server()
 
 
 async def post_shutdown(application: Application):
     session = application.bot_data['aiohttp_session']
     await session.close()
+    metrics_runner = application.bot_data.get('metrics_runner')
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await orm.async_engine.dispose()
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -225,13 +513,15 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 
 def main():
+    logs.setup()
     application = ApplicationBuilder().token(config.TELEGRAM_TOKEN).post_init(post_init).post_shutdown(
-        post_shutdown).build()
+        post_shutdown).concurrent_updates(chat_updates.PerChatUpdateProcessor(CONCURRENT_UPDATES)).build()
 
     application.add_handler(CommandHandler('start', start))
     # application.add_handler(CommandHandler('get_lab_info', get_lab_info))
     application.add_handler(CommandHandler('get_epic_info', get_epic_info))
     application.add_handler(CommandHandler('get_lab_requests', get_lab_requests))
+    application.add_handler(CommandHandler('lab_chart', lab_chart))
     application.add_handler(CallbackQueryHandler(callback_query))
 
     application.add_error_handler(error_handler)
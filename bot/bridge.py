@@ -0,0 +1,151 @@
+"""
+Мостик: кто с кем дружит в игре, чтобы у каждого было до MAX_PARTNERS партнёров и среди них были игроки
+с разной энергией. Раньше пары вели руками в mostik.ipynb, теперь их предлагает solve() по игрокам из бд
+(orm.PlayerEnergy заполняет бот из состава флотов).
+
+    python bridge.py                           # все, кого видели во флотах за MEMBER_MAX_AGE
+    python bridge.py --exclude 362 --graph     # без игрока 362, и ещё картинка bridge_graph.png
+"""
+import argparse
+import dataclasses
+import datetime
+import logging
+from typing import Iterable, Optional
+
+import graphviz
+
+import orm
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+MAX_PARTNERS = 4
+# игроков, которых столько не видели во флотах, в мостик не берём
+MEMBER_MAX_AGE = datetime.timedelta(days=30)
+# от меньшей энергии к большей
+TIERS = ('low', 'medium', 'high')
+# как в mostik.ipynb
+TIER_SIGNS = {'low': '', 'medium': '±', 'high': '+'}
+GRAPH_FILENAME = 'bridge_graph'
+
+
+@dataclasses.dataclass(frozen=True)
+class Member:
+    player_id: int
+    name: str
+    energy: int
+    tier: str = ''
+
+
+def assign_tiers(members: Iterable[Member]) -> list[Member]:
+    """уровни по третям списка, отсортированного по энергии: относительные, в каждом примерно треть игроков"""
+    ordered = sorted(members, key=lambda m: (m.energy, m.player_id))
+    return [dataclasses.replace(m, tier=TIERS[i * len(TIERS) // len(ordered)]) for i, m in enumerate(ordered)]
+
+
+def load_members(
+        session: orm.Session, now: Optional[datetime.datetime] = None, exclude: Iterable[int] = ()
+) -> list[Member]:
+    now = now or datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    rows = session.execute(
+        orm.select(orm.PlayerEnergy.player_id, orm.PlayerEnergy.name, orm.PlayerEnergy.energy_productivity)
+        .where(orm.PlayerEnergy.update_dt >= now - MEMBER_MAX_AGE, orm.PlayerEnergy.player_id.not_in(list(exclude)))
+    )
+    return assign_tiers(Member(player_id, name, energy) for player_id, name, energy in rows)
+
+
+def _interleave(members: list[Member]) -> list[Member]:
+    """
+    Порядок по кругу, где уровни перемешаны равномерно: i-й игрок уровня встаёт на долю (i + 0.5) / размер уровня.
+    При равных уровнях выходит low, medium, high, low, medium, high...
+    """
+    by_tier: dict[str, list[Member]] = {}
+    for member in sorted(members, key=lambda m: (-m.energy, m.player_id)):
+        by_tier.setdefault(member.tier, []).append(member)
+    positions = []
+    for tier_index, tier in enumerate(sorted(by_tier, key=lambda t: TIERS.index(t) if t in TIERS else len(TIERS))):
+        group = by_tier[tier]
+        for i, member in enumerate(group):
+            positions.append(((i + 0.5) / len(group), tier_index, member.player_id, member))
+    return [member for *_, member in sorted(positions)]
+
+
+def solve(members: list[Member], max_partners: int = MAX_PARTNERS) -> dict[int, set[int]]:
+    """
+    player_id -> player_id партнёров. Игроки стоят по кругу вперемешку по уровням, и каждый связан
+    с max_partners // 2 ближайшими соседями с каждой стороны, а при нечётном max_partners ещё и с противоположным.
+    Так у всех ровно max_partners партнёров (у одного на одного меньше, если и игроков, и партнёров нечётно -
+    иначе не бывает), а ближайшие соседи по кругу - из других уровней. Работает за O(n * max_partners)
+    """
+    ring = _interleave(members)
+    n = len(ring)
+    relations: dict[int, set[int]] = {member.player_id: set() for member in ring}
+
+    def link(a: Member, b: Member) -> None:
+        relations[a.player_id].add(b.player_id)
+        relations[b.player_id].add(a.player_id)
+
+    if n <= max_partners:
+        for i, a in enumerate(ring):
+            for b in ring[i + 1:]:
+                link(a, b)
+        return relations
+
+    for i, member in enumerate(ring):
+        for offset in range(1, max_partners // 2 + 1):
+            link(member, ring[(i + offset) % n])
+    if max_partners % 2:
+        for i in range(n // 2):
+            link(ring[i], ring[i + n // 2])
+    return relations
+
+
+def energy_mix(partner_ids: Iterable[int], members: dict[int, Member]) -> str:
+    """знаки уровней партнёров, как get_energy_of_members в mostik.ipynb"""
+    return ''.join(sorted(TIER_SIGNS.get(members[player_id].tier, '?') for player_id in partner_ids))
+
+
+def make_graph(
+        members: dict[int, Member], relations: dict[int, set[int]], max_partners: int = MAX_PARTNERS,
+        add_signs: bool = False,
+) -> graphviz.Graph:
+    """зелёные - ровно max_partners партнёров, красные - больше"""
+    g = graphviz.Graph('Walkr mostik', filename=GRAPH_FILENAME, format='png', engine='dot')
+    for player_id, partner_ids in relations.items():
+        name = members[player_id].name
+        caption = f'{name} {energy_mix(partner_ids, members)}' if add_signs else name
+        if len(partner_ids) == max_partners:
+            g.node(str(player_id), caption, style='filled', fillcolor='#bef574')
+        elif len(partner_ids) > max_partners:
+            g.node(str(player_id), caption, style='filled', fillcolor='#fd7c6e')
+        else:
+            g.node(str(player_id), caption)
+    for player_id, partner_ids in relations.items():
+        for partner_id in partner_ids:
+            if player_id < partner_id:
+                g.edge(str(player_id), str(partner_id))
+    return g
+
+
+parser = argparse.ArgumentParser(prog='Walkr bridge', description='Предложить пары мостика по игрокам из бд')
+parser.add_argument('--max_partners', type=int, default=MAX_PARTNERS)
+parser.add_argument('--exclude', type=int, action='append', default=[], help='Не брать игрока (id), можно несколько')
+parser.add_argument('--graph', action='store_true', help=f'Нарисовать {GRAPH_FILENAME}.png (нужен graphviz)')
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    with orm.make_session() as session:
+        loaded = load_members(session, exclude=args.exclude)
+    if not loaded:
+        raise SystemExit('no members in player_energy, let the bot see some fleets first')
+
+    by_id = {member.player_id: member for member in loaded}
+    bridge = solve(loaded, args.max_partners)
+    for member in sorted(loaded, key=lambda m: m.name.lower()):
+        partners = sorted(bridge[member.player_id], key=lambda player_id: by_id[player_id].name.lower())
+        print(f'{member.name} [{member.tier}, {member.energy}]: '
+              f'{", ".join(by_id[player_id].name for player_id in partners)} '
+              f'({energy_mix(partners, by_id) or "-"})')
+    if args.graph:
+        print(make_graph(by_id, bridge, args.max_partners, add_signs=True).render(cleanup=True))
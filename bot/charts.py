@@ -0,0 +1,107 @@
+"""
+Графики прогресса запросов лабы из LabRequestProgress. Картинка однозначно определяется данными,
+поэтому кэшируем её по хэшу данных: если ничего не поменялось, повторно отправляем file_id уже загруженной в телеграм
+"""
+import datetime
+import hashlib
+import io
+import json
+import logging
+from dataclasses import dataclass, field
+from zoneinfo import ZoneInfo
+
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+
+import orm
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# за сколько последних дней рисуем
+CHART_PERIOD = datetime.timedelta(days=3)
+# больше линий на одном графике уже не различить
+CHART_MAX_PLANETS = 12
+# поменяли отрисовку - меняем версию, чтобы старые file_id не подходили к новым картинкам
+CHART_VERSION = 1
+
+
+@dataclass
+class PlanetSeries:
+    lab_planet_id: int
+    title: str
+    requirements: int
+    # (момент в utc без таймзоны, сколько всего вкачано в планету)
+    points: list[tuple[datetime.datetime, int]] = field(default_factory=list)
+
+
+async def load_series(session: orm.AsyncSession, now: datetime.datetime | None = None) -> list[PlanetSeries]:
+    """история за CHART_PERIOD по планетам, сначала самые недавно обновлявшиеся"""
+    now = now or datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    rows = await session.execute(
+        orm.select(
+            orm.LabPlanet.id, orm.User.name, orm.LabPlanet.planet_name, orm.LabPlanet.planet_requirements,
+            orm.LabRequestProgress.create_dt, orm.LabRequestProgress.total_donation,
+        )
+        .join(orm.User, orm.User.id == orm.LabPlanet.user_id)
+        .join(orm.LabRequest, orm.LabRequest.lab_planet_id == orm.LabPlanet.id)
+        .join(orm.LabRequestProgress, orm.LabRequestProgress.lab_request_id == orm.LabRequest.id)
+        .where(orm.LabRequestProgress.create_dt >= now - CHART_PERIOD)
+        .order_by(orm.LabPlanet.id, orm.LabRequestProgress.create_dt, orm.LabRequestProgress.id)
+    )
+
+    series: dict[int, PlanetSeries] = {}
+    for lab_planet_id, user_name, planet_name, requirements, create_dt, total_donation in rows:
+        planet = series.get(lab_planet_id)
+        if planet is None:
+            planet = series[lab_planet_id] = PlanetSeries(lab_planet_id, f'{user_name}: {planet_name}', requirements)
+        planet.points.append((create_dt, total_donation))
+
+    latest_first = sorted(series.values(), key=lambda s: s.points[-1][0], reverse=True)
+    return latest_first[:CHART_MAX_PLANETS]
+
+
+def data_hash(series: list[PlanetSeries]) -> str:
+    data = [
+        (s.lab_planet_id, s.title, s.requirements, [(dt.isoformat(), value) for dt, value in s.points])
+        for s in series
+    ]
+    return hashlib.sha1(json.dumps([CHART_VERSION, data], ensure_ascii=False).encode()).hexdigest()
+
+
+def render(series: list[PlanetSeries]) -> bytes:
+    """png; Figure без pyplot не трогает глобальное состояние и gui-бэкенды, так что рисовать можно из потока"""
+    fig = Figure(figsize=(10, 6), dpi=100)
+    ax = fig.add_subplot()
+    for s in series:
+        dates = [dt.replace(tzinfo=datetime.timezone.utc) for dt, _ in s.points]
+        percents = [100 * value / s.requirements if s.requirements else 0 for _, value in s.points]
+        ax.step(dates, percents, where='post', label=s.title)
+
+    ax.axhline(100, color='grey', linestyle='--', linewidth=1)
+    ax.set_ylim(bottom=0)
+    ax.set_ylabel('% от нужного планете')
+    ax.set_title(f'Прогресс запросов в лаборатории за {CHART_PERIOD.days} дн. (MSK)')
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m %H:%M', tz=ZoneInfo('Europe/Moscow')))
+    ax.grid(alpha=0.3)
+    ax.legend(loc='upper left', fontsize='small')
+    fig.autofmt_xdate()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    return buffer.getvalue()
+
+
+async def get_cached_file_id(session: orm.AsyncSession, hash_: str) -> str | None:
+    return await session.scalar(orm.select(orm.ChartImage.file_id).where(orm.ChartImage.data_hash == hash_))
+
+
+async def save_file_id(session: orm.AsyncSession, hash_: str, file_id: str) -> None:
+    image = await orm.get_or_create(session, orm.ChartImage, {orm.ChartImage.data_hash: hash_})
+    image.file_id = file_id
+    await session.commit()
+
+
+async def forget_file_id(session: orm.AsyncSession, hash_: str) -> None:
+    await session.execute(orm.delete(orm.ChartImage).where(orm.ChartImage.data_hash == hash_))
+    await session.commit()
@@ -0,0 +1,63 @@
+"""
+Параллельная обработка апдейтов телеграма: разные чаты обслуживаются одновременно, а внутри одного чата
+апдейты идут строго по очереди, как без concurrent_updates - кнопки и команды в чате не обгоняют друг друга
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# столько апдейтов может ждать своей очереди в чатах; выше - телеграм-библиотека сама придержит новые
+MAX_PENDING_UPDATES = 256
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Семафор BaseUpdateProcessor берётся до do_process_update, и если бы ограничивал он, десяток апдейтов
+    из одного чата, ждущих друг друга, занял бы все места. Поэтому он ограничивает только очередь,
+    а max_concurrent_updates - число апдейтов, которые уже дождались своего чата и выполняются
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max(MAX_PENDING_UPDATES, max_concurrent_updates))
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # chat_id -> (блокировка, сколько апдейтов её держат или ждут); пустые удаляем, чатов может быть много
+        self._chats: dict[int, tuple[asyncio.Lock, int]] = {}
+
+    @staticmethod
+    def _chat_id(update: object) -> int | None:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            async with self._running:
+                await coroutine
+            return
+
+        lock, users = self._chats.get(chat_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._chats[chat_id] = (lock, users + 1)
+        try:
+            async with lock, self._running:
+                await coroutine
+        finally:
+            lock, users = self._chats[chat_id]
+            if users == 1:
+                del self._chats[chat_id]
+            else:
+                self._chats[chat_id] = (lock, users - 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -1,15 +1,143 @@
 import argparse
-import json
+import asyncio
 import logging
-from datetime import datetime
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterable, Optional
 from zoneinfo import ZoneInfo
 
 import api
+import export
+import logs
 import orm
+import retention
+import transport
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-logging.basicConfig(level=logging.DEBUG)
+
+# столько токенов одновременно проверяем через extend_token
+TOKEN_IMPORT_CONCURRENCY = 5
+
+
+@dataclass
+class TokenImportResult:
+    token: str
+    status: str  # valid | expired | duplicate | error
+    player_id: Optional[int] = None
+    name: Optional[str] = None
+    expired_dt: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+def read_tokens(lines: Iterable[str]) -> list[str]:
+    """по токену на строку; пустые строки и # комментарии пропускаем"""
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+
+async def _validate_token(token: str, http_session, semaphore: asyncio.Semaphore) -> TokenImportResult:
+    async with semaphore:
+        try:
+            authorization = await api.extend_token(token, http_session)
+        except api.InvalidToken:
+            return TokenImportResult(token, 'expired')
+        except Exception as e:
+            logger.exception('cant validate token %s', logs.token_fingerprint(token))
+            return TokenImportResult(token, 'error', error=str(e))
+    expired_dt = datetime.fromtimestamp(authorization['token_expired_at'])
+    return TokenImportResult(
+        token, 'valid' if expired_dt > datetime.now() else 'expired',
+        authorization['player_id'], authorization['name'], expired_dt,
+    )
+
+
+async def validate_tokens(tokens: list[str], concurrency: int = TOKEN_IMPORT_CONCURRENCY) -> list[TokenImportResult]:
+    """
+    Результаты в порядке tokens. Повтор токена не проверяем второй раз, а из нескольких живых токенов одного
+    игрока оставляем самый долгоживущий - у игрока в бд один токен; остальные помечаем duplicate
+    """
+    unique = list(dict.fromkeys(tokens))
+    semaphore = asyncio.Semaphore(concurrency)
+    async with transport.make_async_session() as http_session:
+        validated = dict(zip(unique, await asyncio.gather(
+            *(_validate_token(token, http_session, semaphore) for token in unique)
+        )))
+
+    best: dict[int, TokenImportResult] = {}
+    for result in validated.values():
+        if result.status == 'valid':
+            current = best.get(result.player_id)
+            if current is None or result.expired_dt > current.expired_dt:
+                best[result.player_id] = result
+    for result in validated.values():
+        if result.status == 'valid' and best[result.player_id] is not result:
+            result.status = 'duplicate'
+
+    results = []
+    seen = set()
+    for token in tokens:
+        results.append(TokenImportResult(token, 'duplicate') if token in seen else validated[token])
+        seen.add(token)
+    return results
+
+
+def save_tokens(session: orm.Session, results: list[TokenImportResult]) -> None:
+    """заводит или обновляет User и Token всех valid-результатов; commit за вызывающим"""
+    valid = {result.player_id: result for result in results if result.status == 'valid'}
+    users = {
+        user.id: user
+        for user in session.scalars(orm.select(orm.User).where(orm.User.id.in_(valid)))
+    }
+    tokens = {}
+    for token in session.scalars(orm.select(orm.Token).where(orm.Token.user_id.in_(valid)).order_by(orm.Token.id)):
+        tokens.setdefault(token.user_id, token)
+
+    now = datetime.now(tz=ZoneInfo('UTC'))
+    for player_id, result in valid.items():
+        user = users.get(player_id)
+        if user is None:
+            user = orm.User(id=player_id)
+            session.add(user)
+        user.name = result.name
+
+        token = tokens.get(player_id)
+        if token is None:
+            token = orm.Token(user=user)
+            session.add(token)
+        token.update_dt = now
+        token.value = result.token
+        token.active = True
+        token.expired_dt = result.expired_dt
+
+
+def import_tokens(tokens: list[str]) -> list[TokenImportResult]:
+    results = asyncio.run(validate_tokens(tokens))
+    with orm.make_session() as session:
+        save_tokens(session, results)
+        session.commit()
+    return results
+
+
+def print_token_report(results: list[TokenImportResult]) -> None:
+    for result in results:
+        details = [result.status, logs.token_fingerprint(result.token)]
+        if result.player_id is not None:
+            details.append(f'{result.name} (id={result.player_id}) till {result.expired_dt:%Y-%m-%d %H:%M}')
+        if result.error:
+            details.append(result.error[:200])
+        print(' '.join(details))
+    counts = {status: sum(r.status == status for r in results) for status in ('valid', 'expired', 'duplicate', 'error')}
+    print(', '.join(f'{status}: {count}' for status, count in counts.items()))
+
+
+def utc_datetime(value: str) -> datetime:
+    """ISO дата или дата-время; без таймзоны считаем utc, как create_dt в бд"""
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
 
 parser = argparse.ArgumentParser(
     prog='Walkr manipulator',
@@ -17,41 +145,49 @@ parser = argparse.ArgumentParser(
 )
 
 parser.add_argument('--token', type=str, help='Добавить или обновить токен в системе')
+parser.add_argument('--tokens', type=argparse.FileType('r'), metavar='FILE',
+                    help='Добавить или обновить токены из файла (- для stdin), по одному на строку')
 parser.add_argument('--db_create_tables',
                     action='store_true', help='Завести в бд таблицы стандарным алхимийным инструментом')
+parser.add_argument('--db_migrate',
+                    action='store_true', help='Докинуть в существующую бд недостающие таблицы и индексы')
+parser.add_argument('--db_retention', action='store_true',
+                    help='Проредить старую историю прогресса лабы, ANALYZE и VACUUM')
+parser.add_argument('--export', metavar='FILE',
+                    help='Выгрузить историю прогресса запросов лабы в файл (- для stdout)')
+parser.add_argument('--export_format', choices=export.FORMATS,
+                    help='Формат выгрузки; по умолчанию по расширению файла, иначе csv')
+parser.add_argument('--since', type=utc_datetime, help='Выгружать записи с этого момента (utc, ISO)')
+parser.add_argument('--until', type=utc_datetime, help='Выгружать записи до этого момента (utc, ISO)')
+parser.add_argument('--user', type=int, action='append', help='Выгружать только этого игрока (id), можно несколько')
 
 if __name__ == '__main__':
+    logs.setup(filename=None, level=logging.DEBUG)
     args = parser.parse_args()
     if args.db_create_tables:
         orm.Base.metadata.create_all(orm.engine)
         print('orm creating_all success!')
 
-    if args.token:
-        result = api.make_sync_request(
-            'post',
-            'https://production.sw.fourdesire.com/api/v2/players/extend_token',
-            args.token
-        )
-        result = json.loads(result)
-        if not result['success']:
-            raise ValueError('api answer doesnt have success:true')
-
-        with orm.make_session() as session:
-            user = session.query(orm.User).get(result['authorization']['player_id'])
-            if not user:
-                user = orm.User(id=result['authorization']['player_id'])
-                session.add(user)
-            user.name = result['authorization']['name']
-
-            tokens = session.query(orm.Token).filter(orm.Token.user == user).all()
-            if not tokens:
-                token = orm.Token(user=user)
-                session.add(token)
-            else:
-                token = tokens[0]
-            token.update_dt = datetime.now(tz=ZoneInfo('UTC'))
-            token.value = args.token
-            token.active = True
-            token.expired_dt = datetime.fromtimestamp(result['authorization']['token_expired_at'])
-
-            session.commit()
+    if args.db_migrate:
+        created_indexes = orm.migrate(orm.engine)
+        print(f'migrate success! created indexes: {", ".join(created_indexes) or "none"}')
+
+    if args.db_retention:
+        report = retention.run(orm.engine, vacuum=True)
+        print(f'retention success! deleted rows: {report.deleted}')
+
+    if args.token or args.tokens:
+        tokens_to_import = [args.token] if args.token else read_tokens(args.tokens)
+        import_results = import_tokens(tokens_to_import)
+        print_token_report(import_results)
+        if not any(r.status == 'valid' for r in import_results):
+            sys.exit(1)
+
+    if args.export:
+        export_format = args.export_format or ('jsonl' if args.export.endswith('.jsonl') else 'csv')
+        if args.export == '-':
+            exported = export.export(orm.engine, sys.stdout, export_format, args.since, args.until, args.user)
+        else:
+            with open(args.export, 'w', encoding='utf-8', newline='') as out:
+                exported = export.export(orm.engine, out, export_format, args.since, args.until, args.user)
+        print(f'export success! {exported} rows', file=sys.stderr)
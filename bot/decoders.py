@@ -0,0 +1,132 @@
+"""
+Быстрый разбор ответов api сразу в dataclass'ы, без marshmallow.
+Читаем только те поля, которые потом используем, а геттеры и конвертеры полей собираем один раз на класс.
+Полная проверка схемами осталась в api.py (api.STRICT_DECODING)
+"""
+import dataclasses
+import json
+import operator
+from datetime import datetime, timezone
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Optional, Type, TypeVar
+
+T = TypeVar('T')
+
+# поле dataclass'а -> (путь до значения в json, конвертер или None)
+DecoderSpec = dict[str, tuple[tuple[str, ...], Optional[Callable[[Any], Any]]]]
+
+_json_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+def timestamp(value: int) -> datetime:
+    """то же, что api.TimeStamp: naive utc, а 0 - это 1970-01-01"""
+    if value == 0:
+        return datetime(1970, 1, 1)
+    return datetime.fromtimestamp(value, tz=timezone.utc).replace(tzinfo=None)
+
+
+def _make_getter(path: tuple[str, ...]) -> Callable[[dict], Any]:
+    if len(path) == 1:
+        return operator.itemgetter(path[0])
+
+    getters = [operator.itemgetter(key) for key in path]
+
+    def get(data: dict) -> Any:
+        for getter in getters:
+            data = getter(data)
+        return data
+
+    return get
+
+
+def compile_decoder(cls: Type[T], spec: DecoderSpec) -> Callable[[dict], T]:
+    """
+    Собирает функцию dict из json -> cls. Поля cls, которых нет в spec, заполняются None
+    """
+    unknown = set(spec) - {f.name for f in dataclasses.fields(cls)}
+    if unknown:
+        raise ValueError(f'{cls.__name__} has no fields {unknown}')
+
+    plan = []
+    for field in dataclasses.fields(cls):
+        if field.name in spec:
+            path, convert = spec[field.name]
+            plan.append((_make_getter(path), convert))
+        else:
+            plan.append((None, None))
+
+    def decode(data: dict) -> T:
+        values = []
+        for get, convert in plan:
+            if get is None:
+                values.append(None)
+            elif convert is None:
+                values.append(get(data))
+            else:
+                values.append(convert(get(data)))
+        return cls(*values)
+
+    return decode
+
+
+async def iter_array_items(chunks: AsyncIterable[str], key: str) -> AsyncIterator[Any]:
+    """
+    Элементы массива json_ответ[key] по одному, по мере прихода кусков текста: в памяти только текущий элемент
+    и недочитанный хвост. Ищем первое вхождение "key" в ответе, так что ключ должен быть верхнего уровня и стоять
+    до вложенных объектов с таким же ключом. Элементы - объекты или массивы: недописанное число raw_decode прочёл бы
+    """
+    chunks = aiter(chunks)
+    buffer = ''
+    pos = 0
+    exhausted = False
+
+    async def more() -> bool:
+        nonlocal buffer, pos, exhausted
+        if exhausted:
+            return False
+        try:
+            chunk = await anext(chunks)
+        except StopAsyncIteration:
+            exhausted = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    # до начала массива
+    marker = f'"{key}"'
+    while (found := buffer.find(marker)) < 0:
+        # хвост оставляем на случай, если ключ разрезан между кусками
+        pos = max(len(buffer) - len(marker), 0)
+        if not await more():
+            raise ValueError(f'no "{key}" in response')
+    pos = found + len(marker)
+    for expected in ':[':
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buffer):
+                break
+            if not await more():
+                raise ValueError(f'response ends before "{key}" array')
+        if buffer[pos] != expected:
+            raise ValueError(f'"{key}" is not an array')
+        pos += 1
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE + ',':
+            pos += 1
+        if pos == len(buffer):
+            if not await more():
+                raise ValueError(f'response ends inside "{key}" array')
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            item, pos = _json_decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # элемент ещё не дочитан; если дочитывать нечего - ответ битый
+            if not await more():
+                raise
+            continue
+        yield item
@@ -0,0 +1,103 @@
+"""
+Выгрузка истории прогресса запросов лабы из бд в csv или json lines для cli.py --export.
+Строки читаются из курсора пачками по EXPORT_BATCH_SIZE и сразу пишутся, так что память не зависит от объёма истории.
+В WAL чтение не мешает боту писать, даже если выгрузка идёт долго
+"""
+import csv
+import datetime
+import json
+import logging
+from typing import Iterator, Optional, TextIO
+
+import sqlalchemy
+
+import orm
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+EXPORT_BATCH_SIZE = 1000
+FORMATS = ('csv', 'jsonl')
+
+_COLUMNS = (
+    orm.LabRequestProgress.id.label('progress_id'),
+    orm.LabRequestProgress.create_dt,
+    orm.User.id.label('user_id'),
+    orm.User.name.label('user_name'),
+    orm.LabPlanet.planet_name,
+    orm.LabPlanet.planet_requirements,
+    orm.LabRequest.id.label('lab_request_id'),
+    orm.LabRequest.requested_dt,
+    orm.LabRequestProgress.total_donation,
+    orm.LabRequestProgress.current_donation,
+    orm.LabRequestProgress.donated_counter,
+)
+FIELDS = tuple(column.key for column in _COLUMNS)
+
+
+def _query(
+        since: Optional[datetime.datetime], until: Optional[datetime.datetime], user_ids: Optional[list[int]]
+) -> sqlalchemy.Select:
+    query = (
+        sqlalchemy.select(*_COLUMNS)
+        .join(orm.LabRequest, orm.LabRequest.id == orm.LabRequestProgress.lab_request_id)
+        .join(orm.LabPlanet, orm.LabPlanet.id == orm.LabRequest.lab_planet_id)
+        .join(orm.User, orm.User.id == orm.LabPlanet.user_id)
+        # по первичному ключу - это порядок записи, и sqlite не нужно сортировать всю выборку перед первой строкой
+        .order_by(orm.LabRequestProgress.id)
+    )
+    if since is not None:
+        query = query.where(orm.LabRequestProgress.create_dt >= since)
+    if until is not None:
+        query = query.where(orm.LabRequestProgress.create_dt < until)
+    if user_ids:
+        query = query.where(orm.User.id.in_(user_ids))
+    return query
+
+
+def iter_progress_rows(
+        connection: sqlalchemy.Connection,
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        user_ids: Optional[list[int]] = None,
+) -> Iterator[sqlalchemy.Row]:
+    """since/until - utc без таймзоны, как create_dt в бд; until не включается"""
+    result = connection.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(_query(since, until, user_ids))
+    yield from result
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def write(rows: Iterator[sqlalchemy.Row], out: TextIO, format_: str) -> int:
+    """пишет строки по мере чтения; возвращает их число"""
+    if format_ not in FORMATS:
+        raise ValueError(f'unknown export format {format_}, expected one of {FORMATS}')
+    count = 0
+    if format_ == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow([_plain(value) for value in row])
+            count += 1
+    else:
+        for row in rows:
+            out.write(json.dumps({key: _plain(value) for key, value in zip(FIELDS, row)}, ensure_ascii=False))
+            out.write('\n')
+            count += 1
+    return count
+
+
+def export(
+        engine: sqlalchemy.Engine,
+        out: TextIO,
+        format_: str = 'csv',
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        user_ids: Optional[list[int]] = None,
+) -> int:
+    with engine.connect() as connection:
+        count = write(iter_progress_rows(connection, since, until, user_ids), out, format_)
+    logger.info('exported %s progress rows as %s', count, format_)
+    return count
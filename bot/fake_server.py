@@ -0,0 +1,244 @@
+"""
+Локальная замена walkr api для нагрузочных тестов и бенчмарков: отдаёт записанные или синтетические ответы
+на те ручки, которые дёргает бот, с настраиваемой задержкой и долей ошибок.
+
+    python fake_server.py --port 8088 --comments 10000 --latency 0.2 --error_rate 0.05
+    WALKR_API_BASE_URL=http://127.0.0.1:8088/api/v2 python bot.py
+
+С --record запросы проксируются в настоящий walkr, а ответы складываются в --fixtures, откуда потом и отдаются.
+Записанные ответы содержат настоящие имена и id игроков - не коммитьте их
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+import api
+import transport
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+UPSTREAM_BASE_URL = 'https://production.sw.fourdesire.com/api/v2'
+DEFAULT_FIXTURES_DIR = 'fake_fixtures'
+# ручка -> имя файла с записанным ответом
+FIXTURE_NAMES = {
+    'fleets_current': 'fleets_current.json',
+    'comments': 'comments.json',
+    'labs_current': 'labs_current.json',
+    'labs_request': 'labs_request.json',
+    'players_extend_token': 'players_extend_token.json',
+}
+
+
+@dataclass
+class FakeConfig:
+    fixtures_dir: Path = Path(DEFAULT_FIXTURES_DIR)
+    # секунды задержки каждого ответа и случайная добавка к ней
+    latency: float = 0.0
+    jitter: float = 0.0
+    # доля ответов, которые вернут error_status
+    error_rate: float = 0.0
+    error_status: int = 500
+    # сколько комментариев в лабе, если нет записанного comments.json
+    comments: int = 50
+    # куда проксировать в режиме записи
+    record_upstream: Optional[str] = None
+    seed: Optional[int] = None
+
+
+def synthetic_comments(count: int, seed: int = 0) -> list[dict]:
+    """каждый третий комментарий - запрос энергии, остальные - стикеры и текст"""
+    rnd = random.Random(seed)
+    now = int(time.time())
+    comments = []
+    for comment_id in range(1, count + 1):
+        user_id = 1000 + rnd.randrange(max(count // 10, 1))
+        user = {'id': user_id, 'name': f'Player {user_id}', 'level': rnd.randint(1, 40)}
+        created_at = now - (count - comment_id) * 60
+        if comment_id % 3 == 0:
+            requirements = rnd.choice((30000, 60000, 120000))
+            donations = rnd.randint(0, 5)
+            comment = {
+                'type': 'donation', 'donation_type': 'energy', 'donation_value': 500, 'max_donation_count': 5,
+                'colony_type': 'planet', 'identifier': f'planet-{user_id % 97}', 'requirements': requirements,
+                'total_donation': rnd.randrange(requirements), 'current_donation': 500 * donations,
+                'donated_counter': f'{user_id + 1}|' + '+'.join(['500'] * donations) if donations else '',
+                'last_requested_at': created_at,
+            }
+        else:
+            comment = {'type': rnd.choice(('sticker', 'text')), 'text': 'hi'}
+        comments.append({
+            'id': comment_id, 'comment': comment, 'created_at': created_at, 'blocked': False,
+            'user': user, 'raw_comment': '',
+        })
+    return comments
+
+
+def synthetic_fleet() -> dict:
+    """флот в пути, три участника, прошло одно голосование"""
+    now = int(time.time())
+    members = [
+        {'id': 1000 + i, 'name': f'Player {1000 + i}', 'level': 30, 'planets_count': 80, 'replicators_count': 20,
+         'energy_productivity': 5000, 'population': 700, 'spaceship': 'walkr-baby', 'contribution': 1000000,
+         'title': 'captain' if i == 0 else 'member', 'role': 'sportsman', 'rsvp': 'ready'}
+        for i in range(3)
+    ]
+    return {
+        'success': True,
+        'fleet': {
+            'id': 1, 'name': 'Fake fleet', 'players_count': 3, 'members_count': 3, 'contribution_amount': 3000000,
+            'event_status': 'path', 'energy': 0, 'consumed_energy': 9000, 'value_a': 20000, 'value_b': 24000,
+            'value_c': 0, 'epic': {'id': 15, 'name': 'A Bistro Showdown'},
+        },
+        'event_status': 'path',
+        'event': {
+            'id': 185, 'epic_id': 15, 'event_type': 'resources', 'resource_a': 20000, 'resource_b': 24000,
+            'resource_c': None, 'label_a': None, 'label_b': None, 'label_c': None, 'name': 'A party',
+        },
+        'path': {'id': 165, 'required_energy': 18000},
+        'members': members,
+        'fleet_histories': [
+            {'id': 179, 'event_type': 'voting', 'label_a': 'Bribe', 'label_b': 'Resist', 'label_c': None,
+             'value_a': 2, 'value_b': 0, 'value_c': 0, 'solved_at': now - 3600},
+        ],
+        'now': now,
+    }
+
+
+def synthetic_lab() -> dict:
+    now = int(time.time())
+    return {
+        'success': True,
+        'lab': {'id': api.LAB_ID, 'name': 'Fake lab'},
+        'research': {
+            'type': 'donation', 'donation_type': 'energy', 'donation_value': 500, 'max_donation_count': 5,
+            'colony_type': 'planet', 'identifier': 'aurora', 'requirements': 30000, 'total_donation': 1500,
+            'current_donation': 1000, 'donated_counter': '1001|500+500', 'last_requested_at': now - 600,
+        },
+        'members': [],
+        'now': now,
+    }
+
+
+class FakeWalkr:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self._rnd = random.Random(config.seed)
+        self._fixtures: dict[str, dict] = {}
+        self._synthetic_comments: Optional[list[dict]] = None
+        self._upstream_session: Optional[aiohttp.ClientSession] = None
+
+    def _load(self, name: str) -> Optional[dict]:
+        if name not in self._fixtures:
+            path = self.config.fixtures_dir / FIXTURE_NAMES[name]
+            self._fixtures[name] = json.loads(path.read_text()) if path.exists() else None
+        return self._fixtures[name]
+
+    def _payload(self, name: str, request: web.Request) -> dict:
+        recorded = self._load(name)
+        if name == 'comments':
+            if recorded is not None:
+                comments = recorded['comments']
+            else:
+                if self._synthetic_comments is None:
+                    self._synthetic_comments = synthetic_comments(self.config.comments, self.config.seed or 0)
+                comments = self._synthetic_comments
+            # как настоящий сервер: только новее since_id, не больше limit - без since_id самые новые,
+            # а с ним самые старые после since_id, чтобы дочитывать страницами
+            since_id = int(request.query.get('since_id', 0))
+            limit = int(request.query.get('limit', len(comments)))
+            comments = [c for c in comments if c['id'] > since_id]
+            comments = comments[:limit] if since_id else comments[-limit:]
+            return {'success': True, 'comments': comments, 'now': int(time.time())}
+
+        if recorded is not None:
+            return recorded
+        if name == 'fleets_current':
+            return synthetic_fleet()
+        if name == 'labs_current':
+            return synthetic_lab()
+        if name == 'players_extend_token':
+            return {
+                'success': True,
+                'authorization': {'player_id': 1000, 'name': 'Player 1000',
+                                  'token_expired_at': int(time.time()) + 30 * 24 * 3600},
+            }
+        return {'success': True}
+
+    async def _record(self, name: str, request: web.Request) -> web.Response:
+        url = f'{self.config.record_upstream.rstrip("/")}{request.path.removeprefix("/api/v2")}'
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in ('host', 'content-length')}
+        if self._upstream_session is None:
+            self._upstream_session = transport.make_async_session()
+        async with self._upstream_session.request(
+                request.method, url, params=request.query, data=await request.read(), headers=headers
+        ) as response:
+            body = await response.text()
+            # инкрементальная страница комментариев - это пара новых штук, а отдавать из записи будем на любой
+            # запрос (since_id и limit применяются к записанному), так что пишем только полный ответ
+            partial = name == 'comments' and int(request.query.get('since_id', 0)) != 0
+            if response.status == 200 and not partial:
+                self.config.fixtures_dir.mkdir(parents=True, exist_ok=True)
+                (self.config.fixtures_dir / FIXTURE_NAMES[name]).write_text(body)
+                self._fixtures.pop(name, None)
+                logger.info('recorded %s %s', request.method, request.path)
+            return web.Response(text=body, status=response.status, content_type='application/json')
+
+    def _handler(self, name: str):
+        async def handle(request: web.Request) -> web.Response:
+            delay = self.config.latency + self._rnd.uniform(0, self.config.jitter)
+            if delay:
+                await asyncio.sleep(delay)
+            if self._rnd.random() < self.config.error_rate:
+                return web.json_response({'success': False, 'error': 'fake error'}, status=self.config.error_status)
+            if self.config.record_upstream:
+                return await self._record(name, request)
+            return web.json_response(self._payload(name, request))
+
+        return handle
+
+    async def _close(self, app: web.Application) -> None:
+        if self._upstream_session is not None:
+            await self._upstream_session.close()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/api/v2/fleets/current', self._handler('fleets_current'))
+        app.router.add_get('/api/v2/comments', self._handler('comments'))
+        app.router.add_get('/api/v2/labs/current', self._handler('labs_current'))
+        app.router.add_post('/api/v2/labs/{lab_id}/request', self._handler('labs_request'))
+        app.router.add_post('/api/v2/players/extend_token', self._handler('players_extend_token'))
+        app.on_cleanup.append(self._close)
+        return app
+
+
+parser = argparse.ArgumentParser(prog='Fake walkr', description='Локальная замена walkr api')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8088)
+parser.add_argument('--fixtures', default=DEFAULT_FIXTURES_DIR, help='Папка с записанными ответами')
+parser.add_argument('--latency', type=float, default=0.0, help='Задержка каждого ответа, секунды')
+parser.add_argument('--jitter', type=float, default=0.0, help='Случайная добавка к задержке, секунды')
+parser.add_argument('--error_rate', type=float, default=0.0, help='Доля ответов с ошибкой, 0..1')
+parser.add_argument('--error_status', type=int, default=500)
+parser.add_argument('--comments', type=int, default=50, help='Сколько синтетических комментариев в лабе')
+parser.add_argument('--record', nargs='?', const=UPSTREAM_BASE_URL, default=None,
+                    help='Проксировать в настоящий walkr и записывать ответы в --fixtures')
+parser.add_argument('--seed', type=int, default=None)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    fake = FakeWalkr(FakeConfig(
+        fixtures_dir=Path(args.fixtures), latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_status=args.error_status, comments=args.comments, record_upstream=args.record, seed=args.seed,
+    ))
+    web.run_app(fake.make_app(), host=args.host, port=args.port)
@@ -1,5 +1,8 @@
+import asyncio
 import datetime
 import logging
+from dataclasses import dataclass
+from typing import Optional
 from zoneinfo import ZoneInfo
 
 import aiohttp
@@ -7,20 +10,114 @@ import aiohttp
 import api
 import meta
 import orm
+import token_pool
+import transport
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# сколько токенов одновременно опрашиваем при массовых запросах в лабу
+LAB_REQUESTS_CONCURRENCY = 5
+# и сколько одновременно запрашиваем флотов
+EPIC_FETCH_CONCURRENCY = 5
+# запрос в лабе живёт 6 часов, потом его можно делать заново
+LAB_REQUEST_TTL = datetime.timedelta(hours=6)
+# сколько новых комментариев просим за раз; если пришло столько же - есть ещё, просим следующую страницу
+LAB_COMMENTS_INCREMENTAL_LIMIT = 300
+# столько полных страниц подряд - столько же, сколько даёт полное перечитывание, дальше перечитываем всё
+LAB_COMMENTS_MAX_PAGES = 10
 
-async def get_epic_info(auth_token: str, session: aiohttp.ClientSession):
-    # todo: логически поделить это на отдельные controller и view
+# прогресс запросов пишут и фоновый опрос, и отрисовка /get_lab_requests в каждом чате: без общей блокировки
+# два обработчика прочитали бы одну и ту же последнюю запись и оба вставили бы новую. Держать до commit
+lab_progress_lock = asyncio.Lock()
+# две одновременные "Делаем запросы" из разных чатов сделали бы каждый запрос дважды
+_make_lab_requests_lock = asyncio.Lock()
+
+
+NOT_IN_EPIC_TEXT = 'Сейчас не в эпопее'
+
+
+async def get_fleets(
+        tokens: token_pool.TokenPool,
+        session: aiohttp.ClientSession,
+        concurrency: int = EPIC_FETCH_CONCURRENCY
+) -> dict[int, tuple[api.FleetWrapper, api.EventWrapper]]:
+    """
+    Флоты всех игроков, для которых есть живые токены, без дублей: id флота -> (флот, событие).
+    Если игрок уже нашёлся среди участников полученного флота, его токен не запрашиваем
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    fleets: dict[int, tuple[api.FleetWrapper, api.EventWrapper]] = {}
+    covered_user_ids: set[int] = set()
+    upstream_errors: list[Exception] = []
+
+    async def fetch(token: token_pool.TokenState) -> None:
+        async with semaphore:
+            if token.user_id in covered_user_ids:
+                return
+            try:
+                async with tokens.track(token):
+                    fleet, event = await api.get_fleet(token.value, session)
+            except api.NotInEpic:
+                return
+            except Exception as e:
+                if transport.is_upstream_error(e):
+                    upstream_errors.append(e)
+                    return
+                logger.exception('cant get fleet of user id=%s', token.user_id)
+                return
+        fleets.setdefault(fleet.id, (fleet, event))
+        covered_user_ids.update(member['id'] for member in fleet.members)
+
+    await asyncio.gather(*(fetch(token) for token in tokens.healthy()))
+    if upstream_errors:
+        # без части флотов снимок был бы неполным, а пустой выглядел бы как "не в эпопее":
+        # пусть poller отдаст последний удачный снимок
+        raise upstream_errors[0]
+    return fleets
+
+
+def save_player_energy(
+        session: orm.Session, fleets: dict[int, tuple[api.FleetWrapper, api.EventWrapper]]
+) -> None:
+    """запоминает энергию всех участников флотов для bridge.py; commit за вызывающим"""
+    now = datetime.datetime.now(tz=ZoneInfo('UTC'))
+    rows = {
+        member['id']: {
+            'player_id': member['id'], 'name': member['name'],
+            'energy_productivity': member['energy_productivity'], 'update_dt': now,
+        }
+        for fleet, _ in fleets.values()
+        for member in fleet.members
+    }
+    if not rows:
+        return
+    upsert = orm.dialect_insert(session, orm.PlayerEnergy).values(list(rows.values()))
+    session.execute(upsert.on_conflict_do_update(
+        index_elements=[orm.PlayerEnergy.player_id],
+        set_={key: upsert.excluded[key] for key in ('name', 'energy_productivity', 'update_dt')},
+    ))
+
+
+async def get_epic_info(
+        tokens: token_pool.TokenPool,
+        session: aiohttp.ClientSession,
+        concurrency: int = EPIC_FETCH_CONCURRENCY
+) -> str:
     # todo: коротко о следующих этапах
+    return render_epic_infos(await get_fleets(tokens, session, concurrency))
 
-    try:
-        fleet, event = await api.get_fleet(auth_token, session)
-    except api.NotInEpic:
-        return 'Сейчас не в эпопее'
 
+def render_epic_infos(fleets: dict[int, tuple[api.FleetWrapper, api.EventWrapper]]) -> str:
+    if not fleets:
+        return NOT_IN_EPIC_TEXT
+    return '\n\n'.join(
+        render_epic_info(fleet, event)
+        for fleet, event in sorted(fleets.values(), key=lambda fleet_event: fleet_event[0].name)
+    )
+
+
+def render_epic_info(fleet: api.FleetWrapper, event: api.EventWrapper) -> str:
     comments = []
 
     if fleet.epic_id not in meta.epics:
@@ -82,67 +179,275 @@ async def get_epic_info(auth_token: str, session: aiohttp.ClientSession):
 def _get_orm_request_progresses(
         session: orm.Session, api_requests: list[api.LabRequestWrapper]
 ) -> list[orm.LabRequestProgress]:
-    ret = []
-    for req in api_requests:
-        user = orm.get_or_create(session, orm.User, {orm.User.id: req.user_id})
-        user.name = req.user_name
-
-        lab_planet = orm.get_or_create(
-            session,
-            orm.LabPlanet,
-            {
-                orm.LabPlanet.user: user,
-                orm.LabPlanet.planet_name: req.planet_name,
-                orm.LabPlanet.planet_requirements: req.requirements,
-            }
-        )
+    """
+    Раскладывает запросы из api по User/LabPlanet/LabRequest/LabRequestProgress.
+    Всё существующее подгружаем несколькими запросами на всю пачку, недостающее создаём в памяти
+    и пишем одним flush, чтобы количество запросов в бд не росло вместе с количеством запросов в лабе.
+    Связи у уже существующих объектов проставляем сами: вызывающий код в async и лениво догружать их не может
+    """
+    if not api_requests:
+        return []
 
-        lab_request = orm.get_or_create(
-            session,
-            orm.LabRequest,
-            {
-                orm.LabRequest.lab_planet: lab_planet,
-                orm.LabRequest.requested_dt: req.last_requested_at,
-            }
+    user_names = {req.user_id: req.user_name for req in api_requests}
+    upsert_users = orm.dialect_insert(session, orm.User).values(
+        [{'id': user_id, 'name': name} for user_id, name in user_names.items()]
+    )
+    session.execute(upsert_users.on_conflict_do_update(
+        index_elements=[orm.User.id], set_={'name': upsert_users.excluded.name}
+    ))
+    users = {
+        user.id: user
+        for user in session.scalars(
+            orm.select(orm.User).where(orm.User.id.in_(user_names)).execution_options(populate_existing=True)
         )
+    }
 
-        lab_request_progress = orm.get_or_create(
-            session,
-            orm.LabRequestProgress,
-            {
-                orm.LabRequestProgress.request: lab_request,
-                orm.LabRequestProgress.total_donation: req.total_donation,
-                orm.LabRequestProgress.current_donation: req.current_donation,
-                orm.LabRequestProgress.donated_counter: req.donated_counter,
-            }
+    lab_planets = {
+        (p.user_id, p.planet_name, p.planet_requirements): p
+        for p in session.scalars(orm.select(orm.LabPlanet).where(orm.LabPlanet.user_id.in_(user_names)))
+    }
+    lab_requests = {
+        (r.lab_planet_id, r.requested_dt): r
+        for r in session.scalars(orm.select(orm.LabRequest).where(
+            orm.LabRequest.lab_planet_id.in_([p.id for p in lab_planets.values()])
+        ))
+    }
+    # прогресс храним только при изменении, так что сравнивать достаточно с последней записью каждого запроса
+    latest_progress_ids = (
+        orm.select(orm.func.max(orm.LabRequestProgress.id))
+        .where(orm.LabRequestProgress.lab_request_id.in_([r.id for r in lab_requests.values()]))
+        .group_by(orm.LabRequestProgress.lab_request_id)
+    )
+    latest_progresses = {
+        p.lab_request_id: p
+        for p in session.scalars(
+            orm.select(orm.LabRequestProgress).where(orm.LabRequestProgress.id.in_(latest_progress_ids))
         )
-        ret.append(lab_request_progress)
-        session.flush()
+    }
+
+    ret = []
+    for req in api_requests:
+        planet_key = (req.user_id, req.planet_name, req.requirements)
+        lab_planet = lab_planets.get(planet_key)
+        if lab_planet is None:
+            lab_planet = orm.LabPlanet(
+                user=users[req.user_id], planet_name=req.planet_name, planet_requirements=req.requirements
+            )
+            lab_planets[planet_key] = lab_planet
+        else:
+            orm.set_committed_value(lab_planet, 'user', users[req.user_id])
+
+        # у новых объектов id ещё нет, поэтому ключуем по самому объекту
+        request_key = (lab_planet.id or lab_planet, req.last_requested_at)
+        lab_request = lab_requests.get(request_key)
+        if lab_request is None:
+            lab_request = orm.LabRequest(lab_planet=lab_planet, requested_dt=req.last_requested_at)
+            lab_requests[request_key] = lab_request
+        else:
+            orm.set_committed_value(lab_request, 'lab_planet', lab_planet)
+
+        progress = latest_progresses.get(lab_request.id or lab_request)
+        values = (req.total_donation, req.current_donation, req.donated_counter)
+        if progress is None or (progress.total_donation, progress.current_donation, progress.donated_counter) != values:
+            progress = orm.LabRequestProgress(
+                request=lab_request,
+                total_donation=req.total_donation,
+                current_donation=req.current_donation,
+                donated_counter=req.donated_counter,
+            )
+            session.add(progress)
+            latest_progresses[lab_request.id or lab_request] = progress
+        elif progress.id is not None:
+            orm.set_committed_value(progress, 'request', lab_request)
+        ret.append(progress)
 
+    session.flush()
     return ret
 
 
+def _is_lab_request_expired(last_requested_at: datetime.datetime) -> bool:
+    return (
+            last_requested_at.replace(tzinfo=ZoneInfo('UTC')) + LAB_REQUEST_TTL
+            < datetime.datetime.now().astimezone(ZoneInfo('UTC'))
+    )
+
+
+def _merge_open_lab_requests(db_session: orm.Session, api_requests: list[api.LabRequestWrapper]) -> None:
+    open_requests = {
+        r.user_id: r
+        for r in db_session.query(orm.LabOpenRequest).filter(orm.LabOpenRequest.lab_id == api.LAB_ID)
+    }
+    for req in sorted(api_requests, key=lambda r: r.comment_id):
+        if req.user_id is None or _is_lab_request_expired(req.last_requested_at):
+            continue
+
+        open_request = open_requests.get(req.user_id)
+        if open_request is not None and open_request.comment_id > req.comment_id:
+            continue
+        if open_request is not None and open_request.comment_id != req.comment_id:
+            # у игрока новый запрос, старый больше не актуален
+            db_session.delete(open_request)
+            db_session.flush()
+            open_request = None
+        if open_request is None:
+            open_request = orm.LabOpenRequest(comment_id=req.comment_id, lab_id=api.LAB_ID, user_id=req.user_id)
+            db_session.add(open_request)
+            open_requests[req.user_id] = open_request
+
+        open_request.user_name = req.user_name
+        open_request.planet_name = req.planet_name
+        open_request.requirements = req.requirements
+        open_request.total_donation = req.total_donation
+        open_request.current_donation = req.current_donation
+        open_request.donated_counter = req.donated_counter
+        open_request.created_at = req.created_at
+        open_request.last_requested_at = req.last_requested_at
+
+    for open_request in open_requests.values():
+        if _is_lab_request_expired(open_request.last_requested_at):
+            db_session.delete(open_request)
+    db_session.flush()
+
+
+async def sync_lab_requests(
+        auth_token: str,
+        http_session: aiohttp.ClientSession,
+        db_session: orm.AsyncSession,
+        full: bool = False
+) -> list[api.LabRequestWrapper]:
+    """
+    Дочитывает новые комментарии лабы (после сохранённого since_id) и вливает запросы из них в
+    lab_open_request. Комментарий-запрос меняется на месте, пока в него донатят, поэтому перечитываем
+    и все открытые запросы: читаем с самого старого из них, а это не дальше их 6 часов жизни.
+    Страницы по LAB_COMMENTS_INCREMENTAL_LIMIT читаем, пока не придёт неполная. Полностью перечитываем,
+    если попросили или если новых комментариев больше LAB_COMMENTS_MAX_PAGES страниц
+    """
+    now = datetime.datetime.now(tz=ZoneInfo('UTC'))
+    cursor = await db_session.get(orm.LabCommentCursor, api.LAB_ID)
+    if cursor is None:
+        cursor = orm.LabCommentCursor(lab_id=api.LAB_ID, since_id=0, update_dt=now)
+        db_session.add(cursor)
+
+    requests: list[api.LabRequestWrapper] = []
+    max_comment_id = 0
+    if not full and cursor.since_id:
+        oldest_open = await db_session.scalar(
+            orm.select(orm.func.min(orm.LabOpenRequest.comment_id)).where(orm.LabOpenRequest.lab_id == api.LAB_ID)
+        )
+        since_id = cursor.since_id if oldest_open is None else min(cursor.since_id, oldest_open - 1)
+        for _ in range(LAB_COMMENTS_MAX_PAGES):
+            page = await api.get_lab_comments(
+                auth_token, http_session, since_id=since_id, limit=LAB_COMMENTS_INCREMENTAL_LIMIT
+            )
+            requests.extend(page.requests)
+            max_comment_id = max(max_comment_id, page.max_comment_id)
+            if page.comments_count < LAB_COMMENTS_INCREMENTAL_LIMIT or page.max_comment_id <= since_id:
+                break
+            since_id = page.max_comment_id
+        else:
+            logger.info('got %s full pages of lab comments, doing full resync', LAB_COMMENTS_MAX_PAGES)
+            full = True
+    else:
+        full = True
+
+    if full:
+        page = await api.get_lab_comments(auth_token, http_session)
+        requests, max_comment_id = page.requests, page.max_comment_id
+        await db_session.execute(orm.delete(orm.LabOpenRequest).where(orm.LabOpenRequest.lab_id == api.LAB_ID))
+        cursor.since_id = 0
+        cursor.full_sync_dt = now
+
+    await db_session.run_sync(_merge_open_lab_requests, requests)
+    cursor.since_id = max(cursor.since_id, max_comment_id)
+    cursor.update_dt = now
+    await db_session.flush()
+
+    open_requests = await db_session.scalars(
+        orm.select(orm.LabOpenRequest)
+        .where(orm.LabOpenRequest.lab_id == api.LAB_ID)
+        .order_by(orm.LabOpenRequest.comment_id)
+    )
+
+    return [
+        api.LabRequestWrapper(
+            created_at=r.created_at,
+            user_id=r.user_id,
+            user_name=r.user_name,
+            planet_name=r.planet_name,
+            requirements=r.requirements,
+            total_donation=r.total_donation,
+            current_donation=r.current_donation,
+            last_requested_at=r.last_requested_at,
+            donated_counter=r.donated_counter,
+            comment_id=r.comment_id,
+        )
+        for r in open_requests
+    ]
+
+
 async def get_current_lab_planets(
         http_session: aiohttp.ClientSession,
-        db_session: orm.Session
-) -> tuple[list[orm.LabRequestProgress], orm.Query]:
-    auth_token: str = db_session.query(orm.Token).filter(orm.Token.active).first().value
-    api_lab_requests = await api.get_lab_planets(auth_token, http_session)
-    req_progresses = _get_orm_request_progresses(db_session, api_lab_requests)
-    has_token_no_request_query = db_session.query(orm.User).join(orm.Token).filter(
-        orm.User.id.notin_([r.request.lab_planet.user_id for r in req_progresses]))
-    return req_progresses, has_token_no_request_query
+        db_session: orm.AsyncSession,
+        tokens: token_pool.TokenPool,
+        full_sync: bool = False
+) -> tuple[list[orm.LabRequestProgress], list[orm.User]]:
+    token = tokens.get()
+    async with tokens.track(token):
+        api_lab_requests = await sync_lab_requests(token.value, http_session, db_session, full=full_sync)
+    return await get_lab_request_progresses(db_session, api_lab_requests)
+
+
+async def get_lab_request_progresses(
+        db_session: orm.AsyncSession,
+        api_lab_requests: list[api.LabRequestWrapper]
+) -> tuple[list[orm.LabRequestProgress], list[orm.User]]:
+    # внутри много связей между объектами, синхронная сессия тут проще и ленивые догрузки не запрещены
+    req_progresses = await db_session.run_sync(_get_orm_request_progresses, api_lab_requests)
+    has_token_no_request = (await db_session.scalars(
+        orm.select(orm.User).join(orm.Token).where(orm.User.id.notin_([r.user_id for r in api_lab_requests]))
+    )).all()
+    return req_progresses, list(has_token_no_request)
+
+
+@dataclass
+class LabRequestAttempt:
+    user_name: str
+    status: str  # requested | skipped | error
+    error: Optional[str] = None
+
+
+def _can_make_lab_request(req: api.LabRequestWrapper) -> bool:
+    return _is_lab_request_expired(req.last_requested_at) and req.total_donation != req.requirements
+
+
+async def _make_lab_request(
+        token: token_pool.TokenState,
+        tokens: token_pool.TokenPool,
+        http_session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore
+) -> LabRequestAttempt:
+    async with semaphore:
+        try:
+            async with tokens.track(token):
+                req = await api.get_user_request(token.value, http_session)
+                if not _can_make_lab_request(req):
+                    return LabRequestAttempt(token.user_name, 'skipped')
+                await api.make_lab_request(token.value, http_session)
+        except Exception as e:
+            # один сломанный токен не должен ронять запросы остальных
+            logger.exception('lab request for %s failed', token.user_name)
+            return LabRequestAttempt(token.user_name, 'error', str(e))
+    return LabRequestAttempt(token.user_name, 'requested')
 
 
 async def make_lab_requests(
         http_session: aiohttp.ClientSession,
-        db_session: orm.Session
-) -> None:
-    for token in db_session.query(orm.Token).filter(orm.Token.active):
-        req = await api.get_user_request(token.value, http_session)
-        if (
-                req.last_requested_at.replace(tzinfo=ZoneInfo('UTC'))
-                + datetime.timedelta(hours=6) < datetime.datetime.now().astimezone(ZoneInfo('UTC'))
-                and req.total_donation != req.requirements
-        ):
-            await api.make_lab_request(token.value, http_session)
+        tokens: token_pool.TokenPool,
+        concurrency: int = LAB_REQUESTS_CONCURRENCY
+) -> list[LabRequestAttempt]:
+    semaphore = asyncio.Semaphore(concurrency)
+    async with _make_lab_requests_lock:
+        return list(await asyncio.gather(*(
+            _make_lab_request(token, tokens, http_session, semaphore)
+            for token in tokens.healthy()
+        )))
@@ -0,0 +1,116 @@
+"""
+Настройка логов: запись в файл и консоль идёт в отдельном потоке через очередь, а не на event loop,
+токены вычищаются из всех сообщений, тела ответов api пишутся обрезанными или только хэшем
+"""
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import os
+import queue
+import re
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_FILE = 'debug.log'
+LOG_LEVEL = os.environ.get('WALKR_LOG_LEVEL', 'INFO')
+# файл ротируется при таком размере, храним столько старых
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+# сколько символов тела ответа попадает в лог; 0 - только размер и хэш
+BODY_LOG_LIMIT = int(os.environ.get('WALKR_LOG_BODY_LIMIT', 300))
+
+# Bearer-токены из заголовков и сами walkr-токены вида spacewalk:...
+_TOKEN_RE = re.compile(r'(Bearer\s+)[^\s\'",}]+|spacewalk:[^\s\'",}]+', re.IGNORECASE)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def token_fingerprint(token: str) -> str:
+    """короткий отпечаток, чтобы в логах можно было отличить токены друг от друга, не раскрывая их"""
+    return hashlib.sha1(token.encode()).hexdigest()[:8]
+
+
+def redact(text: str) -> str:
+    def replace(match: re.Match) -> str:
+        prefix = match.group(1) or ''
+        return f'{prefix}<token {token_fingerprint(match.group(0)[len(prefix):])}>'
+
+    return _TOKEN_RE.sub(replace, text)
+
+
+class Body:
+    """
+    Тело ответа для лога. Считается, только если запись и правда пишется,
+    так что отброшенный по уровню лог не стоит ни хэша, ни копии
+    """
+
+    def __init__(self, text: str, limit: Optional[int] = None):
+        self.text = text
+        self.limit = BODY_LOG_LIMIT if limit is None else limit
+
+    def __str__(self) -> str:
+        digest = hashlib.sha1(self.text.encode()).hexdigest()[:12]
+        summary = f'<{len(self.text)} chars, sha1 {digest}>'
+        if self.limit <= 0:
+            return summary
+        if len(self.text) <= self.limit:
+            return f'{summary} {self.text}'
+        return f'{summary} {self.text[:self.limit]}...'
+
+
+class RedactingFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        redacted = redact(message)
+        if redacted != message:
+            record.msg = redacted
+            record.args = None
+        return True
+
+
+def setup(filename: Optional[str] = LOG_FILE, level: int | str = LOG_LEVEL) -> None:
+    """
+    Вешает на root один QueueHandler, а файл и консоль обслуживает QueueListener в своём потоке.
+    filename=None - только консоль (cli)
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers: list[logging.Handler] = [logging.StreamHandler()]
+    if filename:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            filename, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.setLevel(level)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # модули ставят своим логгерам DEBUG, поэтому уровень режем на хэндлере, ещё до форматирования
+    queue_handler.setLevel(level)
+    queue_handler.addFilter(RedactingFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop() -> None:
+    """дописывает всё, что осталось в очереди"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,156 @@
+"""
+Метрики в текстовом формате prometheus: гистограммы задержек и счётчики, отдаются на локальном http /metrics.
+Без prometheus_client, нам хватает пары гистограмм
+"""
+import bisect
+import contextlib
+import logging
+import math
+import re
+import time
+from typing import Callable, Iterator, Optional
+from urllib.parse import urlsplit
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9101
+# секунды; от быстрых запросов в sqlite до медленного walkr
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NUMBER_RE = re.compile(r'/\d+(?=/|$)')
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # значения лейблов -> (счётчики по корзинам + одна для +Inf, сумма)
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in sorted(self._series.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket_labels = _format_labels({**labels, 'le': _format_value(bound)})
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(total[0])}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+class CallbackMetric:
+    """значение считается в момент отдачи /metrics, например, размер кэша"""
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], float], type_: str = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.type = type_
+
+    def collect(self) -> list[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+            f'{self.name} {_format_value(self.fn())}',
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Histogram | CallbackMetric] = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.collect())
+            except Exception:
+                logger.exception('cant collect metric %s', metric.name)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def histogram(name: str, documentation: str, labelnames: tuple[str, ...] = (),
+              buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def callback_metric(name: str, documentation: str, fn: Callable[[], float], type_: str = 'gauge') -> CallbackMetric:
+    return registry.register(CallbackMetric(name, documentation, fn, type_))
+
+
+def endpoint_label(url: str) -> str:
+    """путь без id, чтобы /labs/68334/request и подобные не плодили отдельные ряды"""
+    return _NUMBER_RE.sub('/:id', urlsplit(url).path)
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        # метрики не должны мешать боту стартовать
+        logger.exception('cant start metrics server on %s:%s', host, port)
+        await runner.cleanup()
+        return None
+    logger.info('metrics are served on http://%s:%s/metrics', host, port)
+    return runner
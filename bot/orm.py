@@ -1,20 +1,99 @@
+import logging
+import time
 from datetime import datetime
 from typing import List, Type, Any, TypeVar
 
 import sqlalchemy
-from sqlalchemy import func, ForeignKey
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, Session, Query
+from sqlalchemy import event, func, delete, select, update, ForeignKey, Index, UniqueConstraint
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, joinedload, Session, Query
+from sqlalchemy.orm.attributes import set_committed_value
 
-engine = sqlalchemy.create_engine('sqlite+pysqlite:///walkr.db')
+import metrics
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
 
-# todo: переделать всё в async
+DB_PATH = 'walkr.db'
+# сколько миллисекунд соединение ждёт, пока другое допишет свою транзакцию, прежде чем упасть с database is locked
+DB_BUSY_TIMEOUT_MS = 10000
+
+# синхронный движок остаётся для cli, бот ходит в бд только через async_engine
+engine = sqlalchemy.create_engine(f'sqlite+pysqlite:///{DB_PATH}')
+async_engine = create_async_engine(f'sqlite+aiosqlite:///{DB_PATH}')
+# expire_on_commit=False: после commit объекты ещё рендерятся, а ленивые догрузки в async запрещены
+async_session_maker = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+@event.listens_for(engine, 'connect')
+@event.listens_for(async_engine.sync_engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL: чтения не ждут запись, а апдейты из разных чатов бот обрабатывает параллельно;
+    # запись в бд по-прежнему одна за раз, остальные ждут до DB_BUSY_TIMEOUT_MS
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    cursor.close()
+
+
+DB_STATEMENT_LATENCY = metrics.histogram(
+    'db_statement_duration_seconds', 'Duration of sql statements', ('statement',)
+)
+DB_SESSION_LATENCY = metrics.histogram(
+    'db_session_duration_seconds', 'Duration of orm transactions from begin to commit/rollback', ('outcome',)
+)
+DB_COMMIT_LATENCY = metrics.histogram('db_commit_duration_seconds', 'Duration of orm commits including flush')
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+@event.listens_for(async_engine.sync_engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+@event.listens_for(async_engine.sync_engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    # только SELECT/INSERT/..., иначе каждый запрос станет отдельным рядом
+    DB_STATEMENT_LATENCY.observe(time.perf_counter() - start, statement=statement.split(None, 1)[0].upper())
+
+
+# AsyncSession внутри тоже работает через Session, так что слушаем один класс
+@event.listens_for(Session, 'after_begin')
+def _after_begin(session, transaction, connection):
+    session.info['begin_start'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session):
+    session.info['commit_start'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    now = time.perf_counter()
+    if 'commit_start' in session.info:
+        DB_COMMIT_LATENCY.observe(now - session.info.pop('commit_start'))
+    if 'begin_start' in session.info:
+        DB_SESSION_LATENCY.observe(now - session.info.pop('begin_start'), outcome='commit')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('commit_start', None)
+    if 'begin_start' in session.info:
+        DB_SESSION_LATENCY.observe(time.perf_counter() - session.info.pop('begin_start'), outcome='rollback')
 
 
 def make_session():
     return Session(engine)
 
 
+def make_async_session() -> AsyncSession:
+    return async_session_maker()
+
+
 class Base(DeclarativeBase):
     pass
 
@@ -22,27 +101,70 @@ class Base(DeclarativeBase):
 T = TypeVar('T')
 
 
-def get_or_create(
-        session: Session,
+async def get_or_create(
+        session: AsyncSession,
         class_: Type[T],
         filters: dict[sqlalchemy.orm.attributes.InstrumentedAttribute, Any],
         allow_many: bool = False
 ) -> T | list[T]:
     norm_filters: dict[str, Any] = {k.key: v for k, v in filters.items()}
-    query = session.query(class_).filter_by(**norm_filters)
-    found = query.count()
-    if found == 0:
+    found = (await session.scalars(select(class_).filter_by(**norm_filters))).all()
+    if not found:
         obj = class_(**norm_filters)
         session.add(obj)
         return obj
-    elif found == 1 or not allow_many:
-        return query.one()
-
-    return query.all()
+    elif len(found) == 1:
+        return found[0]
+    elif not allow_many:
+        raise sqlalchemy.exc.MultipleResultsFound(f'{len(found)} rows of {class_.__name__} found by {norm_filters}')
+
+    return list(found)
+
+
+def dialect_insert(session: Session, class_: Type[T]):
+    """insert() нужного диалекта, чтобы был доступен ON CONFLICT"""
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise ValueError(f'no ON CONFLICT support for dialect {dialect}')
+    return insert(class_)
+
+
+def migrate(engine_: sqlalchemy.Engine) -> list[str]:
+    """
+    Доводит существующую бд до текущих моделей: создаёт недостающие таблицы и индексы.
+    Колонки не трогает. Возвращает имена созданных индексов
+    """
+    Base.metadata.create_all(engine_)
+    inspector = sqlalchemy.inspect(engine_)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(engine_)
+            except sqlalchemy.exc.IntegrityError:
+                logger.error('cant create unique index %s: table %s has duplicates, clean them up and retry',
+                             index.name, table.name)
+                continue
+            created.append(index.name)
+
+    with engine_.begin() as connection:
+        connection.exec_driver_sql('ANALYZE')
+    return created
 
 
 class Token(Base):
     __tablename__ = "token"
+    __table_args__ = (
+        Index('ix_token_user_id', 'user_id'),
+        Index('ix_token_active', 'active'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     value: Mapped[str]
@@ -67,6 +189,10 @@ class User(Base):
 
 class LabPlanet(Base):
     __tablename__ = 'lab_planet'
+    # уникальность именно индексом, а не UniqueConstraint: в sqlite индекс можно докинуть в старую бд
+    __table_args__ = (
+        Index('ix_lab_planet_user_id_planet', 'user_id', 'planet_name', 'planet_requirements', unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
@@ -80,6 +206,9 @@ class LabPlanet(Base):
 
 class LabRequest(Base):
     __tablename__ = 'lab_request'
+    __table_args__ = (
+        Index('ix_lab_request_lab_planet_id_requested_dt', 'lab_planet_id', 'requested_dt', unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     lab_planet_id: Mapped[int] = mapped_column(ForeignKey("lab_planet.id"))
@@ -92,6 +221,9 @@ class LabRequest(Base):
 
 class LabRequestProgress(Base):
     __tablename__ = 'lab_request_progress'
+    __table_args__ = (
+        Index('ix_lab_request_progress_lab_request_id_create_dt', 'lab_request_id', 'create_dt'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     lab_request_id: Mapped[int] = mapped_column(ForeignKey("lab_request.id"))
@@ -101,3 +233,73 @@ class LabRequestProgress(Base):
     donated_counter: Mapped[str]
 
     request: Mapped[LabRequest] = relationship(back_populates='progresses')
+
+
+class LabCommentCursor(Base):
+    """до какого комментария лабы мы уже дочитали"""
+    __tablename__ = 'lab_comment_cursor'
+
+    lab_id: Mapped[int] = mapped_column(primary_key=True)
+    since_id: Mapped[int] = mapped_column(default=0)
+    full_sync_dt: Mapped[datetime | None]
+    update_dt: Mapped[datetime]
+
+
+class LabOpenRequest(Base):
+    """последний запрос доната от каждого игрока лабы, собранный из комментариев"""
+    __tablename__ = 'lab_open_request'
+    __table_args__ = (UniqueConstraint('lab_id', 'user_id'),)
+
+    comment_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    lab_id: Mapped[int]
+    user_id: Mapped[int]
+    user_name: Mapped[str]
+    planet_name: Mapped[str]
+    requirements: Mapped[int]
+    total_donation: Mapped[int]
+    current_donation: Mapped[int]
+    donated_counter: Mapped[str]
+    created_at: Mapped[datetime]
+    last_requested_at: Mapped[datetime]
+
+
+class TrackedMessage(Base):
+    """последнее сообщение каждого вида в чате, которое бот обновляет сам"""
+    __tablename__ = 'tracked_message'
+    __table_args__ = (
+        Index('ix_tracked_message_chat_id_kind', 'chat_id', 'kind', unique=True),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int]
+    kind: Mapped[str]  # epic_info | lab_requests
+    message_id: Mapped[int]
+    text_hash: Mapped[str]  # хэш текста без подвала с временем обновления
+    create_dt: Mapped[datetime] = mapped_column(insert_default=func.now())
+    update_dt: Mapped[datetime]
+
+
+class ChartImage(Base):
+    """уже загруженная в телеграм картинка графика; data_hash - хэш данных, по которым она нарисована"""
+    __tablename__ = 'chart_image'
+    __table_args__ = (
+        Index('ix_chart_image_data_hash', 'data_hash', unique=True),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    data_hash: Mapped[str]
+    file_id: Mapped[str]
+    create_dt: Mapped[datetime] = mapped_column(insert_default=func.now())
+
+
+class PlayerEnergy(Base):
+    """
+    Производство энергии игроков из состава флотов, последнее увиденное; по нему bridge.py делит игроков на уровни.
+    Без связи с user: во флоте бывают игроки без токенов и без запросов в лабе
+    """
+    __tablename__ = 'player_energy'
+
+    player_id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str]
+    energy_productivity: Mapped[int]
+    update_dt: Mapped[datetime]
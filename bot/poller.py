@@ -0,0 +1,133 @@
+"""
+Фоновый опрос walkr через JobQueue: последний снимок флота и лабы лежит в bot_data,
+и команды отвечают из него, не дожидаясь сервера игры
+"""
+import asyncio
+import dataclasses
+import datetime
+import functools
+import logging
+import os
+from typing import Any, MutableMapping, Optional
+from zoneinfo import ZoneInfo
+
+from telegram.ext import ContextTypes, JobQueue
+
+import logic
+import orm
+import transport
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# как часто опрашиваем walkr в фоне, секунды
+POLL_INTERVAL = float(os.environ.get('WALKR_POLL_INTERVAL', 60))
+# снимок старше этого считаем протухшим даже для обычных команд (например, опрос сломался)
+SNAPSHOT_MAX_AGE = 3 * POLL_INTERVAL
+# кнопка "Обновить" перезапрашивает данные, только если снимок старше этого
+FORCE_REFRESH_MIN_AGE = 10
+
+FLEET_SNAPSHOT_KEY = 'fleet_snapshot'
+LAB_SNAPSHOT_KEY = 'lab_snapshot'
+
+_refresh_locks = {FLEET_SNAPSHOT_KEY: asyncio.Lock(), LAB_SNAPSHOT_KEY: asyncio.Lock()}
+
+
+@dataclasses.dataclass
+class Snapshot:
+    value: Any
+    updated_dt: datetime.datetime = dataclasses.field(
+        default_factory=lambda: datetime.datetime.now(tz=ZoneInfo('UTC'))
+    )
+    # обновить не получилось, walkr не отвечает - это последний удачный снимок
+    stale: bool = False
+
+    @property
+    def age(self) -> float:
+        return (datetime.datetime.now(tz=ZoneInfo('UTC')) - self.updated_dt).total_seconds()
+
+
+async def refresh_fleet(bot_data: MutableMapping) -> Snapshot:
+    """value снимка: все флоты, где есть игроки с токенами, id флота -> (FleetWrapper, EventWrapper)"""
+    value = await logic.get_fleets(bot_data['token_pool'], bot_data['aiohttp_session'])
+    snapshot = bot_data[FLEET_SNAPSHOT_KEY] = Snapshot(value)
+    try:
+        async with orm.make_async_session() as session:
+            await session.run_sync(logic.save_player_energy, value)
+            await session.commit()
+    except Exception:
+        # это только для bridge.py, снимок флота важнее
+        logger.exception('cant save player energy')
+    return snapshot
+
+
+async def refresh_lab(bot_data: MutableMapping, full_sync: bool = False) -> Snapshot:
+    """value снимка: список LabRequestWrapper; заодно сохраняет прогресс запросов в бд"""
+    tokens = bot_data['token_pool']
+    token = tokens.get()
+    async with orm.make_async_session() as session:
+        async with tokens.track(token):
+            lab_requests = await logic.sync_lab_requests(
+                token.value, bot_data['aiohttp_session'], session, full=full_sync
+            )
+        await session.commit()
+    # отдельной транзакцией: блокировку нельзя ждать, уже держа запись в бд, и не стоит держать её на время запроса
+    async with logic.lab_progress_lock, orm.make_async_session() as session:
+        await session.run_sync(logic._get_orm_request_progresses, lab_requests)
+        await session.commit()
+
+    snapshot = bot_data[LAB_SNAPSHOT_KEY] = Snapshot(lab_requests)
+    return snapshot
+
+
+async def _get_snapshot(bot_data: MutableMapping, key: str, refresh, max_age: Optional[float]) -> Snapshot:
+    def is_fresh(snapshot_: Optional[Snapshot]) -> bool:
+        return snapshot_ is not None and (max_age is None or snapshot_.age <= max_age)
+
+    snapshot = bot_data.get(key)
+    if is_fresh(snapshot):
+        return snapshot
+
+    async with _refresh_locks[key]:
+        # пока ждали, снимок мог обновить кто-то другой
+        snapshot = bot_data.get(key)
+        if is_fresh(snapshot):
+            return snapshot
+        try:
+            return await refresh(bot_data)
+        except Exception as e:
+            if snapshot is None or not transport.is_upstream_error(e):
+                raise
+            logger.warning('cant refresh %s, serving snapshot from %s: %r', key, snapshot.updated_dt, e)
+            return dataclasses.replace(snapshot, stale=True)
+
+
+async def get_fleet_snapshot(bot_data: MutableMapping, max_age: Optional[float] = SNAPSHOT_MAX_AGE) -> Snapshot:
+    return await _get_snapshot(bot_data, FLEET_SNAPSHOT_KEY, refresh_fleet, max_age)
+
+
+async def get_lab_snapshot(
+        bot_data: MutableMapping, max_age: Optional[float] = SNAPSHOT_MAX_AGE, full_sync: bool = False
+) -> Snapshot:
+    if full_sync:
+        return await _get_snapshot(bot_data, LAB_SNAPSHOT_KEY, functools.partial(refresh_lab, full_sync=True), 0)
+    return await _get_snapshot(bot_data, LAB_SNAPSHOT_KEY, refresh_lab, max_age)
+
+
+async def poll(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for key, refresh in ((FLEET_SNAPSHOT_KEY, refresh_fleet), (LAB_SNAPSHOT_KEY, refresh_lab)):
+        try:
+            async with _refresh_locks[key]:
+                await refresh(context.bot_data)
+        except transport.UpstreamUnavailable as e:
+            logger.warning('background refresh of %s skipped: %s', key, e)
+        except Exception:
+            # старый снимок остаётся, команды обновят его сами, когда он протухнет
+            logger.exception('background refresh of %s failed', key)
+
+
+def schedule(job_queue: Optional[JobQueue], interval: float = POLL_INTERVAL) -> None:
+    if job_queue is None:
+        logger.warning('no job queue (install python-telegram-bot[job-queue]), background polling is disabled')
+        return
+    job_queue.run_repeating(poll, interval=interval, first=0, name='walkr_poller')
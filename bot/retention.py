@@ -0,0 +1,97 @@
+"""
+Хранение истории прогресса лабы: свежие записи храним все, старые прореживаем до часовых, а совсем старые
+до дневных точек (в каждом интервале остаётся последняя запись запроса), потом ANALYZE и при нужде VACUUM.
+Запускается из cli.py --db_retention и раз в сутки из бота
+"""
+import asyncio
+import datetime
+import logging
+from dataclasses import dataclass, field
+
+import sqlalchemy
+from telegram.ext import ContextTypes
+
+import orm
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# до этого возраста храним все записи
+KEEP_RAW = datetime.timedelta(days=7)
+# до этого - по одной в час, дальше - по одной в сутки
+KEEP_HOURLY = datetime.timedelta(days=30)
+# как часто бот прореживает историю
+RETENTION_INTERVAL = 24 * 3600
+# VACUUM переписывает всю бд, поэтому делаем его, только если свободных страниц стало больше этой доли
+VACUUM_FREE_RATIO = 0.2
+
+
+@dataclass
+class RetentionReport:
+    deleted: dict[str, int] = field(default_factory=dict)
+    vacuumed: bool = False
+
+
+def _bucket(dialect: str, column, unit: str):
+    """выражение, одинаковое для всех моментов внутри одного часа/дня"""
+    if dialect == 'sqlite':
+        return sqlalchemy.func.strftime({'hour': '%Y-%m-%d %H', 'day': '%Y-%m-%d'}[unit], column)
+    if dialect == 'postgresql':
+        return sqlalchemy.func.date_trunc(unit, column)
+    raise ValueError(f'no downsampling support for dialect {dialect}')
+
+
+def downsample(
+        connection: sqlalchemy.Connection, unit: str, newer_than: datetime.datetime | None,
+        older_than: datetime.datetime,
+) -> int:
+    """оставляет в [newer_than, older_than) последнюю запись каждого запроса в каждом часе/дне"""
+    progress = orm.LabRequestProgress
+    period = [progress.create_dt < older_than]
+    if newer_than is not None:
+        period.append(progress.create_dt >= newer_than)
+
+    keep = (
+        sqlalchemy.select(sqlalchemy.func.max(progress.id))
+        .where(*period)
+        .group_by(progress.lab_request_id, _bucket(connection.dialect.name, progress.create_dt, unit))
+    )
+    result = connection.execute(sqlalchemy.delete(progress).where(*period, progress.id.not_in(keep)))
+    return result.rowcount
+
+
+def _free_ratio(connection: sqlalchemy.Connection) -> float:
+    page_count = connection.exec_driver_sql('PRAGMA page_count').scalar()
+    freelist_count = connection.exec_driver_sql('PRAGMA freelist_count').scalar()
+    return freelist_count / page_count if page_count else 0.0
+
+
+def run(
+        engine: sqlalchemy.Engine, now: datetime.datetime | None = None, vacuum: bool | None = None
+) -> RetentionReport:
+    """
+    vacuum: True - всегда, False - никогда, None - если свободного места больше VACUUM_FREE_RATIO
+    """
+    # create_dt пишется через func.now(), то есть в utc без таймзоны
+    now = now or datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    report = RetentionReport()
+    with engine.begin() as connection:
+        report.deleted['hourly'] = downsample(connection, 'hour', now - KEEP_HOURLY, now - KEEP_RAW)
+        report.deleted['daily'] = downsample(connection, 'day', None, now - KEEP_HOURLY)
+        connection.exec_driver_sql('ANALYZE')
+        if engine.dialect.name == 'sqlite' and vacuum is None:
+            vacuum = _free_ratio(connection) > VACUUM_FREE_RATIO
+
+    if vacuum and engine.dialect.name == 'sqlite':
+        # VACUUM не работает внутри транзакции
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql('VACUUM')
+        report.vacuumed = True
+
+    logger.info('retention: deleted %s progress rows, vacuum=%s', report.deleted, report.vacuumed)
+    return report
+
+
+async def retention_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # бот живёт на async_engine, а тут синхронный движок - уводим в поток, чтобы не держать event loop
+    await asyncio.to_thread(run, orm.engine)
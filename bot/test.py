@@ -1,16 +1,988 @@
-from api import FleetsApiAnswerSchema
+import asyncio
+import csv
+import datetime
+import io
+import json
+from pathlib import Path
+
+import aiohttp
+import sqlalchemy
+from aiohttp import web
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import api
+import bridge
+import charts
+import chat_updates
+import cli
+import decoders
+import export
+import fake_server
+import logic
+import logs
+import metrics
+import orm
+import poller
+import retention
+import token_pool
+import transport
+from api import FleetsApiAnswerSchema, ResponseCache
 import pytest
 
 
-@pytest.mark.parametrize(
-    'api_answer_example',
-    (
-        '{"success": true, "fleet": null, "now": 1667901025}',
-        '{"success": true, "fleet": {"id": 8744947, "name": "Happy new year", "country_code": "KZ", "privacy": "private", "is_invitable": true, "members_count": 3, "players_count": 3, "members_max": 8, "members_min": 3, "weight": 76.0, "invited": false, "created_at": 1672545408, "started_at": 1672665797, "event_status": "event", "contribution_amount": 8125000, "energy": 0, "consumed_energy": 18000, "last_consumed_at": 1672665797, "value_a": 900000, "value_b": 1250, "value_c": 0, "badge_front": "http://cargoship.walkrgame.com/fleet_badges/front-2.png", "badge_back": "http://cargoship.walkrgame.com/fleet_badges/back-7.png", "epic": {"id": 15, "icon": "http://cargoship.walkrgame.com/uploads/epic/icon/15/e917195cbc67ffb49009.jpg", "cover": "http://cargoship.walkrgame.com/uploads/epic/cover/15/e917195cbc67ffb49009.jpg", "name": "A Bistro Showdown"}, "captain": {"name": "Nathalie Popova", "avatar": "https://toycar.fourdesire.com/uploads/user/avatar_file/1935777/b60cb8b447d220dd1c0b.jpg"}}, "event_status": "event", "event": {"id": 182, "epic_id": 15, "cover": {"url": "http://cargoship.walkrgame.com/uploads/epic_event/cover/182/5919019eb876bc7385ac.jpg"}, "event_type": "currency", "resource_a": 900000, "resource_b": 5000, "resource_c": null, "created_at": "2016-08-17 08:56:30", "updated_at": "2016-08-18 06:18:29", "attachment": null, "name": "An invitation from the desert bandits", "description": "Never expected to be respected by the desert bandits", "label_a": null, "label_b": null, "label_c": null}, "path": {"id": 163, "epic_event_id": 182, "target_id": 185, "time": 3, "required_energy": 18000, "created_at": "2016-08-17 09:36:50", "updated_at": "2016-08-17 09:36:50"}, "members": [{"id": 271306, "name": "Andrew Popov", "avatar": "https://toycar.fourdesire.com/uploads/user/avatar_file/1935781/e33fb437db767c09be7c.jpg", "level": 40, "planets_count": 100, "replicators_count": 41, "energy_productivity": 28980, "population": 1191, "spaceship": "flash-pink", "contribution": 3436756, "title": "member", "role": "sportsman", "rsvp": "ready"}, {"id": 2100453, "name": "Maria Subbotina", "avatar": "", "level": 27, "planets_count": 62, "replicators_count": 16, "energy_productivity": 678, "population": 599, "spaceship": "walkr-baby", "contribution": 2543893, "title": "member", "role": "banker", "rsvp": "ready"}, {"id": 1599163, "name": "Nathalie Popova", "avatar": "https://toycar.fourdesire.com/uploads/user/avatar_file/1935777/b60cb8b447d220dd1c0b.jpg", "level": 25, "planets_count": 67, "replicators_count": 26, "energy_productivity": 10328, "population": 721, "spaceship": "walkr-baby", "contribution": 2144351, "title": "captain", "role": "sportsman", "rsvp": "ready"}], "fleet_histories": [{"id": 167, "name": "Create a space fleet", "description": "A good beginning is half way to success", "cover": "http://cargoship.walkrgame.com/uploads/epic_event/cover/167/813efa26332f50d6344f.jpg", "event_type": "preparation", "attachment": null, "label_a": null, "label_b": null, "label_c": null, "value_a": 1000000, "value_b": 100000, "value_c": 0, "solved_at": 1672577413}, {"id": 178, "name": "Travel to Gold Rush Town on business", "description": "It has been a while since you have taken a journey", "cover": "http://cargoship.walkrgame.com/uploads/epic_event/cover/178/d3f19ba6978991e3b2ad.jpg", "event_type": "virtual-coins", "attachment": "https://s3-ap-northeast-1.amazonaws.com/spacewalk-server-production/fleet_avatars/sw-fleet-ticket@2x.png", "label_a": "Travel ticket", "label_b": null, "label_c": null, "value_a": 108, "value_b": 0, "value_c": 0, "solved_at": 1672592546}, {"id": 179, "name": "Encounter bandits in the middle of your journey", "description": "Counterattack or mount a resistance?", "cover": "http://cargoship.walkrgame.com/uploads/epic_event/cover/179/0a07869a530ad19adb9b.jpg", "event_type": "voting", "attachment": null, "label_a": "Bribe", "label_b": "Resist", "label_c": null, "value_a": 2, "value_b": 1, "value_c": 0, "solved_at": 1672607733}, {"id": 180, "name": "Settle the matter with money", "description": "Trivial problems can be resolved with money", "cover": "http://cargoship.walkrgame.com/uploads/epic_event/cover/180/d7b43c67b0ad0c10b56a.jpg", "event_type": "currency", "attachment": null, "label_a": null, "label_b": null, "label_c": null, "value_a": 1200000, "value_b": 0, "value_c": 0, "solved_at": 1672654157}], "hitpoints": {"value_a": 675000, "value_b": 0, "value_c": 0, "hitpoints": 1, "next_hitpoint_at": 1672674135, "next_hitpoint_countdown": 52}, "now": 1672674083}',
-        '{"success":true,"fleet":{"id":8751634,"name":"Clower","country_code":"KZ","privacy":"private","is_invitable":true,"members_count":3,"players_count":3,"members_max":8,"members_min":3,"weight":77.0,"invited":false,"created_at":1672873965,"started_at":1673091868,"event_status":"path","contribution_amount":10160000,"energy":0,"consumed_energy":9000,"last_consumed_at":1673097446,"value_a":20000,"value_b":24000,"value_c":0,"badge_front":"http://cargoship.walkrgame.com/fleet_badges/front-5.png","badge_back":"http://cargoship.walkrgame.com/fleet_badges/back-19.png","epic":{"id":15,"icon":"http://cargoship.walkrgame.com/uploads/epic/icon/15/e917195cbc67ffb49009.jpg","cover":"http://cargoship.walkrgame.com/uploads/epic/cover/15/e917195cbc67ffb49009.jpg","name":"A Bistro Showdown"},"captain":{"name":"Nathalie Popova","avatar":"https://toycar.fourdesire.com/uploads/user/avatar_file/1935777/b60cb8b447d220dd1c0b.jpg"}},"event_status":"path","event":{"id":185,"epic_id":15,"cover":{"url":"http://cargoship.walkrgame.com/uploads/epic_event/cover/185/7034e0729ad93010e5f9.jpg"},"event_type":"resources","resource_a":20000,"resource_b":24000,"resource_c":null,"created_at":"2016-08-17 08:57:19","updated_at":"2016-08-18 06:20:09","attachment":null,"name":"A party to celebrate the successful theft of the world\'s treasures","description":"Let loose and have fun!","label_a":null,"label_b":null,"label_c":null},"path":{"id":165,"epic_event_id":185,"target_id":188,"time":3,"required_energy":18000,"created_at":"2016-08-17 09:37:19","updated_at":"2016-08-17 09:37:19"},"members":[{"id":271306,"name":"Andrew Popov","avatar":"https://toycar.fourdesire.com/uploads/user/avatar_file/1935781/f81f6e1e77e17a48f6c4.jpg","level":40,"planets_count":101,"replicators_count":41,"energy_productivity":15612,"population":1222,"spaceship":"flash-pink","contribution":3591520,"title":"member","role":"sportsman","rsvp":"ready"},{"id":2100453,"name":"Maria Subbotina","avatar":"","level":27,"planets_count":63,"replicators_count":16,"energy_productivity":1283,"population":605,"spaceship":"walkr-baby","contribution":3563480,"title":"member","role":"banker","rsvp":"ready"},{"id":1599163,"name":"Nathalie Popova","avatar":"https://toycar.fourdesire.com/uploads/user/avatar_file/1935777/b60cb8b447d220dd1c0b.jpg","level":25,"planets_count":68,"replicators_count":26,"energy_productivity":5011,"population":781,"spaceship":"walkr-baby","contribution":3005000,"title":"captain","role":"cook","rsvp":"ready"}],"fleet_histories":[{"id":167,"name":"Create a space fleet","description":"A good beginning is half way to success","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/167/813efa26332f50d6344f.jpg","event_type":"preparation","attachment":null,"label_a":null,"label_b":null,"label_c":null,"value_a":1000000,"value_b":100000,"value_c":0,"solved_at":1672924785},{"id":178,"name":"Travel to Gold Rush Town on business","description":"It has been a while since you have taken a journey","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/178/d3f19ba6978991e3b2ad.jpg","event_type":"virtual-coins","attachment":"https://s3-ap-northeast-1.amazonaws.com/spacewalk-server-production/fleet_avatars/sw-fleet-ticket@2x.png","label_a":"Travel ticket","label_b":null,"label_c":null,"value_a":108,"value_b":0,"value_c":0,"solved_at":1672936641},{"id":179,"name":"Encounter bandits in the middle of your journey","description":"Counterattack or mount a resistance?","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/179/0a07869a530ad19adb9b.jpg","event_type":"voting","attachment":null,"label_a":"Bribe","label_b":"Resist","label_c":null,"value_a":2,"value_b":0,"value_c":0,"solved_at":1672955233},{"id":180,"name":"Settle the matter with money","description":"Trivial problems can be resolved with money","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/180/d7b43c67b0ad0c10b56a.jpg","event_type":"currency","attachment":null,"label_a":null,"label_b":null,"label_c":null,"value_a":1200000,"value_b":0,"value_c":0,"solved_at":1673023984},{"id":182,"name":"An invitation from the desert bandits","description":"Never expected to be respected by the desert bandits","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/182/5919019eb876bc7385ac.jpg","event_type":"currency","attachment":null,"label_a":null,"label_b":null,"label_c":null,"value_a":900000,"value_b":5000,"value_c":0,"solved_at":1673051366},{"id":185,"name":"A party to celebrate the successful theft of the world\'s treasures","description":"Let loose and have fun!","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/185/7034e0729ad93010e5f9.jpg","event_type":"resources","attachment":null,"label_a":null,"label_b":null,"label_c":null,"value_a":20000,"value_b":24000,"value_c":0,"solved_at":1673091867}],"hitpoints":{"value_a":0,"value_b":0,"value_c":0,"hitpoints":3,"next_hitpoint_at":0,"next_hitpoint_countdown":null},"now":1673113822}',
-    )
+FLEETS_API_ANSWERS = (
+    '{"success": true, "fleet": null, "now": 1667901025}',
+    '{"success": true, "fleet": {"id": 8744947, "name": "Happy new year", "country_code": "KZ", "privacy": "private", "is_invitable": true, "members_count": 3, "players_count": 3, "members_max": 8, "members_min": 3, "weight": 76.0, "invited": false, "created_at": 1672545408, "started_at": 1672665797, "event_status": "event", "contribution_amount": 8125000, "energy": 0, "consumed_energy": 18000, "last_consumed_at": 1672665797, "value_a": 900000, "value_b": 1250, "value_c": 0, "badge_front": "http://cargoship.walkrgame.com/fleet_badges/front-2.png", "badge_back": "http://cargoship.walkrgame.com/fleet_badges/back-7.png", "epic": {"id": 15, "icon": "http://cargoship.walkrgame.com/uploads/epic/icon/15/e917195cbc67ffb49009.jpg", "cover": "http://cargoship.walkrgame.com/uploads/epic/cover/15/e917195cbc67ffb49009.jpg", "name": "A Bistro Showdown"}, "captain": {"name": "Nathalie Popova", "avatar": "https://toycar.fourdesire.com/uploads/user/avatar_file/1935777/b60cb8b447d220dd1c0b.jpg"}}, "event_status": "event", "event": {"id": 182, "epic_id": 15, "cover": {"url": "http://cargoship.walkrgame.com/uploads/epic_event/cover/182/5919019eb876bc7385ac.jpg"}, "event_type": "currency", "resource_a": 900000, "resource_b": 5000, "resource_c": null, "created_at": "2016-08-17 08:56:30", "updated_at": "2016-08-18 06:18:29", "attachment": null, "name": "An invitation from the desert bandits", "description": "Never expected to be respected by the desert bandits", "label_a": null, "label_b": null, "label_c": null}, "path": {"id": 163, "epic_event_id": 182, "target_id": 185, "time": 3, "required_energy": 18000, "created_at": "2016-08-17 09:36:50", "updated_at": "2016-08-17 09:36:50"}, "members": [{"id": 271306, "name": "Andrew Popov", "avatar": "https://toycar.fourdesire.com/uploads/user/avatar_file/1935781/e33fb437db767c09be7c.jpg", "level": 40, "planets_count": 100, "replicators_count": 41, "energy_productivity": 28980, "population": 1191, "spaceship": "flash-pink", "contribution": 3436756, "title": "member", "role": "sportsman", "rsvp": "ready"}, {"id": 2100453, "name": "Maria Subbotina", "avatar": "", "level": 27, "planets_count": 62, "replicators_count": 16, "energy_productivity": 678, "population": 599, "spaceship": "walkr-baby", "contribution": 2543893, "title": "member", "role": "banker", "rsvp": "ready"}, {"id": 1599163, "name": "Nathalie Popova", "avatar": "https://toycar.fourdesire.com/uploads/user/avatar_file/1935777/b60cb8b447d220dd1c0b.jpg", "level": 25, "planets_count": 67, "replicators_count": 26, "energy_productivity": 10328, "population": 721, "spaceship": "walkr-baby", "contribution": 2144351, "title": "captain", "role": "sportsman", "rsvp": "ready"}], "fleet_histories": [{"id": 167, "name": "Create a space fleet", "description": "A good beginning is half way to success", "cover": "http://cargoship.walkrgame.com/uploads/epic_event/cover/167/813efa26332f50d6344f.jpg", "event_type": "preparation", "attachment": null, "label_a": null, "label_b": null, "label_c": null, "value_a": 1000000, "value_b": 100000, "value_c": 0, "solved_at": 1672577413}, {"id": 178, "name": "Travel to Gold Rush Town on business", "description": "It has been a while since you have taken a journey", "cover": "http://cargoship.walkrgame.com/uploads/epic_event/cover/178/d3f19ba6978991e3b2ad.jpg", "event_type": "virtual-coins", "attachment": "https://s3-ap-northeast-1.amazonaws.com/spacewalk-server-production/fleet_avatars/sw-fleet-ticket@2x.png", "label_a": "Travel ticket", "label_b": null, "label_c": null, "value_a": 108, "value_b": 0, "value_c": 0, "solved_at": 1672592546}, {"id": 179, "name": "Encounter bandits in the middle of your journey", "description": "Counterattack or mount a resistance?", "cover": "http://cargoship.walkrgame.com/uploads/epic_event/cover/179/0a07869a530ad19adb9b.jpg", "event_type": "voting", "attachment": null, "label_a": "Bribe", "label_b": "Resist", "label_c": null, "value_a": 2, "value_b": 1, "value_c": 0, "solved_at": 1672607733}, {"id": 180, "name": "Settle the matter with money", "description": "Trivial problems can be resolved with money", "cover": "http://cargoship.walkrgame.com/uploads/epic_event/cover/180/d7b43c67b0ad0c10b56a.jpg", "event_type": "currency", "attachment": null, "label_a": null, "label_b": null, "label_c": null, "value_a": 1200000, "value_b": 0, "value_c": 0, "solved_at": 1672654157}], "hitpoints": {"value_a": 675000, "value_b": 0, "value_c": 0, "hitpoints": 1, "next_hitpoint_at": 1672674135, "next_hitpoint_countdown": 52}, "now": 1672674083}',
+    '{"success":true,"fleet":{"id":8751634,"name":"Clower","country_code":"KZ","privacy":"private","is_invitable":true,"members_count":3,"players_count":3,"members_max":8,"members_min":3,"weight":77.0,"invited":false,"created_at":1672873965,"started_at":1673091868,"event_status":"path","contribution_amount":10160000,"energy":0,"consumed_energy":9000,"last_consumed_at":1673097446,"value_a":20000,"value_b":24000,"value_c":0,"badge_front":"http://cargoship.walkrgame.com/fleet_badges/front-5.png","badge_back":"http://cargoship.walkrgame.com/fleet_badges/back-19.png","epic":{"id":15,"icon":"http://cargoship.walkrgame.com/uploads/epic/icon/15/e917195cbc67ffb49009.jpg","cover":"http://cargoship.walkrgame.com/uploads/epic/cover/15/e917195cbc67ffb49009.jpg","name":"A Bistro Showdown"},"captain":{"name":"Nathalie Popova","avatar":"https://toycar.fourdesire.com/uploads/user/avatar_file/1935777/b60cb8b447d220dd1c0b.jpg"}},"event_status":"path","event":{"id":185,"epic_id":15,"cover":{"url":"http://cargoship.walkrgame.com/uploads/epic_event/cover/185/7034e0729ad93010e5f9.jpg"},"event_type":"resources","resource_a":20000,"resource_b":24000,"resource_c":null,"created_at":"2016-08-17 08:57:19","updated_at":"2016-08-18 06:20:09","attachment":null,"name":"A party to celebrate the successful theft of the world\'s treasures","description":"Let loose and have fun!","label_a":null,"label_b":null,"label_c":null},"path":{"id":165,"epic_event_id":185,"target_id":188,"time":3,"required_energy":18000,"created_at":"2016-08-17 09:37:19","updated_at":"2016-08-17 09:37:19"},"members":[{"id":271306,"name":"Andrew Popov","avatar":"https://toycar.fourdesire.com/uploads/user/avatar_file/1935781/f81f6e1e77e17a48f6c4.jpg","level":40,"planets_count":101,"replicators_count":41,"energy_productivity":15612,"population":1222,"spaceship":"flash-pink","contribution":3591520,"title":"member","role":"sportsman","rsvp":"ready"},{"id":2100453,"name":"Maria Subbotina","avatar":"","level":27,"planets_count":63,"replicators_count":16,"energy_productivity":1283,"population":605,"spaceship":"walkr-baby","contribution":3563480,"title":"member","role":"banker","rsvp":"ready"},{"id":1599163,"name":"Nathalie Popova","avatar":"https://toycar.fourdesire.com/uploads/user/avatar_file/1935777/b60cb8b447d220dd1c0b.jpg","level":25,"planets_count":68,"replicators_count":26,"energy_productivity":5011,"population":781,"spaceship":"walkr-baby","contribution":3005000,"title":"captain","role":"cook","rsvp":"ready"}],"fleet_histories":[{"id":167,"name":"Create a space fleet","description":"A good beginning is half way to success","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/167/813efa26332f50d6344f.jpg","event_type":"preparation","attachment":null,"label_a":null,"label_b":null,"label_c":null,"value_a":1000000,"value_b":100000,"value_c":0,"solved_at":1672924785},{"id":178,"name":"Travel to Gold Rush Town on business","description":"It has been a while since you have taken a journey","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/178/d3f19ba6978991e3b2ad.jpg","event_type":"virtual-coins","attachment":"https://s3-ap-northeast-1.amazonaws.com/spacewalk-server-production/fleet_avatars/sw-fleet-ticket@2x.png","label_a":"Travel ticket","label_b":null,"label_c":null,"value_a":108,"value_b":0,"value_c":0,"solved_at":1672936641},{"id":179,"name":"Encounter bandits in the middle of your journey","description":"Counterattack or mount a resistance?","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/179/0a07869a530ad19adb9b.jpg","event_type":"voting","attachment":null,"label_a":"Bribe","label_b":"Resist","label_c":null,"value_a":2,"value_b":0,"value_c":0,"solved_at":1672955233},{"id":180,"name":"Settle the matter with money","description":"Trivial problems can be resolved with money","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/180/d7b43c67b0ad0c10b56a.jpg","event_type":"currency","attachment":null,"label_a":null,"label_b":null,"label_c":null,"value_a":1200000,"value_b":0,"value_c":0,"solved_at":1673023984},{"id":182,"name":"An invitation from the desert bandits","description":"Never expected to be respected by the desert bandits","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/182/5919019eb876bc7385ac.jpg","event_type":"currency","attachment":null,"label_a":null,"label_b":null,"label_c":null,"value_a":900000,"value_b":5000,"value_c":0,"solved_at":1673051366},{"id":185,"name":"A party to celebrate the successful theft of the world\'s treasures","description":"Let loose and have fun!","cover":"http://cargoship.walkrgame.com/uploads/epic_event/cover/185/7034e0729ad93010e5f9.jpg","event_type":"resources","attachment":null,"label_a":null,"label_b":null,"label_c":null,"value_a":20000,"value_b":24000,"value_c":0,"solved_at":1673091867}],"hitpoints":{"value_a":0,"value_b":0,"value_c":0,"hitpoints":3,"next_hitpoint_at":0,"next_hitpoint_countdown":null},"now":1673113822}',
 )
+
+COMMENTS_API_ANSWER = (
+    '{"success": true, "comments": ['
+    '{"id": 101, "comment": {"type": "sticker", "text": "hi"}, "created_at": 1672674083, "blocked": false, '
+    '"user": {"id": 271306, "name": "Andrew Popov"}, "raw_comment": ""}, '
+    '{"id": 102, "comment": {"type": "donation", "donation_type": "energy", "donation_value": 500, '
+    '"max_donation_count": 5, "colony_type": "planet", "identifier": "aurora", "requirements": 30000, '
+    '"total_donation": 1500, "current_donation": 1000, "donated_counter": "271306|500+500", '
+    '"last_requested_at": 1672674000}, "created_at": 1672674083, "blocked": false, '
+    '"user": {"id": 1599163, "name": "Nathalie Popova", "level": 25}, "raw_comment": ""}'
+    '], "now": 1672674090}'
+)
+
+
+@pytest.mark.parametrize('api_answer_example', FLEETS_API_ANSWERS)
 def test_fleets_api_answer_schema(api_answer_example):
     parsed = FleetsApiAnswerSchema().loads(api_answer_example)
     assert 1 == 1
 
+
+@pytest.mark.parametrize('api_answer_example', FLEETS_API_ANSWERS)
+def test_fast_fleet_decoding_matches_schema(api_answer_example):
+    strict = FleetsApiAnswerSchema().loads(api_answer_example)
+    fast = json.loads(api_answer_example)
+    assert api.FleetWrapper.from_api_answer(fast) == api.FleetWrapper.from_api_answer(strict)
+    if strict['fleet']:
+        assert api.EventWrapper.from_api_answer(fast) == api.EventWrapper.from_api_answer(strict)
+
+
+def test_fast_comments_decoding_matches_schema():
+    strict = [
+        api._lab_request_from_schema(c)
+        for c in api.CommentsAnswerSchema().loads(COMMENTS_API_ANSWER)['comments']
+        if c['comment']['type'] == 'donation'
+    ]
+    fast = [
+        api._decode_lab_request(c)
+        for c in json.loads(COMMENTS_API_ANSWER)['comments']
+        if c['comment']['type'] == 'donation'
+    ]
+    assert fast == strict
+    assert fast[0].comment_id == 102
+    assert fast[0].last_requested_at == datetime.datetime(2023, 1, 2, 15, 40)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_streaming_comments_match_full_parse(chunk_size):
+    async def chunks():
+        for i in range(0, len(COMMENTS_API_ANSWER), chunk_size):
+            yield COMMENTS_API_ANSWER[i:i + chunk_size]
+
+    async def broken():
+        yield COMMENTS_API_ANSWER[:len(COMMENTS_API_ANSWER) // 2]
+
+    async def collect(source):
+        return [c async for c in decoders.iter_array_items(source, 'comments')]
+
+    assert asyncio.run(collect(chunks())) == json.loads(COMMENTS_API_ANSWER)['comments']
+    with pytest.raises(ValueError):
+        asyncio.run(collect(broken()))
+
+
+def test_response_cache_coalesces_and_caches():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return 'answer'
+
+    async def scenario():
+        cache = ResponseCache(ttl=60)
+        results = await asyncio.gather(*(cache.get_or_fetch('key', fetch) for _ in range(5)))
+        results.append(await cache.get_or_fetch('key', fetch))
+        return cache, results
+
+    cache, results = asyncio.run(scenario())
+    assert results == ['answer'] * 6
+    assert calls == 1
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['coalesced'] == 4
+    assert cache.stats()['hits'] == 1
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / 'walkr.db'
+    engine = sqlalchemy.create_engine(f'sqlite+pysqlite:///{path}')
+    orm.Base.metadata.create_all(engine)
+    engine.dispose()
+    return path
+
+
+@pytest.fixture
+def db_session(db_path):
+    engine = sqlalchemy.create_engine(f'sqlite+pysqlite:///{db_path}')
+    with orm.Session(engine) as session:
+        yield session
+    engine.dispose()
+
+
+def run_with_async_session(db_path, coro_fn):
+    async def scenario():
+        engine = create_async_engine(f'sqlite+aiosqlite:///{db_path}')
+        try:
+            async with orm.AsyncSession(engine, expire_on_commit=False) as session:
+                result = await coro_fn(session)
+                await session.commit()
+                return result
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(scenario())
+
+
+def _token_pool(user_ids) -> token_pool.TokenPool:
+    return token_pool.TokenPool(
+        token_pool.TokenState(
+            user_id=user_id, user_name=f'user{user_id}', value=f'token{user_id}',
+            expired_dt=datetime.datetime(2030, 1, 1),
+        )
+        for user_id in user_ids
+    )
+
+
+def test_make_lab_requests_isolates_errors(monkeypatch):
+    tokens = _token_pool(range(1, 5))
+
+    running = 0
+    max_running = 0
+    requested = []
+
+    async def get_user_request(auth_token, session):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if auth_token == 'token2':
+            raise ValueError('response code is 401')
+        return api.LabRequestWrapper(
+            created_at=None, user_id=None, user_name=None, planet_name='p', requirements=100,
+            total_donation=100 if auth_token == 'token3' else 0, current_donation=0,
+            last_requested_at=datetime.datetime(2020, 1, 1), donated_counter='',
+        )
+
+    async def make_lab_request(auth_token, session):
+        requested.append(auth_token)
+
+    monkeypatch.setattr(api, 'get_user_request', get_user_request)
+    monkeypatch.setattr(api, 'make_lab_request', make_lab_request)
+
+    attempts = asyncio.run(logic.make_lab_requests(None, tokens, concurrency=2))
+    assert [(a.user_name, a.status) for a in attempts] == [
+        ('user1', 'requested'), ('user2', 'error'), ('user3', 'skipped'), ('user4', 'requested'),
+    ]
+    assert sorted(requested) == ['token1', 'token4']
+    assert max_running == 2
+    assert [t.user_name for t in tokens.healthy()] == ['user1', 'user2', 'user3', 'user4']
+
+    for _ in range(token_pool.MAX_FAILURES - 1):
+        asyncio.run(logic.make_lab_requests(None, tokens))
+    assert [t.user_name for t in tokens.healthy()] == ['user1', 'user3', 'user4']
+    assert 'response code is 401' in tokens._tokens['token2'].last_error
+
+
+def _with_test_db(monkeypatch, db_path, coro_fn):
+    """coro_fn() ходит в бд через orm.make_async_session, как бот"""
+    async def scenario():
+        engine = create_async_engine(f'sqlite+aiosqlite:///{db_path}')
+        monkeypatch.setattr(orm, 'make_async_session', lambda: orm.AsyncSession(engine, expire_on_commit=False))
+        try:
+            return await coro_fn()
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(scenario())
+
+
+def _add_tokens(db_path, user_ids, expired_dt=datetime.datetime(2030, 1, 1)):
+    engine = sqlalchemy.create_engine(f'sqlite+pysqlite:///{db_path}')
+    with orm.Session(engine) as session:
+        for user_id in user_ids:
+            session.add(orm.Token(
+                user=orm.User(id=user_id, name=f'user{user_id}'), value=f'token{user_id}', active=True,
+                update_dt=datetime.datetime.now(), expired_dt=expired_dt,
+            ))
+        session.commit()
+    engine.dispose()
+
+
+def test_invalid_token_is_deactivated_but_outage_is_not_counted(monkeypatch, db_path):
+    _add_tokens(db_path, [1, 2])
+
+    async def get_user_request(auth_token, session):
+        if auth_token == 'token1':
+            raise transport.InvalidToken('response code is 401', 401)
+        raise transport.ApiError('response code is not 200: 503', 503)
+
+    monkeypatch.setattr(api, 'get_user_request', get_user_request)
+
+    async def scenario():
+        tokens = token_pool.TokenPool()
+        await tokens.reload()
+        for _ in range(token_pool.MAX_FAILURES):
+            await logic.make_lab_requests(None, tokens)
+        async with orm.make_async_session() as session:
+            active = dict((await session.execute(orm.select(orm.Token.value, orm.Token.active))).all())
+        return tokens, active
+
+    tokens, active = _with_test_db(monkeypatch, db_path, scenario)
+    assert active == {'token1': False, 'token2': True}
+    assert [(t.value, t.failures) for t in tokens.healthy()] == [('token2', 0)]
+
+
+def test_refresh_expiring_extends_tokens_through_api(monkeypatch, db_path):
+    soon = datetime.datetime.now() + datetime.timedelta(hours=1)
+    _add_tokens(db_path, [1], expired_dt=soon)
+
+    async def scenario():
+        fake = fake_server.FakeWalkr(fake_server.FakeConfig(fixtures_dir=Path('/nonexistent')))
+        runner = web.AppRunner(fake.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        monkeypatch.setattr(api, 'API_BASE_URL', f'http://127.0.0.1:{runner.addresses[0][1]}/api/v2')
+        try:
+            tokens = token_pool.TokenPool()
+            await tokens.reload()
+            async with aiohttp.ClientSession() as session:
+                await tokens.refresh_expiring(session)
+            async with orm.make_async_session() as session:
+                return tokens, await session.scalar(orm.select(orm.Token.expired_dt))
+        finally:
+            await runner.cleanup()
+
+    tokens, saved = _with_test_db(monkeypatch, db_path, scenario)
+    extended = tokens.healthy()[0].expired_dt
+    assert extended - datetime.datetime.now() > datetime.timedelta(days=29)
+    assert saved == extended
+
+
+def _lab_request(comment_id: int, user_id: int, total_donation: int = 0) -> api.LabRequestWrapper:
+    now = datetime.datetime.utcnow()
+    return api.LabRequestWrapper(
+        created_at=now, user_id=user_id, user_name=f'user{user_id}', planet_name='p', requirements=100,
+        total_donation=total_donation, current_donation=total_donation, last_requested_at=now,
+        donated_counter='', comment_id=comment_id,
+    )
+
+
+def test_sync_lab_requests_is_incremental(db_path, monkeypatch):
+    pages = {
+        0: api.LabCommentsPage([_lab_request(10, 1), _lab_request(11, 2)], comments_count=50, max_comment_id=12),
+        # открытые запросы перечитываются с самого старого из них
+        9: api.LabCommentsPage(
+            [_lab_request(10, 1), _lab_request(11, 2), _lab_request(13, 1, total_donation=50)],
+            comments_count=5, max_comment_id=15,
+        ),
+        # тот же комментарий 11, но в него уже донатили
+        10: api.LabCommentsPage(
+            [_lab_request(11, 2, total_donation=70), _lab_request(13, 1, total_donation=50)],
+            comments_count=4, max_comment_id=15,
+        ),
+    }
+    calls = []
+
+    async def get_lab_comments(auth_token, session, since_id=0, limit=3000):
+        calls.append(since_id)
+        return pages[since_id]
+
+    monkeypatch.setattr(api, 'get_lab_comments', get_lab_comments)
+
+    def sync(session):
+        return logic.sync_lab_requests('token', None, session)
+
+    first = run_with_async_session(db_path, sync)
+    assert [(r.comment_id, r.user_id) for r in first] == [(10, 1), (11, 2)]
+
+    second = run_with_async_session(db_path, sync)
+    assert [(r.comment_id, r.user_id, r.total_donation) for r in second] == [(11, 2, 0), (13, 1, 50)]
+    assert calls == [0, 9]
+    cursor = run_with_async_session(db_path, lambda s: s.get(orm.LabCommentCursor, api.LAB_ID))
+    assert cursor.since_id == 15
+
+    third = run_with_async_session(db_path, sync)
+    assert [(r.comment_id, r.total_donation) for r in third] == [(11, 70), (13, 50)]
+    assert calls == [0, 9, 10]
+
+    # больше страницы новых комментариев - дочитываем следующими страницами, а не перечитываем всё
+    limit = logic.LAB_COMMENTS_INCREMENTAL_LIMIT
+    pages[10] = api.LabCommentsPage([_lab_request(11, 2, total_donation=70)], comments_count=limit,
+                                    max_comment_id=10 + limit)
+    pages[10 + limit] = api.LabCommentsPage([_lab_request(20 + limit, 3)], comments_count=1,
+                                            max_comment_id=20 + limit)
+    fourth = run_with_async_session(db_path, sync)
+    assert [r.comment_id for r in fourth] == [11, 13, 20 + limit]
+    assert calls == [0, 9, 10, 10, 10 + limit]
+
+    # а если и за LAB_COMMENTS_MAX_PAGES страниц не дочитали - перечитываем всё
+    calls.clear()
+    for page_number in range(logic.LAB_COMMENTS_MAX_PAGES):
+        since_id = 10 + limit * page_number
+        pages[since_id] = api.LabCommentsPage([], comments_count=limit, max_comment_id=since_id + limit)
+    run_with_async_session(db_path, sync)
+    assert calls == [10 + limit * i for i in range(logic.LAB_COMMENTS_MAX_PAGES)] + [0]
+
+
+def test_get_orm_request_progresses_reuses_rows(db_session):
+    requests = [_lab_request(1, 1), _lab_request(2, 2)]
+    first = logic._get_orm_request_progresses(db_session, requests)
+    assert [p.request.lab_planet.user.name for p in first] == ['user1', 'user2']
+
+    requests[1].user_name = 'renamed'
+    requests.append(_lab_request(3, 3))
+    second = logic._get_orm_request_progresses(db_session, requests)
+    assert second[:2] == first
+    assert second[1].request.lab_planet.user.name == 'renamed'
+
+    requests[0].total_donation = 30
+    third = logic._get_orm_request_progresses(db_session, requests)
+    assert third[0] is not first[0]
+    assert third[0].request is first[0].request
+    assert db_session.query(orm.LabRequestProgress).count() == 4
+    assert db_session.query(orm.LabRequest).count() == 3
+
+
+def test_migrate_adds_missing_indexes(db_path):
+    engine = sqlalchemy.create_engine(f'sqlite+pysqlite:///{db_path}')
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP INDEX ix_lab_request_lab_planet_id_requested_dt')
+        connection.exec_driver_sql('DROP TABLE lab_comment_cursor')
+
+    assert orm.migrate(engine) == ['ix_lab_request_lab_planet_id_requested_dt']
+    assert 'lab_comment_cursor' in sqlalchemy.inspect(engine).get_table_names()
+    assert orm.migrate(engine) == []
+    engine.dispose()
+
+
+def test_snapshot_is_refreshed_only_when_old():
+    refreshes = 0
+
+    async def refresh(bot_data):
+        nonlocal refreshes
+        refreshes += 1
+        snapshot = bot_data[poller.FLEET_SNAPSHOT_KEY] = poller.Snapshot(refreshes)
+        return snapshot
+
+    async def scenario():
+        bot_data = {}
+        first = await poller._get_snapshot(bot_data, poller.FLEET_SNAPSHOT_KEY, refresh, max_age=60)
+        cached = await poller._get_snapshot(bot_data, poller.FLEET_SNAPSHOT_KEY, refresh, max_age=60)
+        bot_data[poller.FLEET_SNAPSHOT_KEY].updated_dt -= datetime.timedelta(minutes=5)
+        refreshed = await poller._get_snapshot(bot_data, poller.FLEET_SNAPSHOT_KEY, refresh, max_age=60)
+        return first.value, cached.value, refreshed.value
+
+    assert asyncio.run(scenario()) == (1, 1, 2)
+
+
+def test_get_fleets_deduplicates_by_fleet(monkeypatch):
+    fleet_answers = {
+        'token1': json.loads(FLEETS_API_ANSWERS[1]),
+        'token3': json.loads(FLEETS_API_ANSWERS[2]),
+        'token4': json.loads(FLEETS_API_ANSWERS[0]),
+    }
+    requested = []
+
+    async def get_fleet(auth_token, session):
+        requested.append(auth_token)
+        fleet = api.FleetWrapper.from_api_answer(fleet_answers[auth_token])
+        if not fleet:
+            raise api.NotInEpic
+        return fleet, api.EventWrapper.from_api_answer(fleet_answers[auth_token])
+
+    monkeypatch.setattr(api, 'get_fleet', get_fleet)
+
+    # 2100453 летит в одном флоте с 271306, поэтому его токен даже не запрашиваем
+    tokens = _token_pool([271306, 2100453, 3, 4])
+    for token, value in zip(tokens.healthy(), ('token1', 'token2', 'token3', 'token4')):
+        token.value = value
+    fleets = asyncio.run(logic.get_fleets(tokens, None, concurrency=1))
+    assert sorted(fleets) == [8744947, 8751634]
+    assert 'token2' not in requested
+
+    text = logic.render_epic_infos(fleets)
+    assert text.index('Clower') < text.index('Happy new year')
+    assert logic.render_epic_infos({}) == logic.NOT_IN_EPIC_TEXT
+
+
+def test_histogram_renders_prometheus_text():
+    histogram = metrics.Histogram('test_seconds', 'test', ('endpoint',), buckets=(0.1, 1.0))
+    endpoint = metrics.endpoint_label('https://production.sw.fourdesire.com/api/v2/labs/68334/request?x=1')
+    assert endpoint == '/api/v2/labs/:id/request'
+    histogram.observe(0.05, endpoint=endpoint)
+    histogram.observe(0.5, endpoint=endpoint)
+    histogram.observe(5, endpoint=endpoint)
+
+    assert histogram.collect() == [
+        '# HELP test_seconds test',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{endpoint="/api/v2/labs/:id/request",le="0.1"} 1',
+        'test_seconds_bucket{endpoint="/api/v2/labs/:id/request",le="1.0"} 2',
+        'test_seconds_bucket{endpoint="/api/v2/labs/:id/request",le="+Inf"} 3',
+        'test_seconds_sum{endpoint="/api/v2/labs/:id/request"} 5.55',
+        'test_seconds_count{endpoint="/api/v2/labs/:id/request"} 3',
+    ]
+    assert 'walkr_response_cache_hits_total' in metrics.registry.render()
+
+
+def test_api_against_fake_server(monkeypatch):
+    async def run():
+        fake = fake_server.FakeWalkr(fake_server.FakeConfig(fixtures_dir=Path('/nonexistent'), comments=1000, seed=1))
+        runner = web.AppRunner(fake.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        monkeypatch.setattr(api, 'API_BASE_URL', f'http://127.0.0.1:{port}/api/v2')
+        api.response_cache.clear()
+        try:
+            async with aiohttp.ClientSession() as session:
+                page = await api.get_lab_comments('token', session, since_id=900)
+                fleet, event = await api.get_fleet('token', session)
+                authorization = await api.extend_token('token', session)
+
+                fake.config.error_rate = 1
+                with pytest.raises(ValueError, match='500'):
+                    await api.get_user_request('token', session)
+        finally:
+            await runner.cleanup()
+        return page, fleet, event, authorization
+
+    page, fleet, event, authorization = asyncio.run(run())
+    assert page.comments_count == 100
+    assert page.max_comment_id == 1000
+    assert all(r.comment_id > 900 for r in page.requests) and len(page.requests) == 33
+    assert fleet.name == 'Fake fleet' and fleet.voting == 'Bribe' and event.status == 'path'
+    assert authorization['player_id'] == 1000
+
+
+def test_fake_server_records_only_full_comment_pages(tmp_path):
+    async def start(app):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        return runner, f'http://127.0.0.1:{runner.addresses[0][1]}/api/v2'
+
+    async def run():
+        upstream = fake_server.FakeWalkr(fake_server.FakeConfig(fixtures_dir=Path('/nonexistent'), comments=50))
+        upstream_runner, upstream_url = await start(upstream.make_app())
+        recorder = fake_server.FakeWalkr(fake_server.FakeConfig(fixtures_dir=tmp_path, record_upstream=upstream_url))
+        recorder_runner, recorder_url = await start(recorder.make_app())
+        try:
+            async with aiohttp.ClientSession() as session:
+                for since_id in (0, 45):
+                    async with session.get(f'{recorder_url}/comments', params={'since_id': since_id}) as response:
+                        assert response.status == 200
+        finally:
+            await recorder_runner.cleanup()
+            await upstream_runner.cleanup()
+
+    asyncio.run(run())
+    recorded = json.loads((tmp_path / fake_server.FIXTURE_NAMES['comments']).read_text())
+    assert len(recorded['comments']) == 50
+
+
+def test_logs_redact_tokens_and_truncate_bodies():
+    headers = {'authorization': 'Bearer abc.def-123', 'Accept': '*/*'}
+    text = logs.redact(f'headers={headers} cli token spacewalk:xyz')
+    assert 'abc.def-123' not in text and 'xyz' not in text
+    assert f"'Bearer <token {logs.token_fingerprint('abc.def-123')}>'" in text
+
+    assert str(logs.Body('x' * 1000, limit=10)).endswith(' xxxxxxxxxx...')
+    assert str(logs.Body('x' * 1000, limit=0)).startswith('<1000 chars, sha1 ')
+    assert str(logs.Body('short', limit=10)).endswith(' short')
+
+
+def test_progress_is_stored_only_on_change(db_session):
+    requests = [_lab_request(1, 1)]
+    first = logic._get_orm_request_progresses(db_session, requests)
+    requests[0].total_donation = 30
+    second = logic._get_orm_request_progresses(db_session, requests)
+    assert logic._get_orm_request_progresses(db_session, requests) == second
+    # вернулись к старым значениям - это тоже изменение относительно последней записи
+    requests[0].total_donation = first[0].total_donation
+    fourth = logic._get_orm_request_progresses(db_session, requests)
+    assert fourth[0] not in (first[0], second[0])
+    assert db_session.query(orm.LabRequestProgress).count() == 3
+
+
+def test_retention_downsamples_old_progress(db_path):
+    now = datetime.datetime(2024, 6, 1)
+    engine = sqlalchemy.create_engine(f'sqlite+pysqlite:///{db_path}')
+    with orm.Session(engine) as session:
+        request = orm.LabRequest(
+            requested_dt=now,
+            lab_planet=orm.LabPlanet(user=orm.User(id=1, name='user1'), planet_name='p', planet_requirements=1),
+        )
+        # каждые 20 минут в течение 60 дней
+        for minutes in range(0, 60 * 24 * 60, 20):
+            session.add(orm.LabRequestProgress(
+                request=request, create_dt=now - datetime.timedelta(minutes=minutes),
+                total_donation=minutes, current_donation=0, donated_counter='',
+            ))
+        session.commit()
+
+    report = retention.run(engine, now=now, vacuum=True)
+    assert report.vacuumed
+
+    with orm.Session(engine) as session:
+        create_dts = session.scalars(orm.select(orm.LabRequestProgress.create_dt)).all()
+    raw = [dt for dt in create_dts if dt >= now - retention.KEEP_RAW]
+    hourly = [dt for dt in create_dts if now - retention.KEEP_HOURLY <= dt < now - retention.KEEP_RAW]
+    daily = [dt for dt in create_dts if dt < now - retention.KEEP_HOURLY]
+    assert len(raw) == 7 * 24 * 3 + 1
+    assert len(hourly) == 23 * 24
+    assert len(daily) == 30
+    assert sum(report.deleted.values()) == 60 * 24 * 3 - len(create_dts)
+
+
+def test_lab_chart_is_cached_by_data(db_path, db_session):
+    now = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    request = orm.LabRequest(
+        requested_dt=now,
+        lab_planet=orm.LabPlanet(user=orm.User(id=1, name='user1'), planet_name='aurora', planet_requirements=30000),
+    )
+    for minutes, total in ((60, 1000), (30, 3500), (0, 6000)):
+        db_session.add(orm.LabRequestProgress(request=request, create_dt=now - datetime.timedelta(minutes=minutes),
+                                              total_donation=total, current_donation=0, donated_counter=''))
+    db_session.commit()
+
+    async def load(session):
+        series = await charts.load_series(session, now=now)
+        hash_ = charts.data_hash(series)
+        assert await charts.get_cached_file_id(session, hash_) is None
+        await charts.save_file_id(session, hash_, 'file-1')
+        return series, hash_, await charts.get_cached_file_id(session, hash_)
+
+    series, hash_, file_id = run_with_async_session(db_path, load)
+    assert file_id == 'file-1'
+    assert series[0].title == 'user1: aurora' and [v for _, v in series[0].points] == [1000, 3500, 6000]
+
+    series[0].points.append((now, 9000))
+    assert charts.data_hash(series) != hash_
+    assert charts.render(series).startswith(b'\x89PNG')
+
+
+def test_transport_retries_only_idempotent_requests(monkeypatch):
+    monkeypatch.setattr(transport, 'BACKOFF_BASE', 0)
+    calls = []
+
+    async def flaky(request):
+        calls.append(request.method)
+        if len(calls) % 3:
+            return web.Response(status=503)
+        return web.Response(text='ok')
+
+    async def run():
+        app = web.Application()
+        app.router.add_route('*', '/flaky', flaky)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        url = f'http://127.0.0.1:{runner.addresses[0][1]}/flaky'
+        try:
+            async with aiohttp.ClientSession() as session:
+                assert await transport.request_async('get', url, session) == 'ok'
+                with pytest.raises(transport.ApiError) as e:
+                    await transport.request_async('post', url, session)
+                assert e.value.status == 503
+            assert await asyncio.to_thread(lambda: transport.request_sync('get', url).text) == 'ok'
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    assert calls == ['GET', 'GET', 'GET', 'POST', 'GET', 'GET']
+
+
+def test_transport_deadline_covers_all_retries(monkeypatch):
+    monkeypatch.setattr(transport, 'HTTP_DEADLINE', 0.3)
+    monkeypatch.setattr(transport, 'BACKOFF_BASE', 0)
+    calls = []
+
+    async def hung(request):
+        calls.append(request.method)
+        await asyncio.sleep(1)
+        return web.Response(text='late')
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/hung', hung)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        url = f'http://127.0.0.1:{runner.addresses[0][1]}/hung'
+        try:
+            async with aiohttp.ClientSession() as session:
+                start = asyncio.get_running_loop().time()
+                with pytest.raises(asyncio.TimeoutError):
+                    await transport.request_async('get', url, session, retries=5)
+                return asyncio.get_running_loop().time() - start
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run()) < 0.9
+    assert len(calls) == 1
+
+
+def test_circuit_breaker_fails_fast_and_serves_last_snapshot(monkeypatch):
+    breaker = transport.CircuitBreaker('walkr', threshold=2, open_seconds=60)
+    monkeypatch.setitem(transport._breakers, '127.0.0.1:1', breaker)
+    monkeypatch.setattr(transport, 'GET_RETRIES', 0)
+
+    async def scenario():
+        # на порту 1 никто не слушает - соединение сразу отклоняется
+        url = 'http://127.0.0.1:1/api/v2/fleets/current'
+        async with transport.make_async_session() as session:
+            for _ in range(2):
+                with pytest.raises(aiohttp.ClientConnectionError):
+                    await transport.request_async('get', url, session)
+            with pytest.raises(transport.UpstreamUnavailable):
+                await transport.request_async('get', url, session)
+
+            async def refresh(bot_data):
+                return await transport.request_async('get', url, session)
+
+            bot_data = {poller.FLEET_SNAPSHOT_KEY: poller.Snapshot('old')}
+            bot_data[poller.FLEET_SNAPSHOT_KEY].updated_dt -= datetime.timedelta(minutes=5)
+            snapshot = await poller._get_snapshot(bot_data, poller.FLEET_SNAPSHOT_KEY, refresh, max_age=60)
+            assert (snapshot.value, snapshot.stale) == ('old', True)
+            assert not bot_data[poller.FLEET_SNAPSHOT_KEY].stale
+
+            # полуоткрытое состояние: один пробный запрос, успех закрывает выключатель
+            breaker.opened_at -= 60
+            breaker.before_request()
+            with pytest.raises(transport.UpstreamUnavailable):
+                breaker.before_request()
+            breaker.record_success()
+            assert not breaker.is_open
+
+    asyncio.run(scenario())
+
+
+def test_fleet_snapshot_is_stale_not_empty_while_breaker_is_open(monkeypatch):
+    host = transport.breaker_for(api.api_url('/fleets/current')).host
+    breaker = transport.CircuitBreaker(host, threshold=1, open_seconds=60)
+    breaker.record_failure()
+    monkeypatch.setitem(transport._breakers, host, breaker)
+    tokens = _token_pool([1, 2])
+
+    async def scenario():
+        async with aiohttp.ClientSession() as session:
+            bot_data = {
+                'token_pool': tokens, 'aiohttp_session': session,
+                poller.FLEET_SNAPSHOT_KEY: poller.Snapshot({1: 'fleet'}),
+            }
+            bot_data[poller.FLEET_SNAPSHOT_KEY].updated_dt -= datetime.timedelta(minutes=5)
+            with pytest.raises(transport.UpstreamUnavailable):
+                await poller.refresh_fleet(bot_data)
+            return await poller.get_fleet_snapshot(bot_data, max_age=60)
+
+    snapshot = asyncio.run(scenario())
+    assert (snapshot.value, snapshot.stale) == ({1: 'fleet'}, True)
+    assert all(token.failures == 0 for token in tokens.healthy())
+
+
+def test_updates_run_in_parallel_across_chats_but_in_order_within_chat():
+    from telegram import Chat, Message, Update
+
+    def make_update(update_id, chat_id):
+        chat = Chat(chat_id, 'private')
+        message = Message(update_id, datetime.datetime.now(), chat)
+        return Update(update_id, message=message)
+
+    async def run():
+        processor = chat_updates.PerChatUpdateProcessor(2)
+        events = []
+        release = asyncio.Event()
+
+        async def handle(name, wait=False):
+            events.append(f'{name} start')
+            if wait:
+                await release.wait()
+            events.append(f'{name} end')
+
+        slow = asyncio.create_task(processor.process_update(make_update(1, 10), handle('a1', wait=True)))
+        same_chat = asyncio.create_task(processor.process_update(make_update(2, 10), handle('a2')))
+        await asyncio.sleep(0)
+        await processor.process_update(make_update(3, 20), handle('b1'))
+        # другой чат не ждал медленный апдейт, а второй апдейт того же чата ждёт
+        assert events == ['a1 start', 'b1 start', 'b1 end']
+        release.set()
+        await asyncio.gather(slow, same_chat)
+        assert events[3:] == ['a1 end', 'a2 start', 'a2 end']
+        assert processor._chats == {}
+
+    asyncio.run(run())
+
+
+def test_repeated_callback_presses_are_debounced(monkeypatch):
+    import types
+
+    import bot
+
+    monkeypatch.setattr(bot, '_callbacks_done_at', {})
+    monkeypatch.setattr(bot, '_callbacks_in_flight', {})
+    answers = []
+    calls = []
+
+    def press(message_id, data='update_epic_info'):
+        async def answer():
+            answers.append(message_id)
+
+        if message_id is None:
+            query = types.SimpleNamespace(message=None, inline_message_id='inline', data=data, answer=answer)
+        else:
+            message = types.SimpleNamespace(chat_id=1, message_id=message_id)
+            query = types.SimpleNamespace(message=message, data=data, answer=answer)
+        return types.SimpleNamespace(callback_query=query)
+
+    @bot._debounce_callback_presses
+    async def handler(update, context):
+        query = update.callback_query
+        calls.append(query.message.message_id if query.message else query.inline_message_id)
+
+    async def run():
+        # второе нажатие доходит после первого (chat_updates держит чат), третье - по другому сообщению
+        for message_id in (100, 100, 200, None, None):
+            await handler(press(message_id), None)
+
+    asyncio.run(run())
+    assert calls == [100, 200, 'inline']
+    assert answers == [100, None]
+
+    async def run_concurrently():
+        # под inline-сообщением чата нет, и chat_updates нажатия не упорядочивает - ждут первое сами
+        bot._callbacks_done_at.clear()
+        await asyncio.gather(*(handler(press(None), None) for _ in range(3)))
+
+    calls.clear()
+    answers.clear()
+    asyncio.run(run_concurrently())
+    assert calls == ['inline']
+    assert answers == [None, None]
+
+
+def test_callback_under_inline_message_is_not_tracked(monkeypatch):
+    import types
+
+    import bot
+
+    monkeypatch.setattr(bot, '_callbacks_done_at', {})
+    monkeypatch.setattr(bot, '_callbacks_in_flight', {})
+    edits = []
+    tracked = []
+
+    async def fake_get_epic_info(update, context, callback=False):
+        return 'epic', None
+
+    async def fake_track_message(*args):
+        tracked.append(args)
+
+    async def answer(*args, **kwargs):
+        pass
+
+    async def edit_message_text(**kwargs):
+        edits.append(kwargs['text'])
+
+    monkeypatch.setattr(bot, '_get_epic_info', fake_get_epic_info)
+    monkeypatch.setattr(bot, '_track_message', fake_track_message)
+    query = types.SimpleNamespace(id='1', message=None, inline_message_id='inline', data='update_epic_info',
+                                  answer=answer, edit_message_text=edit_message_text)
+    update = types.SimpleNamespace(callback_query=query, effective_chat=None,
+                                   effective_user=types.SimpleNamespace(name='@user', id=1))
+    asyncio.run(bot.callback_query(update, None))
+    assert len(edits) == 1 and edits[0].startswith('epic')
+    assert tracked == []
+
+
+def test_callback_press_after_failure_recomputes(monkeypatch):
+    import types
+
+    import bot
+
+    monkeypatch.setattr(bot, '_callbacks_done_at', {})
+    monkeypatch.setattr(bot, '_callbacks_in_flight', {})
+    calls = []
+
+    async def answer(*args, **kwargs):
+        pass
+
+    @bot._debounce_callback_presses
+    async def handler(update, context):
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise transport.UpstreamUnavailable('walkr is down')
+
+    async def run():
+        update = types.SimpleNamespace(callback_query=types.SimpleNamespace(
+            message=types.SimpleNamespace(chat_id=1, message_id=100), data='update_epic_info', answer=answer,
+        ))
+        with pytest.raises(transport.UpstreamUnavailable):
+            await handler(update, None)
+        await handler(update, None)
+        await handler(update, None)
+
+    asyncio.run(run())
+    # после ошибки пересчитали, а после успеха уже нет
+    assert calls == [0, 1]
+
+
+def test_bulk_token_import_reports_and_upserts(monkeypatch, db_session):
+    expires = int(datetime.datetime(2100, 1, 1).timestamp())
+    players = {
+        'tok-a': {'player_id': 1, 'name': 'A', 'token_expired_at': expires},
+        'tok-a-newer': {'player_id': 1, 'name': 'A', 'token_expired_at': expires + 3600},
+        'tok-b': {'player_id': 2, 'name': 'B', 'token_expired_at': expires},
+    }
+
+    async def fake_extend_token(auth_token, session):
+        if auth_token not in players:
+            raise transport.InvalidToken('401', 401)
+        return players[auth_token]
+
+    monkeypatch.setattr(api, 'extend_token', fake_extend_token)
+    db_session.add(orm.User(id=2, name='old B'))
+    db_session.add(orm.Token(user_id=2, value='old', active=False, update_dt=datetime.datetime.now(),
+                          expired_dt=datetime.datetime(2000, 1, 1)))
+    db_session.commit()
+
+    tokens = cli.read_tokens(['tok-a', '', '# comment', 'tok-b', 'tok-a-newer', 'dead', 'tok-b'])
+    results = asyncio.run(cli.validate_tokens(tokens))
+    assert [r.status for r in results] == ['duplicate', 'valid', 'valid', 'expired', 'duplicate']
+
+    cli.save_tokens(db_session, results)
+    db_session.commit()
+    saved = {t.user_id: t for t in db_session.scalars(orm.select(orm.Token))}
+    assert {user_id: (t.value, t.active) for user_id, t in saved.items()} == {
+        1: ('tok-a-newer', True), 2: ('tok-b', True),
+    }
+    assert db_session.get(orm.User, 2).name == 'B'
+
+
+def test_export_streams_filtered_progress(db_path, monkeypatch):
+    start = datetime.datetime(2024, 6, 1)
+    engine = sqlalchemy.create_engine(f'sqlite+pysqlite:///{db_path}')
+    with orm.Session(engine) as session:
+        for user_id in (1, 2):
+            request = orm.LabRequest(
+                requested_dt=start,
+                lab_planet=orm.LabPlanet(
+                    user=orm.User(id=user_id, name=f'user{user_id}'), planet_name='p', planet_requirements=100
+                ),
+            )
+            for minutes in range(10):
+                session.add(orm.LabRequestProgress(
+                    request=request, create_dt=start + datetime.timedelta(minutes=minutes),
+                    total_donation=minutes, current_donation=0, donated_counter='',
+                ))
+        session.commit()
+
+    monkeypatch.setattr(export, 'EXPORT_BATCH_SIZE', 3)
+    out = io.StringIO()
+    count = export.export(engine, out, 'csv', since=start + datetime.timedelta(minutes=2),
+                          until=start + datetime.timedelta(minutes=5), user_ids=[2])
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    assert count == len(rows) == 3
+    assert {r['user_name'] for r in rows} == {'user2'}
+    assert [r['create_dt'] for r in rows] == [f'2024-06-01T00:0{m}:00' for m in (2, 3, 4)]
+
+    out = io.StringIO()
+    assert export.export(engine, out, 'jsonl') == 20
+    first = json.loads(out.getvalue().splitlines()[0])
+    assert first['user_id'] == 1 and first['planet_requirements'] == 100 and first['total_donation'] == 0
+
+
+def test_bridge_solver_gives_everyone_partners_from_other_tiers(db_session):
+    fleet = api.FleetWrapper.from_api_answer(fake_server.synthetic_fleet())
+    fleet.members = [
+        {'id': player_id, 'name': f'Player {player_id}', 'energy_productivity': 1000 + player_id * 10}
+        for player_id in range(300)
+    ]
+    logic.save_player_energy(db_session, {fleet.id: (fleet, None)})
+    db_session.commit()
+    members = bridge.load_members(db_session, exclude=[299])
+    assert len(members) == 299 and {m.tier for m in members} == set(bridge.TIERS)
+
+    by_id = {m.player_id: m for m in members}
+    relations = bridge.solve(members)
+    assert all(len(partners) == bridge.MAX_PARTNERS for partners in relations.values())
+    assert all(player_id in relations[partner] for player_id, ps in relations.items() for partner in ps)
+    # уровни почти равные, так что соседи по кругу почти всегда из других уровней
+    same_tier = sum(by_id[p].tier == by_id[player_id].tier for player_id, ps in relations.items() for p in ps)
+    assert same_tier <= 4
+
+    few = bridge.solve(members[:4])
+    assert all(len(partners) == 3 for partners in few.values())
+    odd = bridge.solve(members[:11], max_partners=3)
+    assert sorted(len(partners) for partners in odd.values()) == [2] + [3] * 10
+    assert 'fillcolor="#bef574"' in bridge.make_graph(by_id, relations).source
+
+
+def test_autoupdate_hash_ignores_footer_and_countdown():
+    import bot
+
+    text = 'Вижу такие запросы в лаборатории:\n - *user1* 1K/30K осталось 5h10m'
+    later = 'Вижу такие запросы в лаборатории:\n - *user1* 1K/30K осталось 4h59m'
+    assert bot._autoupdate_hash(f'{text}\n\nОбновлено автоматически в 01.01.2024 10:00:00 MSK') == \
+        bot._autoupdate_hash(f'{later}\n\nОбновлено пользователем @x в 01.01.2024 11:30:00 MSK')
+    assert bot._autoupdate_hash(f'{text}\nАктуально на 01.01.2024 10:00:00 MSK') == bot._autoupdate_hash(text)
+    assert bot._autoupdate_hash(text) != bot._autoupdate_hash(text.replace('1K/30K', '2K/30K'))
+
+
+def test_autoupdate_edits_only_changed_messages(monkeypatch, db_path):
+    import types
+
+    import bot
+
+    answer = json.loads(FLEETS_API_ANSWERS[1])
+    edits = []
+
+    async def edit_message_text(chat_id, message_id, **kwargs):
+        edits.append((chat_id, message_id))
+
+    def fleets_snapshot(data):
+        fleet, event = api.FleetWrapper.from_api_answer(data), api.EventWrapper.from_api_answer(data)
+        return poller.Snapshot({fleet.id: (fleet, event)})
+
+    context = types.SimpleNamespace(
+        bot=types.SimpleNamespace(edit_message_text=edit_message_text),
+        bot_data={poller.FLEET_SNAPSHOT_KEY: fleets_snapshot(answer)},
+    )
+
+    async def scenario():
+        text, _ = bot._render_epic_info(context.bot_data[poller.FLEET_SNAPSHOT_KEY])
+        await bot._track_message(1, 10, bot.EPIC_INFO_KIND, f'{text}\n\nОбновлено автоматически в 01.01.2024 MSK')
+
+        # флот не поменялся, поменялось бы только время в подвале
+        await bot.autoupdate_messages(context)
+        assert edits == []
+
+        answer['fleet']['contribution_amount'] += 1000
+        context.bot_data[poller.FLEET_SNAPSHOT_KEY] = fleets_snapshot(answer)
+        await bot.autoupdate_messages(context)
+        assert edits == [(1, 10)]
+
+        # новый хэш запомнен - повторно не редактируем
+        await bot.autoupdate_messages(context)
+        assert edits == [(1, 10)]
+
+    _with_test_db(monkeypatch, db_path, scenario)
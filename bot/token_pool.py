@@ -0,0 +1,152 @@
+"""
+Пул walkr-токенов: кто из них сейчас жив, какая была последняя ошибка, и своевременное продление через extend_token.
+Бот берёт токены отсюда, а не из orm.Token напрямую
+"""
+import contextlib
+import datetime
+import itertools
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterable, Optional
+
+import aiohttp
+from telegram.ext import ContextTypes
+
+import api
+import orm
+import transport
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# после стольких ошибок подряд токен считаем больным
+MAX_FAILURES = 3
+# больной токен снова пробуем через столько секунд
+UNHEALTHY_COOLDOWN = 300
+# продлеваем токен, когда до конца его жизни осталось меньше этого
+REFRESH_BEFORE = datetime.timedelta(days=2)
+# как часто проверяем, не пора ли продлевать, и перечитываем токены из бд
+REFRESH_CHECK_INTERVAL = 3600
+
+
+class NoHealthyTokens(Exception):
+    pass
+
+
+@dataclass
+class TokenState:
+    user_id: int
+    user_name: str
+    value: str
+    expired_dt: datetime.datetime
+    failures: int = 0
+    last_error: Optional[str] = None
+    last_error_dt: Optional[datetime.datetime] = None
+
+    @property
+    def healthy(self) -> bool:
+        if self.failures < MAX_FAILURES:
+            return True
+        return (datetime.datetime.now() - self.last_error_dt).total_seconds() > UNHEALTHY_COOLDOWN
+
+
+class TokenPool:
+    def __init__(self, tokens: Iterable[TokenState] = ()):
+        self._tokens: dict[str, TokenState] = {token.value: token for token in tokens}
+        self._round_robin = itertools.count()
+
+    async def reload(self) -> None:
+        """перечитывает активные токены из бд, сохраняя здоровье уже известных"""
+        async with orm.make_async_session() as session:
+            db_tokens = (await session.scalars(
+                orm.select(orm.Token).where(orm.Token.active).options(orm.joinedload(orm.Token.user))
+            )).all()
+
+        tokens = {}
+        for db_token in db_tokens:
+            token = self._tokens.get(db_token.value) or TokenState(
+                user_id=db_token.user_id, user_name=db_token.user.name, value=db_token.value,
+                expired_dt=db_token.expired_dt,
+            )
+            token.expired_dt = db_token.expired_dt
+            tokens[token.value] = token
+        self._tokens = tokens
+        logger.info('token pool reloaded: %s tokens, %s healthy', len(self._tokens), len(self.healthy()))
+
+    def healthy(self) -> list[TokenState]:
+        return [token for token in self._tokens.values() if token.healthy]
+
+    def get(self) -> TokenState:
+        """любой живой токен, по кругу, чтобы не долбить сервер от лица одного игрока"""
+        healthy = self.healthy()
+        if not healthy:
+            raise NoHealthyTokens('there are no healthy walkr tokens, add one with cli.py --token')
+        return healthy[next(self._round_robin) % len(healthy)]
+
+    def report_success(self, token: TokenState) -> None:
+        token.failures = 0
+
+    async def report_error(self, token: TokenState, error: Exception) -> None:
+        token.failures += 1
+        token.last_error = str(error)[:500]
+        token.last_error_dt = datetime.datetime.now()
+        if isinstance(error, api.InvalidToken):
+            await self.deactivate(token)
+
+    async def deactivate(self, token: TokenState) -> None:
+        logger.warning('deactivating token of %s (id=%s): %s', token.user_name, token.user_id, token.last_error)
+        self._tokens.pop(token.value, None)
+        async with orm.make_async_session() as session:
+            await session.execute(
+                orm.update(orm.Token)
+                .where(orm.Token.value == token.value)
+                .values(active=False, update_dt=datetime.datetime.now(tz=datetime.timezone.utc))
+            )
+            await session.commit()
+
+    @contextlib.asynccontextmanager
+    async def track(self, token: TokenState) -> AsyncIterator[TokenState]:
+        """учитывает результат запросов внутри блока в здоровье токена"""
+        try:
+            yield token
+        except api.NotInEpic:
+            # это не проблема токена
+            self.report_success(token)
+            raise
+        except Exception as e:
+            # walkr лежит или запрос даже не отправлялся - токен тут ни при чём; иначе после сбоя все токены
+            # были бы больными ещё UNHEALTHY_COOLDOWN и после того, как walkr поднимется
+            if not transport.is_upstream_error(e):
+                await self.report_error(token, e)
+            raise
+        else:
+            self.report_success(token)
+
+    async def refresh_expiring(self, http_session: aiohttp.ClientSession) -> None:
+        now = datetime.datetime.now()
+        for token in list(self._tokens.values()):
+            if token.expired_dt - now > REFRESH_BEFORE:
+                continue
+            try:
+                async with self.track(token):
+                    authorization = await api.extend_token(token.value, http_session)
+            except Exception:
+                logger.exception('cant extend token of %s (id=%s)', token.user_name, token.user_id)
+                continue
+
+            # так же, как в cli.py --token
+            token.expired_dt = datetime.datetime.fromtimestamp(authorization['token_expired_at'])
+            async with orm.make_async_session() as session:
+                await session.execute(
+                    orm.update(orm.Token)
+                    .where(orm.Token.value == token.value)
+                    .values(expired_dt=token.expired_dt, update_dt=datetime.datetime.now(tz=datetime.timezone.utc))
+                )
+                await session.commit()
+            logger.info('token of %s (id=%s) extended till %s', token.user_name, token.user_id, token.expired_dt)
+
+
+async def refresh_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    pool: TokenPool = context.bot_data['token_pool']
+    await pool.reload()
+    await pool.refresh_expiring(context.bot_data['aiohttp_session'])
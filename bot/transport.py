@@ -0,0 +1,423 @@
+"""
+Общий http-транспорт для бота (async, aiohttp) и cli/скриптов (sync, requests): одни заголовки и параметры walkr,
+одни ошибки, пул keep-alive соединений и повторы идемпотентных GET с джиттером.
+Параметры уходят в query у GET и json-телом у POST
+"""
+import asyncio
+import codecs
+import contextlib
+import logging
+import os
+import random
+import time
+from typing import AsyncIterator, Iterator, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+import logs
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_CLIENT_VERSION = "7.2.2.4"
+DEFAULT_IOS_VERSION = "17.4.1"
+
+# сколько раз повторяем GET после первой неудачи
+GET_RETRIES = 2
+# пауза перед повтором: случайная от 0 до BACKOFF_BASE * 2^попытка, но не больше BACKOFF_MAX
+BACKOFF_BASE = 0.3
+BACKOFF_MAX = 5.0
+# на эти ответы есть смысл повторить запрос, на остальные 4xx - нет
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+SYNC_TIMEOUT = 30
+# соединений на хост в пуле sync-сессии
+SYNC_POOL_SIZE = 10
+# кусками такого размера stream_async читает тело ответа
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# таймауты async-сессии бота, секунды: на весь запрос, на установку соединения и на чтение между кусками ответа
+HTTP_TIMEOUT_TOTAL = float(os.environ.get('WALKR_HTTP_TIMEOUT_TOTAL', 30))
+HTTP_TIMEOUT_CONNECT = float(os.environ.get('WALKR_HTTP_TIMEOUT_CONNECT', 5))
+HTTP_TIMEOUT_READ = float(os.environ.get('WALKR_HTTP_TIMEOUT_READ', 15))
+# срок на весь запрос вместе с повторами: зависший walkr держит обработчик не дольше этого, а не по
+# HTTP_TIMEOUT_TOTAL на каждую попытку; повтор, который не успеет начаться до срока, не делаем
+HTTP_DEADLINE = float(os.environ.get('WALKR_HTTP_DEADLINE', HTTP_TIMEOUT_TOTAL))
+# соединений всего и на один хост; остальные запросы ждут в очереди коннектора
+HTTP_CONNECTIONS_LIMIT = 50
+HTTP_CONNECTIONS_PER_HOST = 10
+DNS_CACHE_TTL = 300
+# проверка сертификата выключена исторически (ходили через mitm-прокси), WALKR_VERIFY_SSL=1 включает
+VERIFY_SSL = os.environ.get('WALKR_VERIFY_SSL') == '1'
+
+# после стольких неудачных запросов подряд к хосту перестаём к нему ходить
+BREAKER_FAILURE_THRESHOLD = 5
+# и столько секунд сразу отвечаем UpstreamUnavailable, потом пропускаем один пробный запрос
+BREAKER_OPEN_SECONDS = 30
+
+WALKR_REQUEST_LATENCY = metrics.histogram(
+    'walkr_request_duration_seconds', 'Latency of walkr api requests (cache misses only, every attempt)',
+    ('method', 'endpoint', 'status'),
+)
+
+_sync_session: Optional[requests.Session] = None
+
+
+class ApiError(ValueError):
+    """сервер ответил не 2xx"""
+
+    def __init__(self, message: str, status: Optional[int] = None, url: Optional[str] = None):
+        super().__init__(message)
+        self.status = status
+        self.url = url
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRY_STATUSES
+
+
+class InvalidToken(ApiError):
+    """сервер ответил 401"""
+    auth_token: Optional[str] = None
+
+
+class UpstreamUnavailable(Exception):
+    """хост подряд не отвечает, запрос даже не отправляли"""
+
+
+class CircuitBreaker:
+    """
+    closed - запросы идут; BREAKER_FAILURE_THRESHOLD сбоев подряд - open, все запросы сразу падают;
+    через BREAKER_OPEN_SECONDS - half-open, пропускаем один пробный запрос и по его итогу закрываемся или снова open
+    """
+
+    def __init__(
+            self, host: str, threshold: int = BREAKER_FAILURE_THRESHOLD, open_seconds: float = BREAKER_OPEN_SECONDS
+    ):
+        self.host = host
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_request(self) -> None:
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.open_seconds or self._probe_in_flight:
+            raise UpstreamUnavailable(f'{self.host} is unavailable, not sending requests for a while')
+        self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info('circuit breaker for %s is closed again', self.host)
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """пробный запрос отменили, не дождавшись ответа - ничего о хосте не узнали"""
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning('circuit breaker for %s is open after %s failures', self.host, self.failures)
+            self.opened_at = time.monotonic()
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def breaker_for(url: str) -> CircuitBreaker:
+    host = urlsplit(url).netloc
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = CircuitBreaker(host)
+    return breaker
+
+
+def is_upstream_error(error: BaseException) -> bool:
+    """сбой на стороне walkr или сети, а не наш запрос или токен"""
+    if isinstance(error, ApiError):
+        return error.retryable
+    return isinstance(error, (UpstreamUnavailable, aiohttp.ClientError, asyncio.TimeoutError))
+
+
+metrics.callback_metric(
+    'walkr_circuit_breakers_open', 'Hosts that are not requested right now because of repeated failures',
+    lambda: sum(breaker.is_open for breaker in _breakers.values()),
+)
+
+
+def make_async_session() -> aiohttp.ClientSession:
+    """сессия бота: таймауты, лимиты соединений и кэш dns"""
+    return aiohttp.ClientSession(
+        trust_env=True,
+        timeout=aiohttp.ClientTimeout(
+            total=HTTP_TIMEOUT_TOTAL, connect=HTTP_TIMEOUT_CONNECT, sock_read=HTTP_TIMEOUT_READ
+        ),
+        connector=aiohttp.TCPConnector(
+            limit=HTTP_CONNECTIONS_LIMIT, limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+            use_dns_cache=True, ttl_dns_cache=DNS_CACHE_TTL, ssl=None if VERIFY_SSL else False,
+        ),
+    )
+
+
+def get_headers(
+        auth_token: str,
+        client_version: str = DEFAULT_CLIENT_VERSION,
+        ios_version: str = DEFAULT_IOS_VERSION,
+        **additional_params
+) -> dict[str, str]:
+    client_version = '.'.join(client_version.split('.')[:3])
+    headers = {
+        'Accept': '*/*',
+        'User-Agent': f'Walkr/{client_version} (iPhone; iOS {ios_version}; Scale/3.00)',
+        'Accept-Language': 'en-US;q=1, ru-RU;q=0.9',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'authorization': f'Bearer {auth_token}',
+    }
+    headers.update(additional_params)
+    return headers
+
+
+def get_params(
+        client_version: str = DEFAULT_CLIENT_VERSION,
+        ios_version: str = DEFAULT_IOS_VERSION,
+        **additional_params
+) -> dict[str, str]:
+    data = {
+        "locale": "en",
+        "client_version": client_version,
+        "platform": "ios",
+        "timezone": 2,
+        "os_version": f"iOS {ios_version}",
+        "country_code": "RU",
+        "device_model": "iPhone13,2"
+    }
+    data.update(additional_params)
+    return data
+
+
+def check_response(url: str, status: int, body: str) -> None:
+    if status == 401:
+        # токен устарел, выключает его token_pool
+        raise InvalidToken(f'response code is 401, token is invalid: url: {url}\ndata={logs.Body(body)}', status, url)
+    if not 200 <= status < 300:
+        raise ApiError(f'response code is not 200: {status} url: {url}\ndata={logs.Body(body)}', status, url)
+
+
+def _attempt_timeout(deadline: float) -> aiohttp.ClientTimeout:
+    """таймауты сессии, но общий - не дальше срока всего запроса"""
+    return aiohttp.ClientTimeout(
+        # total=0 у aiohttp - "без таймаута", поэтому не ноль
+        total=max(min(HTTP_TIMEOUT_TOTAL, deadline - time.monotonic()), 0.001),
+        connect=HTTP_TIMEOUT_CONNECT, sock_read=HTTP_TIMEOUT_READ,
+    )
+
+
+def backoff(attempt: int) -> float:
+    """full jitter: одновременно упавшие запросы не повторяются все разом"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _observe(method: str, url: str, status: int | str, size: int, start: float, headers: dict) -> None:
+    """метрика и одна запись в лог на каждую попытку; поля лога ещё и в extra, чтобы не парсить текст"""
+    duration = time.perf_counter() - start
+    WALKR_REQUEST_LATENCY.observe(duration, method=method, endpoint=metrics.endpoint_label(url), status=status)
+    request = {
+        'method': method,
+        'url': url,
+        'status': status,
+        'bytes': size,
+        'duration': round(duration, 4),
+        'token': logs.token_fingerprint(headers.get('authorization', '').removeprefix('Bearer ')),
+    }
+    logger.info('walkr request %s', ' '.join(f'{k}={v}' for k, v in request.items()),
+                extra={'walkr_request': request})
+
+
+def _attempts(method: str, retries: Optional[int]) -> int:
+    if method not in ('get', 'post'):
+        raise ValueError(f'unknown method - {method}')
+    if retries is None:
+        retries = GET_RETRIES if method == 'get' else 0
+    return retries + 1
+
+
+@contextlib.contextmanager
+def _guarded(url: str) -> Iterator[None]:
+    """circuit breaker хоста вокруг одного запроса со всеми его повторами"""
+    breaker = breaker_for(url)
+    breaker.before_request()
+    try:
+        yield
+    except Exception as e:
+        if is_upstream_error(e):
+            breaker.record_failure()
+        else:
+            # 4xx и прочее - хост отвечает
+            breaker.record_success()
+        raise
+    except BaseException:
+        breaker.release_probe()
+        raise
+    breaker.record_success()
+
+
+async def request_async(
+        method: str,
+        url: str,
+        session: aiohttp.ClientSession,
+        params: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        retries: Optional[int] = None,
+) -> str:
+    """retries: None - GET_RETRIES для GET и ни одного для POST"""
+    with _guarded(url):
+        return await _request_async(method, url, session, params, headers, retries)
+
+
+async def _request_async(
+        method: str,
+        url: str,
+        session: aiohttp.ClientSession,
+        params: Optional[dict],
+        headers: Optional[dict],
+        retries: Optional[int],
+) -> str:
+    headers = headers or {}
+    attempts = _attempts(method, retries)
+    deadline = time.monotonic() + HTTP_DEADLINE
+    logger.debug('async %s %s params=%s headers=%s', method, url, params, headers)
+
+    for attempt in range(attempts):
+        start = time.perf_counter()
+        # если ответа так и не дождались (таймаут, обрыв соединения)
+        status = 'error'
+        body = ''
+        try:
+            timeout = _attempt_timeout(deadline)
+            if method == 'get':
+                mng = session.get(url, params=params, headers=headers, timeout=timeout)
+            else:
+                mng = session.post(url, json=params, headers=headers, timeout=timeout)
+            async with mng as response:
+                status = response.status
+                body = await response.text()
+            check_response(url, status, body)
+            logger.debug('response %s status, data=%s', status, logs.Body(body))
+            return body
+        except (ApiError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            delay = backoff(attempt)
+            if (attempt + 1 == attempts or (isinstance(e, ApiError) and not e.retryable)
+                    or time.monotonic() + delay >= deadline):
+                raise
+            logger.warning('retrying %s %s in %.2fs after %r', method, url, delay, e)
+        finally:
+            _observe(method, url, status, len(body), start, headers)
+        await asyncio.sleep(delay)
+
+
+async def stream_async(
+        url: str,
+        session: aiohttp.ClientSession,
+        params: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+) -> AsyncIterator[str]:
+    """
+    GET, тело которого отдаётся кусками текста по мере чтения, целиком в памяти его нет.
+    Повторяем, как request_async, только пока не отдали ни одного куска; обрыв посреди тела уходит вызывающему.
+    В метрику попадает и время, пока вызывающий разбирал куски
+    """
+    headers = headers or {}
+    attempts = _attempts('get', None)
+    deadline = time.monotonic() + HTTP_DEADLINE
+    logger.debug('async stream get %s params=%s headers=%s', url, params, headers)
+
+    with _guarded(url):
+        for attempt in range(attempts):
+            start = time.perf_counter()
+            status = 'error'
+            size = 0
+            try:
+                async with session.get(
+                        url, params=params, headers=headers, timeout=_attempt_timeout(deadline)
+                ) as response:
+                    status = response.status
+                    if not 200 <= status < 300:
+                        check_response(url, status, await response.text())
+                    decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')()
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        size += len(chunk)
+                        yield decoder.decode(chunk)
+                    yield decoder.decode(b'', final=True)
+                return
+            except (ApiError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                delay = backoff(attempt)
+                if (size or attempt + 1 == attempts or (isinstance(e, ApiError) and not e.retryable)
+                        or time.monotonic() + delay >= deadline):
+                    raise
+                logger.warning('retrying stream get %s in %.2fs after %r', url, delay, e)
+            finally:
+                _observe('get', url, status, size, start, headers)
+            await asyncio.sleep(delay)
+
+
+def sync_session() -> requests.Session:
+    """одна сессия на процесс: соединения к одному хосту переиспользуются, без нового TCP+TLS на каждый запрос"""
+    global _sync_session
+    if _sync_session is None:
+        _sync_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=SYNC_POOL_SIZE, pool_maxsize=SYNC_POOL_SIZE)
+        _sync_session.mount('https://', adapter)
+        _sync_session.mount('http://', adapter)
+    return _sync_session
+
+
+def request_sync(
+        method: str,
+        url: str,
+        params: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        retries: Optional[int] = None,
+) -> requests.Response:
+    """то же, что request_async, но для cli и скриптов; отдаёт весь ответ, скриптам нужны и заголовки"""
+    headers = headers or {}
+    attempts = _attempts(method, retries)
+    session = sync_session()
+    logger.debug('sync %s %s params=%s headers=%s', method, url, params, headers)
+
+    for attempt in range(attempts):
+        start = time.perf_counter()
+        status = 'error'
+        body = ''
+        try:
+            if method == 'get':
+                response = session.get(url, params=params, headers=headers, timeout=SYNC_TIMEOUT)
+            else:
+                response = session.post(url, json=params, headers=headers, timeout=SYNC_TIMEOUT)
+            status = response.status_code
+            body = response.text
+            check_response(url, status, body)
+            logger.debug('response %s status, data=%s', status, logs.Body(body))
+            return response
+        except (ApiError, requests.ConnectionError, requests.Timeout) as e:
+            if attempt + 1 == attempts or (isinstance(e, ApiError) and not e.retryable):
+                raise
+            delay = backoff(attempt)
+            logger.warning('retrying %s %s in %.2fs after %r', method, url, delay, e)
+        finally:
+            _observe(method, url, status, len(body), start, headers)
+        time.sleep(delay)
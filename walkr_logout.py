@@ -1,16 +1,25 @@
-import requests
 import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot'))
+
+import transport  # noqa: E402
+
 
 def action(email: str, password: str):
-    r1 = requests.post(
+    # все три запроса идут через одну keep-alive сессию transport
+    r1 = transport.request_sync(
+        'post',
         'https://core.sparkful.app/api/v1/auth/signIn',
-        json={'email': email, 'password': password}
+        {'email': email, 'password': password}
     )
     token1 = r1.headers['authorization'][7:]
 
-    r2 = requests.post(
+    r2 = transport.request_sync(
+        'post',
         'https://core.sparkful.app/api/v1/appUsages',
-        json={
+        {
             "appIdentifier": "walkr",
             "platform": "ios",
             "auth_token": token1,
@@ -20,20 +29,15 @@ def action(email: str, password: str):
         headers={'authorization': f'BEARER {token1}'})
     token2 = r2.headers['authorization'][7:]
 
-    r3 = requests.get(
+    r3 = transport.request_sync(
+        'get',
         'https://production.sw.fourdesire.com/api/v2/friends',
-        params={
-            'client_version': '7.2.2.4',
-            'country_code': 'ru',
-            'device_model': 'iPhone13,2',
-            'limit': '100',
-            'locale': 'en',
-            'offset': '0',
-            'order_by': 'population',
-            'os_version': 'iOS 17.4.1',
-            'platform': 'ios',
-            'timezone': '2'
-        },
+        transport.get_params(
+            country_code='ru',
+            limit='100',
+            offset='0',
+            order_by='population',
+        ),
         headers={'authorization': f'BEARER {token2}'}
     )
     print(r3.text)